@@ -0,0 +1,185 @@
+"""
+Prompt tokens per answer and hit precision of the retrieval, with every
+page embedded whole against the token-sized chunks of `core.chunking`.
+
+The fixture is a synthetic manual of dense pages, each one stating a single
+fact that a query asks for. The embeddings are hashed TF-IDF bags of words, so
+the benchmark needs neither the network nor an API key. tiktoken is used when
+its encoding is available, a whitespace tokenizer otherwise (--stub forces
+it).
+
+    python benchmarks/bench_chunking.py [--stub]
+"""
+
+import os
+import re
+import sys
+import zlib
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core.chunking  # noqa: E402
+from config.cfg import CHUNK_OVERLAP_TOKENS, CHUNK_SIZE_TOKENS  # noqa: E402
+from core.chunking import chunk_text  # noqa: E402
+from core.scoring import EmbeddingMatrix  # noqa: E402
+
+PAGES = 60
+PARAGRAPHS_PER_PAGE = 12
+WORDS_PER_SENTENCE = 18
+SENTENCES_PER_PARAGRAPH = 6
+DIMENSIONS = 1024
+TOP_K = 5
+WORD = re.compile(r"\w+")
+
+
+class WhitespaceEncoding:
+    """
+    Stand-in for a tiktoken encoding: one token per word with its trailing
+    whitespace.
+    """
+
+    name = "whitespace"
+    TOKEN = re.compile(r"\S+\s*|\s+")
+
+    def encode(self, text, disallowed_special=()):
+        return [match.group() for match in self.TOKEN.finditer(text)]
+
+    def decode_with_offsets(self, tokens):
+        offsets, position = [], 0
+        for token in tokens:
+            offsets.append(position)
+            position += len(token)
+        return "".join(tokens), offsets
+
+
+def load_encoding(stub: bool):
+    if not stub:
+        try:
+            encoding = core.chunking.get_encoding()
+            encoding.encode("warm up")
+            return encoding
+        except Exception as e:
+            print(f"tiktoken unavailable ({e}), using the whitespace tokenizer")
+    encoding = WhitespaceEncoding()
+    core.chunking.get_encoding = lambda name="cl100k_base": encoding
+    return encoding
+
+
+def make_manual(rng):
+    """
+    Pages of filler paragraphs, one of them holding the fact of the page, and
+    the query asking for every fact.
+    """
+    vocabulary = [
+        "".join(
+            rng.choice(list("abcdefghijklmnopqrstuvwxyz"), size=rng.integers(3, 10))
+        )
+        for _ in range(3000)
+    ]
+
+    def sentence():
+        return " ".join(rng.choice(vocabulary, size=WORDS_PER_SENTENCE)) + "."
+
+    pages, facts, queries = [], [], []
+    for page in range(PAGES):
+        paragraphs = [
+            " ".join(sentence() for _ in range(SENTENCES_PER_PARAGRAPH))
+            for _ in range(PARAGRAPHS_PER_PAGE)
+        ]
+        pressure = int(rng.integers(5, 400))
+        fact = (
+            f"The maximum operating pressure of relief valve RV{page:03d} is "
+            f"{pressure} bar at the rated flow."
+        )
+        paragraphs[int(rng.integers(0, PARAGRAPHS_PER_PAGE))] += " " + fact
+        pages.append("\n".join(paragraphs))
+        facts.append(fact)
+        queries.append(
+            f"What is the maximum operating pressure of relief valve RV{page:03d}?"
+        )
+    return pages, facts, queries
+
+
+def inverse_frequencies(texts):
+    frequencies = {}
+    for text in texts:
+        for word in set(WORD.findall(text.lower())):
+            frequencies[word] = frequencies.get(word, 0) + 1
+    return {
+        word: np.log(len(texts) / frequency) + 1
+        for word, frequency in frequencies.items()
+    }
+
+
+def embed(text: str, idf: dict) -> np.ndarray:
+    vector = np.zeros(DIMENSIONS, dtype=np.float32)
+    for word in WORD.findall(text.lower()):
+        vector[zlib.crc32(word.encode("utf-8")) % DIMENSIONS] += idf.get(word, 1)
+    return vector
+
+
+def measure(pages, facts, queries, encoding, chunk_size):
+    documents = [
+        {"page": page, **chunk}
+        for page, text in enumerate(pages)
+        for chunk in chunk_text(
+            text, chunk_size=chunk_size, overlap=CHUNK_OVERLAP_TOKENS
+        )
+    ]
+    idf = inverse_frequencies([doc["text"] for doc in documents])
+    matrix = EmbeddingMatrix(
+        pages=[doc["page"] for doc in documents],
+        embeddings=np.stack([embed(doc["text"], idf) for doc in documents]),
+        ids=range(len(documents)),
+    )
+
+    # Only one page holds the fact, so the precision is at most 1 / TOP_K
+    prompt_tokens, precision, hits_at_1, found = [], [], [], []
+    for fact, query in zip(facts, queries):
+        # The text of the best segment of every page goes in the prompt
+        texts = [
+            documents[hit["_id"]]["text"]
+            for hit in matrix.search(embed(query, idf), top_k=TOP_K)
+        ]
+        prompt_tokens.append(
+            sum(len(encoding.encode(text, disallowed_special=())) for text in texts)
+        )
+        precision.append(np.mean([fact in text for text in texts]))
+        hits_at_1.append(fact in texts[0])
+        found.append(any(fact in text for text in texts))
+    return (
+        len(documents),
+        np.mean(prompt_tokens),
+        np.mean(precision),
+        np.mean(hits_at_1),
+        np.mean(found),
+    )
+
+
+def main():
+    encoding = load_encoding(stub="--stub" in sys.argv)
+    pages, facts, queries = make_manual(np.random.default_rng(0))
+    page_tokens = np.mean([len(encoding.encode(text)) for text in pages])
+    print(
+        f"{PAGES} pages of {page_tokens:.0f} tokens ({encoding.name}), "
+        f"top {TOP_K} pages per query"
+    )
+
+    baseline = None
+    for label, chunk_size in (("whole pages", 0), ("chunked", CHUNK_SIZE_TOKENS)):
+        documents, tokens, precision, hit_at_1, found = measure(
+            pages, facts, queries, encoding, chunk_size
+        )
+        saved = "" if baseline is None else f" ({1 - tokens / baseline:.0%} saved)"
+        baseline = baseline or tokens
+        print(
+            f"{label} ({documents} vectors): {tokens:.0f} prompt tokens per "
+            f"answer{saved}, precision {precision:.2f}, hit@1 {hit_at_1:.2f}, "
+            f"fact in the prompt {found:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
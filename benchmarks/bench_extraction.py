@@ -0,0 +1,169 @@
+"""
+PDF parsing: the original extraction, where `extract_full_text`,
+`generate_toc` and `extract_keywords` each opened the PDF and walked its
+pages, against the single analysis of `TextExtractor` (one worker, then the
+configured process pool), on a PDF generated with reportlab.
+
+    python benchmarks/bench_extraction.py [pages]
+"""
+
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import pdfplumber
+from reportlab.pdfgen import canvas
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config.cfg import EXTRACTION_WORKERS, TOC_KEYWORDS  # noqa: E402
+from core.text_extractor import TextExtractor  # noqa: E402
+
+PAGES = 100
+LINES_PER_PAGE = 40
+
+
+def make_pdf(path: str, pages: int = PAGES):
+    """
+    A manual with a ToC on its second page, and pages of body text with a
+    larger heading and some bold and coloured words. The body of the pages
+    holds non-ASCII text too.
+    """
+    pdf = canvas.Canvas(path)
+    for index in range(pages):
+        if index == 1:
+            pdf.setFont("Helvetica-Bold", 16)
+            pdf.drawString(72, 780, "Indice")
+            pdf.setFont("Helvetica", 10)
+            for chapter in range(1, 11):
+                pdf.drawString(
+                    72,
+                    760 - chapter * 14,
+                    f"{chapter} Chapter {chapter} .... {chapter * 3}",
+                )
+            pdf.showPage()
+            continue
+
+        pdf.setFont("Helvetica-Bold", 16)
+        pdf.drawString(72, 780, f"Section {index}: pump P-{index:03d}")
+        for line in range(LINES_PER_PAGE):
+            y = 750 - line * 16
+            pdf.setFont("Helvetica", 10)
+            pdf.drawString(
+                72,
+                y,
+                f"Line {line} of page {index}: la pressione è di {line} bar, "
+                f"the valve opens at {index + line} °C.",
+            )
+            if line % 8 == 0:
+                pdf.setFont("Helvetica-Bold", 10)
+                pdf.drawString(420, y, f"Warning{line}")
+            elif line % 8 == 4:
+                pdf.setFillColorRGB(0.8, 0, 0)
+                pdf.drawString(420, y, f"Note{line}")
+                pdf.setFillColorRGB(0, 0, 0)
+        pdf.showPage()
+    pdf.save()
+
+
+def per_page_full_text(path: str, directory: str) -> str:
+    """
+    The original `extract_full_text`: the text of every page, also written
+    to a file per page.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with pdfplumber.open(path) as pdf:
+        complete_text = ""
+        for i, page in enumerate(pdf.pages):
+            page_text = page.extract_text()
+            with open(
+                os.path.join(directory, f"page_{i}.txt"), "w", encoding="utf-8"
+            ) as file:
+                file.write(page_text or "")
+            complete_text += page_text or ""
+    return complete_text
+
+
+def per_page_toc_pages(path: str, toc_keywords: List[str] = TOC_KEYWORDS) -> List[int]:
+    """
+    The scan of the original `generate_toc`: the text of every page is
+    extracted to look for the ToC keywords.
+    """
+    pages = []
+    with pdfplumber.open(path) as pdf:
+        for i, page in enumerate(pdf.pages):
+            text = page.extract_text()
+            if text and any(keyword in text for keyword in toc_keywords):
+                pages.append(i + 1)
+    return pages
+
+
+def per_page_keyword_chars(path: str, pages: List[int]) -> Dict[int, str]:
+    """
+    The parsing of the original `extract_keywords`: the chars of every page
+    are walked once for the average font size, then again to select the
+    bold, coloured and larger ones.
+    """
+    selected = {}
+    with pdfplumber.open(path) as pdf:
+        sizes = [char.get("size", 0) for page in pdf.pages for char in page.chars]
+        size_threshold = (statistics.mean(sizes) if sizes else 10) * 1.2
+        for page in pdf.pages:
+            if page.page_number in pages:
+                continue
+            selected[page.page_number] = "".join(
+                char.get("text", "")
+                for char in page.chars
+                if "Bold" in char.get("fontname", "")
+                or char.get("stroking_color", None) != (0,)
+                or char.get("size", 0) > size_threshold
+            )
+    return selected
+
+
+def per_page_extraction(path: str, directory: str):
+    full_text = per_page_full_text(path, directory)
+    pages = per_page_toc_pages(path)
+    return full_text, per_page_keyword_chars(path, pages)
+
+
+def single_pass_extraction(path: str, workers: int):
+    text_extractor = TextExtractor(path)
+    text_extractor.analyze(workers=workers)
+    full_text = text_extractor.extract_full_text()
+    _, pages = text_extractor.scan_toc()
+    return full_text, text_extractor.extract_keywords(pages=pages)
+
+
+def timed_s(function) -> float:
+    started = time.perf_counter()
+    function()
+    return time.perf_counter() - started
+
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else PAGES
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        path = os.path.join(directory, "manual.pdf")
+        make_pdf(path, pages)
+
+        per_page = timed_s(lambda: per_page_extraction(path, "per_page"))
+        one_worker = timed_s(lambda: single_pass_extraction(path, workers=1))
+        pool = timed_s(lambda: single_pass_extraction(path, EXTRACTION_WORKERS))
+        full_text, _ = per_page_extraction(path, "per_page")
+        same_text = full_text == single_pass_extraction(path, workers=1)[0]
+
+    print(
+        f"{pages} pages: per-page extraction {per_page:.2f} s, single pass "
+        f"{one_worker:.2f} s (x{per_page / one_worker:.1f}), single pass with "
+        f"{EXTRACTION_WORKERS} workers {pool:.2f} s (x{per_page / pool:.1f}), "
+        f"same text: {same_text}"
+    )
+
+
+if __name__ == "__main__":
+    main()
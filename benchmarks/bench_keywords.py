@@ -0,0 +1,193 @@
+"""
+Keyword extraction: the original per-char and per-word loops of
+`TextExtractor.extract_keywords` against the NumPy masks, on a synthetic
+analysis of 500 pages.
+
+    python benchmarks/bench_keywords.py
+"""
+
+import os
+import statistics
+import sys
+import time
+from array import array
+from itertools import accumulate
+from typing import Dict, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config.cfg import DEFAULT_KEYWORDS_TO_IGNORE  # noqa: E402
+from core.text_extractor import (  # noqa: E402
+    DocumentAnalysis,
+    PageAnalysis,
+    TextExtractor,
+    clean_text,
+    exact_sum,
+)
+
+PAGES = 500
+WORDS_PER_PAGE = 400
+TOC_PAGES = [2, 3]
+
+# Words exercising the punctuation, the keywords to ignore (alone, inside
+# words, in any case) and the filters of `clean_keywords`
+TRICKY_WORDS = [
+    "Generali",
+    "GENERALI,",
+    "x[str]y",
+    "pro[int]ject",
+    "gen(erali)",
+    "[str/list/dict]",
+    "Project:",
+    "project123",
+    "ab",
+    "a",
+    "1234",
+    "12ab",
+    "verylongwordthatexceeds",
+    "Σigma",
+    "‘quoted’",
+    "(Foo).",
+    "[STR]",
+]
+
+
+def make_analysis(rng, pages: int = PAGES) -> DocumentAnalysis:
+    """
+    Pages of random words, some of them bold, coloured or larger. A few
+    chars hold several code points, like the "(cid:3)" of unmapped glyphs.
+    """
+    vocabulary = [
+        "".join(rng.choice(list("abcdefghijklmnopqrstuvwxyzAEIOU"), size=length))
+        for length in rng.integers(1, 12, size=2000)
+    ] + TRICKY_WORDS
+
+    analysis = DocumentAnalysis()
+    for page_number in range(1, pages + 1):
+        texts, sizes, bold, coloured = [], [], [], []
+        for word in rng.choice(vocabulary, size=WORDS_PER_PAGE):
+            style = rng.random()
+            chars = ["(cid:3)"] if rng.random() < 0.01 else list(word)
+            for char in chars + [" "]:
+                texts.append(char)
+                sizes.append(14.0 if 0.1 < style < 0.2 else 10.0)
+                bold.append(style < 0.1)
+                coloured.append(0.2 < style < 0.25)
+        page = PageAnalysis(
+            page_number=page_number,
+            text="".join(texts),
+            chars="".join(texts),
+            char_sizes=array("d", sizes),
+            char_bold=bytearray(bold),
+            char_coloured=bytearray(coloured),
+        )
+        if len(page.chars) != len(texts):
+            page.char_lengths = array("I", map(len, texts))
+        analysis.pages.append(page)
+        analysis.size_sum += exact_sum(page.char_sizes)
+        analysis.size_count += len(page.char_sizes)
+    return analysis
+
+
+def char_texts(page: PageAnalysis) -> List[str]:
+    """
+    The text of every char, as the original analysis stored them.
+    """
+    if page.char_lengths is None:
+        return list(page.chars)
+    ends = list(accumulate(page.char_lengths))
+    return [
+        page.chars[end - length : end] for end, length in zip(ends, page.char_lengths)
+    ]
+
+
+def loop_extract_keywords(
+    analysis: DocumentAnalysis,
+    texts: Dict[int, List[str]],
+    pages: List[int],
+    keywords_to_ignore: List[str] = DEFAULT_KEYWORDS_TO_IGNORE,
+) -> Dict[int, List[str]]:
+    """
+    The original extraction, char by char and word by word, with the char
+    `texts` of every page number. Its
+    `clean_keywords` removed items from the lists it iterated, skipping the
+    word following every removed one: the filter is applied to every word
+    here.
+    """
+    bold_text = {}
+    size_threshold = analysis.avg_font_size * 1.2
+    for page in analysis.pages:
+        if page.page_number not in pages:
+            page_chars = [
+                text
+                for text, size, bold, coloured in zip(
+                    texts[page.page_number],
+                    page.char_sizes,
+                    page.char_bold,
+                    page.char_coloured,
+                )
+                if bold or coloured or size > size_threshold
+            ]
+            full_text = "".join(page_chars)
+
+            char_list = [char for char in full_text.split(" ") if char]
+            refactored_char_list = []
+            for char in char_list:
+                for keyword in keywords_to_ignore:
+                    replaced_char = char.replace(keyword, "")
+                    if replaced_char != "":
+                        refactored_char_list.append(replaced_char.lower())
+                    break
+            unique_chars = list(set(refactored_char_list))
+            bold_text[page.page_number] = clean_text(" ".join(unique_chars))
+
+    keywords = {}
+    for key, value in bold_text.items():
+        new_value_list = []
+        for v in value.split(" "):
+            for keyword in keywords_to_ignore:
+                v = v.replace(keyword, "")
+            new_value_list.append(v.lower())
+        keywords[key - 1] = [
+            keyword
+            for keyword in set(new_value_list)
+            if 2 <= len(keyword) <= 15 and not keyword.isdigit()
+        ]
+    return keywords
+
+
+def timed_ms(function) -> float:
+    timings = []
+    for _ in range(5):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    analysis = make_analysis(np.random.default_rng(0))
+    text_extractor = TextExtractor("bench.pdf")
+    text_extractor.analysis = analysis
+
+    texts = {page.page_number: char_texts(page) for page in analysis.pages}
+
+    expected = loop_extract_keywords(analysis, texts, TOC_PAGES)
+    found = text_extractor.extract_keywords(pages=TOC_PAGES)
+    same = {page: set(words) for page, words in expected.items()} == {
+        page: set(words) for page, words in found.items()
+    }
+
+    loop_ms = timed_ms(lambda: loop_extract_keywords(analysis, texts, TOC_PAGES))
+    mask_ms = timed_ms(lambda: text_extractor.extract_keywords(pages=TOC_PAGES))
+    chars = sum(len(page.char_sizes) for page in analysis.pages)
+    print(
+        f"{PAGES} pages, {chars} chars: loops {loop_ms:.0f} ms, masks "
+        f"{mask_ms:.0f} ms (x{loop_ms / mask_ms:.1f}), same keywords: {same}"
+    )
+
+
+if __name__ == "__main__":
+    main()
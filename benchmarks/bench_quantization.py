@@ -0,0 +1,111 @@
+"""
+Embedding storage formats: BSON size per document, decode time and recall of
+the int8 coarse pass rescored with the exact embeddings, as done by
+`MongoDb.rescore`, against the exact scan.
+
+    python benchmarks/bench_quantization.py
+"""
+
+import os
+import sys
+import time
+
+import bson
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config.cfg import RESCORE_CANDIDATES  # noqa: E402
+from core.quantization import embedding_fields  # noqa: E402
+from core.scoring import EmbeddingMatrix, QuantizedMatrix  # noqa: E402
+
+DIMENSIONS = 1536
+DOCUMENTS = 10000
+QUERIES = 50
+TOP_K = 5
+
+
+def make_embeddings(rng, count):
+    """
+    Clustered vectors, closer to real embeddings than isotropic noise.
+    """
+    centers = rng.normal(size=(50, DIMENSIONS))
+    topics = rng.integers(0, len(centers), size=count)
+    return centers[topics] + rng.normal(scale=1.5, size=(count, DIMENSIONS))
+
+
+def encode_documents(embeddings, storage):
+    return [
+        bson.encode(
+            {
+                "_id": i,
+                "page": i // 4,
+                **embedding_fields(embedding.tolist(), storage=storage),
+            }
+        )
+        for i, embedding in enumerate(embeddings)
+    ]
+
+
+def decode_ms(encoded):
+    """
+    Time to turn the stored documents into the matrix of a search.
+    """
+    started = time.perf_counter()
+    EmbeddingMatrix.from_documents([bson.decode(document) for document in encoded])
+    return (time.perf_counter() - started) * 1000
+
+
+def rescored_search(documents, exact, query, top_k):
+    candidates = QuantizedMatrix.from_documents(documents).candidates(
+        query, max(RESCORE_CANDIDATES, top_k * 4)
+    )
+    return EmbeddingMatrix(
+        exact.pages[candidates], exact.matrix[candidates], candidates
+    ).search(query, top_k=top_k)
+
+
+def recall(expected, found):
+    return len({hit["page"] for hit in expected} & {hit["page"] for hit in found}) / (
+        len(expected)
+    )
+
+
+def main():
+    rng = np.random.default_rng(0)
+    embeddings = make_embeddings(rng, DOCUMENTS)
+    queries = make_embeddings(rng, QUERIES)
+
+    encoded = {}
+    for storage in ("array", "binary"):
+        encoded[storage] = encode_documents(embeddings, storage)
+        size = np.mean([len(document) for document in encoded[storage]])
+        print(
+            f"{storage}: {size / 1024:.1f} KiB per document, "
+            f"decoded in {decode_ms(encoded[storage]):.0f} ms for {DOCUMENTS}"
+        )
+
+    documents = [bson.decode(document) for document in encoded["binary"]]
+    exact = EmbeddingMatrix.from_documents(documents)
+    coarse = QuantizedMatrix.from_documents(documents)
+    coarse_pages = EmbeddingMatrix(exact.pages, coarse.matrix, coarse.ids)
+
+    started = time.perf_counter()
+    expected = [exact.search(query, top_k=TOP_K) for query in queries]
+    exact_ms = (time.perf_counter() - started) / QUERIES * 1000
+    started = time.perf_counter()
+    found = [rescored_search(documents, exact, query, TOP_K) for query in queries]
+    rescored_ms = (time.perf_counter() - started) / QUERIES * 1000
+    int8_only = [coarse_pages.search(query, top_k=TOP_K) for query in queries]
+
+    print(
+        f"recall@{TOP_K} of the pages against the exact scan ({exact_ms:.1f} ms/query): "
+        f"int8 only {np.mean([recall(e, f) for e, f in zip(expected, int8_only)]):.3f}, "
+        f"int8 + rescoring of {RESCORE_CANDIDATES} candidates "
+        f"{np.mean([recall(e, f) for e, f in zip(expected, found)]):.3f} "
+        f"({rescored_ms:.1f} ms/query with the int8 matrix built per query)"
+    )
+
+
+if __name__ == "__main__":
+    main()
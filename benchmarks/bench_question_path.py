@@ -0,0 +1,274 @@
+"""
+Time to first token of an answer, with the sequential question path (sync
+search, then `call_llm_for_question`) against the async one of the app
+(`aprepare_question`, then `acall_llm_for_question` on a `BackgroundLoop`).
+
+The embedding model, the database round trips, the service data and the
+chat model are stubs sleeping a fixed latency, so the benchmark needs
+neither the network nor an API key. The collection is a `LocalVectorStore`
+whose searches and text fetches wait for the database latency. tiktoken is
+used when its encoding is available, a whitespace tokenizer otherwise
+(--stub forces it).
+
+    python benchmarks/bench_question_path.py [--stub]
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core.chunking  # noqa: E402
+import core.context  # noqa: E402
+import core.embeddings  # noqa: E402
+import core.history  # noqa: E402
+import core.util_functions  # noqa: E402
+from benchmarks.bench_chunking import WhitespaceEncoding  # noqa: E402
+from core.chunking import chunk_page  # noqa: E402
+from core.embeddings import embed_in_batches  # noqa: E402
+from core.history import ConversationHistory  # noqa: E402
+from core.local_store import LocalVectorStore  # noqa: E402
+from core.lru import LRUCache  # noqa: E402
+from core.quantization import embedding_fields  # noqa: E402
+from core.util_functions import (  # noqa: E402
+    BackgroundLoop,
+    acall_llm_for_question,
+    aprepare_question,
+    call_llm_for_question,
+    process_question,
+)
+
+EMBEDDING_LATENCY = 0.15
+DATABASE_LATENCY = 0.08
+SERVICE_DATA_LATENCY = 0.05
+FIRST_TOKEN_LATENCY = 0.3
+QUESTIONS = 10
+PAGES = 40
+TOP_K = 5
+DIMENSIONS = 256
+MODEL = "gpt-4o"
+PDF_PATH = "./tmp/manual.pdf"
+
+
+def load_encoding(stub: bool):
+    if not stub:
+        try:
+            encoding = core.history.get_model_encoding(MODEL)
+            encoding.encode("warm up")
+            return encoding
+        except Exception as e:
+            print(f"tiktoken unavailable ({e}), using the whitespace tokenizer")
+    encoding = WhitespaceEncoding()
+    core.chunking.get_encoding = lambda name="cl100k_base": encoding
+    core.embeddings.get_encoding = lambda name="cl100k_base": encoding
+    core.history.get_model_encoding = lambda model: encoding
+    core.context.get_model_encoding = lambda model: encoding
+    return encoding
+
+
+def vector(text: str) -> list:
+    embedding = np.zeros(DIMENSIONS)
+    for word in text.lower().split():
+        embedding[zlib.crc32(word.encode("utf-8")) % DIMENSIONS] += 1
+    embedding[0] += 0.01
+    return embedding.tolist()
+
+
+class StubEmbeddings:
+    model = "stub-embedding"
+
+    def embed_documents(self, texts):
+        return [vector(text) for text in texts]
+
+    def embed_query(self, text):
+        time.sleep(EMBEDDING_LATENCY)
+        return vector(text)
+
+    async def aembed_query(self, text):
+        await asyncio.sleep(EMBEDDING_LATENCY)
+        return vector(text)
+
+
+class RemoteStore(LocalVectorStore):
+    """
+    Local store answering with the latency of a database.
+    """
+
+    def exact_search(self, *args, **kwargs):
+        time.sleep(DATABASE_LATENCY)
+        return super().exact_search(*args, **kwargs)
+
+    def fetch_texts(self, hits):
+        time.sleep(DATABASE_LATENCY)
+        return super().fetch_texts(hits)
+
+
+class Chunk:
+    def __init__(self, content: str):
+        delta = type("Delta", (), {"content": content})()
+        self.choices = [type("Choice", (), {"delta": delta})()]
+
+
+class StubCompletions:
+    def create(self, model, messages, max_tokens, stream):
+        time.sleep(FIRST_TOKEN_LATENCY)
+        return iter([Chunk("The"), Chunk(" answer.")])
+
+
+class AsyncStubCompletions:
+    async def create(self, model, messages, max_tokens, stream):
+        await asyncio.sleep(FIRST_TOKEN_LATENCY)
+
+        async def chunks():
+            for content in ("The", " answer."):
+                yield Chunk(content)
+
+        return chunks()
+
+
+class StubClient:
+    def __init__(self, completions):
+        self.chat = type("Chat", (), {"completions": completions})()
+
+
+def load_service_data(service_dir: str) -> str:
+    time.sleep(SERVICE_DATA_LATENCY)
+    return "Manuale di manutenzione delle pompe."
+
+
+def ingest(store: LocalVectorStore) -> LocalVectorStore:
+    handle = store.for_collection("manual")
+    handle.create_indexes()
+    chunks = [
+        chunk
+        for page in range(PAGES)
+        for chunk in chunk_page(
+            page,
+            f"Page {page}: the valve V{page:03d} of the pump is serviced every "
+            f"{page + 1} months.",
+            keywords=[],
+            filename="",
+        )
+    ]
+    embeddings = embed_in_batches(
+        handle.embedding_model, [chunk["text"] for chunk in chunks]
+    )
+    handle.insert_in_batches(
+        [
+            {**chunk, **embedding_fields(embedding)}
+            for chunk, embedding in zip(chunks, embeddings)
+        ]
+    )
+    handle.build_indexes({})
+    return handle
+
+
+def sequential_ttft(db, client, question: str, messages: list) -> float:
+    """
+    The original path: every step waits for the previous one.
+    """
+    started = time.perf_counter()
+    results = db.query_with_keyword_filter(
+        query_text=process_question(question),
+        top_k=TOP_K,
+        keyword_filter=question.split(" "),
+        lexical_query=question,
+    )
+    stream = call_llm_for_question(
+        path=PDF_PATH,
+        question=question,
+        external_knowledge=results,
+        client=client,
+        model=MODEL,
+        history=messages,
+    )
+    next(stream)
+    return time.perf_counter() - started
+
+
+def async_ttft(db, client, loop, question: str, history) -> float:
+    """
+    The path of the app: the retrieval and the service data overlap.
+    """
+    started = time.perf_counter()
+    results, service_data, history_text = loop.run(
+        aprepare_question(
+            db=db,
+            path=PDF_PATH,
+            question=question,
+            top_k=TOP_K,
+            history=history,
+            model=MODEL,
+        )
+    )
+    stream = loop.iterate(
+        acall_llm_for_question(
+            path=PDF_PATH,
+            question=question,
+            external_knowledge=results,
+            client=client,
+            model=MODEL,
+            service_data=service_data,
+            history_text=history_text,
+        )
+    )
+    next(stream)
+    stream.close()
+    return time.perf_counter() - started
+
+
+def main():
+    load_encoding(stub="--stub" in sys.argv)
+    # The stop words are downloaded by NLTK, the service data read from disk
+    core.util_functions.get_stop_words = lambda: frozenset({"il", "la", "di"})
+    core.util_functions.load_service_data = load_service_data
+    core.util_functions.save_payload = lambda payload: None
+
+    messages = [
+        {"role": "user", "content": "How often is the pump serviced?"},
+        {"role": "assistant", "content": "It depends on the valve."},
+    ]
+    history = ConversationHistory.from_messages(messages, MODEL)
+    loop = BackgroundLoop()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        db = ingest(RemoteStore(directory=directory, embedding_model=StubEmbeddings()))
+        # Every question is asked by both paths: the results are not cached
+        db.result_cache = LRUCache(0)
+        timings = {"sequential": [], "async": []}
+        for i in range(QUESTIONS):
+            question = f"How often is the valve of pump {i} serviced?"
+            timings["sequential"].append(
+                sequential_ttft(db, StubClient(StubCompletions()), question, messages)
+            )
+            timings["async"].append(
+                async_ttft(
+                    db, StubClient(AsyncStubCompletions()), loop, question, history
+                )
+            )
+
+    print(
+        f"Stub latencies: embedding {EMBEDDING_LATENCY * 1000:.0f} ms, database "
+        f"{DATABASE_LATENCY * 1000:.0f} ms per round trip, service data "
+        f"{SERVICE_DATA_LATENCY * 1000:.0f} ms, first token "
+        f"{FIRST_TOKEN_LATENCY * 1000:.0f} ms"
+    )
+    sequential = statistics.median(timings["sequential"]) * 1000
+    overlapped = statistics.median(timings["async"]) * 1000
+    print(
+        f"Time to first token over {QUESTIONS} questions: sequential "
+        f"{sequential:.0f} ms, async {overlapped:.0f} ms "
+        f"({1 - overlapped / sequential:.0%} less)"
+    )
+
+
+if __name__ == "__main__":
+    main()
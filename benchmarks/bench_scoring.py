@@ -0,0 +1,83 @@
+"""
+Top-k page scoring: the per-document loop of the original
+`query_with_keyword_filter` against `EmbeddingMatrix.search`.
+
+    python benchmarks/bench_scoring.py
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.scoring import EmbeddingMatrix  # noqa: E402
+
+DIMENSIONS = 1536
+QUERIES = 20
+
+
+def loop_search(documents, query_embedding, top_k):
+    """
+    The original scoring: one cosine similarity per document in Python.
+    """
+
+    def cosine_similarity(vec1, vec2):
+        return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
+
+    page_scores = {}
+    for doc in documents:
+        page = doc["page"]
+        score = cosine_similarity(query_embedding, np.array(doc["embedding"]))
+        if page not in page_scores or score > page_scores[page]["score"]:
+            page_scores[page] = {"_id": doc["_id"], "score": score}
+    results = [
+        {"_id": data["_id"], "page": page, "score": data["score"]}
+        for page, data in page_scores.items()
+    ]
+    results.sort(key=lambda x: x["score"], reverse=True)
+    return results[:top_k]
+
+
+def make_documents(count, rng):
+    embeddings = rng.normal(size=(count, DIMENSIONS))
+    # About four segments per page, like the chunked documents
+    return [
+        {"_id": i, "page": i // 4, "embedding": embeddings[i].tolist()}
+        for i in range(count)
+    ]
+
+
+def timed(function, queries):
+    started = time.perf_counter()
+    results = [function(query) for query in queries]
+    return results, (time.perf_counter() - started) / len(queries) * 1000
+
+
+def main():
+    rng = np.random.default_rng(0)
+    for count in (2000, 20000):
+        documents = make_documents(count, rng)
+        queries = rng.normal(size=(QUERIES, DIMENSIONS))
+
+        started = time.perf_counter()
+        matrix = EmbeddingMatrix.from_documents(documents)
+        build_ms = (time.perf_counter() - started) * 1000
+
+        expected, loop_ms = timed(lambda q: loop_search(documents, q, 10), queries)
+        found, matrix_ms = timed(lambda q: matrix.search(q, top_k=10), queries)
+        same = all(
+            [hit["page"] for hit in a] == [hit["page"] for hit in b]
+            for a, b in zip(expected, found)
+        )
+        print(
+            f"{count} documents: loop {loop_ms:.1f} ms/query, matrix "
+            f"{matrix_ms:.2f} ms/query (x{loop_ms / matrix_ms:.0f}, built once "
+            f"in {build_ms:.0f} ms), same pages: {same}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -15,7 +15,42 @@ FAQ = {
 AGENTS_DIR = "service_knowledge"
 
 # MAXIMUM NUMBER OF HISTORY TOKENS
+# Counted with the tokenizer of the chat model, the default applies to the
+# models missing from the budgets
 MAX_HISTORY_TOKENS = 2000
+HISTORY_TOKEN_BUDGETS = {
+    "gpt-3.5-turbo": 2000,
+    "gpt-4-turbo": 4000,
+    "gpt-4o": 4000,
+}
+
+# PROMPT CONTEXT ASSEMBLY
+# Tokens of the whole prompt (system prompt, history, question and retrieved
+# passages), the passages get what the rest leaves
+MAX_PROMPT_TOKENS = 8000
+PROMPT_TOKEN_BUDGETS = {
+    "gpt-3.5-turbo": 8000,
+    "gpt-4-turbo": 12000,
+    "gpt-4o": 12000,
+}
+# Sentences kept from every passage, the most relevant to the question
+CONTEXT_MAX_SENTENCES = 12
+# Passages whose word trigrams overlap a kept one at least this much are dropped
+CONTEXT_DUPLICATE_THRESHOLD = 0.8
+
+# ANSWER CACHE
+ANSWER_CACHE_ENABLED = True
+# Cosine similarity of the question embeddings to reuse an answer
+ANSWER_CACHE_SIMILARITY = 0.95
+ANSWER_CACHE_TTL_SECONDS = 24 * 60 * 60
+# Keys (collection version, model parameters and conversation) kept
+ANSWER_CACHE_MAX_ENTRIES = 1000
+# Answers kept per key
+ANSWER_CACHE_MAX_ANSWERS = 100
+
+# RETRIEVAL RESULTS CACHE
+# Queries cached per process, keyed on the version of the collection
+RETRIEVAL_CACHE_MAX_ENTRIES = 256
 
 # MAXIMUM NUMBER OF CHARACTERS TO USE
 MAX_CHAR_TOC_TO_USE = 10000
@@ -32,6 +67,17 @@ TOC_KEYWORDS = [
     "INDEX",
 ]
 
+# RESOLUTION OF THE TOC
+# Pages scanned for a printed ToC when the PDF has no outline
+TOC_SCAN_PAGES = 10
+# Stage and latency of every ToC resolution, one JSON object per line
+TOC_METRICS_PATH = "chatbot_output/toc_resolution.jsonl"
+
+# PARALLEL PDF EXTRACTION
+EXTRACTION_WORKERS = int(os.environ.get("EXTRACTION_WORKERS", os.cpu_count() or 1))
+# Documents with fewer pages per worker use fewer workers
+EXTRACTION_MIN_PAGES_PER_WORKER = 25
+
 # KEYWORDS TO IGNORE
 DEFAULT_KEYWORDS_TO_IGNORE = [
     "generali",
@@ -50,9 +96,72 @@ DEFAULT_KEYWORDS_TO_IGNORE = [
     "[list]",
 ]
 
+# DIRECTORY OF THE PAGE STORES OF THE DOCUMENTS
+PAGE_STORE_DIR = "extracted_pages"
+
+# CHUNKING OF THE PAGES (0 KEEPS EVERY PAGE IN A SINGLE CHUNK)
+CHUNK_SIZE_TOKENS = 400
+CHUNK_OVERLAP_TOKENS = 50
+
+# APPROXIMATE NEAREST NEIGHBOUR INDEX
+ANN_ENABLED = True
+ANN_INDEX_DIR = "vector_indexes"
+# Collections with fewer documents are searched exactly
+ANN_MIN_DOCUMENTS = 1000
+# Number of lists scanned per query: higher is slower but more accurate
+ANN_N_PROBE = 8
+ANN_KMEANS_ITERATIONS = 10
+
+# EMBEDDING REQUESTS
+# Maximum number of tokens of a single input of the embedding model
+EMBEDDING_MAX_TOKENS = 8191
+EMBEDDING_BATCH_MAX_TOKENS = 100000
+EMBEDDING_BATCH_MAX_SIZE = 256
+EMBEDDING_MAX_CONCURRENCY = 4
+
+# EMBEDDING CACHE
+EMBEDDING_CACHE_PATH = "cache/embeddings.sqlite"
+EMBEDDING_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Query embeddings also kept in memory, in front of the on-disk cache
+QUERY_EMBEDDING_MEMO_SIZE = 1024
+
+# EMBEDDING STORAGE FORMAT
+# "array": BSON array of doubles; "binary": raw vector plus int8 copy
+EMBEDDING_STORAGE = os.environ.get("EMBEDDING_STORAGE", "array")
+# "float32" or "float16", used by the binary format
+EMBEDDING_DTYPE = "float32"
+# Number of rows of the coarse int8 pass rescored with the exact vectors
+RESCORE_CANDIDATES = 100
+
+# VECTOR STORE BACKEND: "mongodb" (MongoDB Atlas) or "local" (files on disk)
+VECTOR_STORE = os.environ.get("VECTOR_STORE", "mongodb")
+LOCAL_STORE_DIR = "local_store"
+
+# NUMBER OF DOCUMENTS WRITTEN PER BULK INSERT
+INSERT_BATCH_SIZE = 100
+
+# STREAMING INGESTION
+# Maximum number of pages waiting between two stages
+INGESTION_BUFFER_SIZE = 16
+# Maximum number of pages embedded together while streaming
+INGESTION_EMBED_BATCH_SIZE = 16
+# Pages analyzed together by an extraction worker while streaming
+INGESTION_EXTRACT_RANGE_PAGES = 8
+
+# HYBRID SEARCH (BM25 + VECTORS, FUSED BY RECIPROCAL RANK)
+HYBRID_SEARCH = True
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60
+# Number of results of each ranking taken into account by the fusion
+RRF_DEPTH = 50
+
 REQUIRED_DIRS = [
     "service_knowledge",
     "chatbot_output",
     "tmp",
     "extracted_pages",
+    "vector_indexes",
+    "cache",
+    "local_store",
 ]
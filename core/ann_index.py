@@ -0,0 +1,205 @@
+import os
+import re
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from config.cfg import ANN_KMEANS_ITERATIONS, ANN_N_PROBE
+from config.logger import logger
+from core.embedding_export import index_dir
+from core.scoring import normalize_rows, top_k_pages
+
+
+class IVFIndex:
+    """
+    Inverted-file approximate nearest neighbour index.
+
+    The normalized embeddings are clustered with spherical k-means; a query
+    is only compared with the rows of the `n_probe` closest clusters. Higher
+    `n_probe` values trade latency for recall (`n_probe == n_lists` is an
+    exact search).
+    """
+
+    def __init__(
+        self,
+        matrix: np.ndarray,
+        pages: np.ndarray,
+        ids: Sequence[str],
+        centroids: np.ndarray,
+        assignments: np.ndarray,
+    ):
+        self.matrix = matrix
+        self.pages = pages
+        self.ids = list(ids)
+        self.centroids = centroids
+        self.assignments = assignments
+
+        # Rows of every list, sorted by cluster
+        self.order = np.argsort(assignments, kind="stable")
+        self.offsets = np.searchsorted(
+            assignments[self.order], np.arange(len(centroids) + 1)
+        )
+
+    @classmethod
+    def build(
+        cls,
+        embeddings,
+        pages: Sequence[int],
+        ids: Sequence[str],
+        n_lists: int = None,
+        iterations: int = ANN_KMEANS_ITERATIONS,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        matrix = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        if not n_lists:
+            n_lists = max(1, int(np.sqrt(len(matrix))))
+        n_lists = min(n_lists, len(matrix))
+
+        rng = np.random.default_rng(seed)
+        centroids = matrix[rng.choice(len(matrix), n_lists, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(matrix @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, matrix)
+            empty = ~np.any(sums, axis=1)
+            # Keep the previous centroid for the empty lists
+            sums[empty] = centroids[empty]
+            centroids = normalize_rows(sums)
+        assignments = np.argmax(matrix @ centroids.T, axis=1)
+
+        return cls(
+            matrix=matrix,
+            pages=np.asarray(pages, dtype=np.int64),
+            ids=ids,
+            centroids=centroids,
+            assignments=assignments,
+        )
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    def page_mask(self, pages: np.ndarray = None) -> Optional[np.ndarray]:
+        """
+        Rows belonging to the given pages, or None when no page is given.
+        """
+        if pages is None:
+            return None
+        return np.isin(self.pages, pages)
+
+    def candidates(self, query: np.ndarray, n_probe: int) -> np.ndarray:
+        n_probe = min(n_probe, self.n_lists)
+        lists = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        return np.sort(
+            np.concatenate(
+                [self.order[self.offsets[i] : self.offsets[i + 1]] for i in lists]
+            )
+        )
+
+    def search(
+        self,
+        query_embedding,
+        top_k: int = 5,
+        n_probe: int = ANN_N_PROBE,
+        mask: np.ndarray = None,
+    ) -> List[Dict]:
+        """
+        Returns the best row of the `top_k` best pages as dictionaries with
+        the `_id`, `page` and `score` of the row.
+        """
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / np.linalg.norm(query)
+
+        rows = self.candidates(query, n_probe)
+        if mask is not None:
+            rows = rows[mask[rows]]
+            if len(rows) < top_k:
+                # The probed lists are too sparse for the filter, scan every match
+                rows = np.flatnonzero(mask)
+        if len(rows) == 0:
+            return []
+
+        scores = self.matrix[rows] @ query
+        best = top_k_pages(self.pages[rows], scores, top_k)
+        return [
+            {
+                "_id": self.ids[rows[i]],
+                "page": int(self.pages[rows[i]]),
+                "score": float(scores[i]),
+            }
+            for i in best
+        ]
+
+    def save(self, path: str) -> str:
+        """
+        Saves the matrix apart, to be memory-mapped by the processes loading
+        the index. Every save writes a new matrix file, referenced by the
+        index file replaced atomically, so the processes still mapping the
+        previous matrix keep reading it. The previous matrix files are
+        removed by the caller (see `remove_matrix_files`) once the new
+        version is published. Returns the path of the new matrix file.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        matrix = f"{os.path.splitext(path)[0]}.{time.time_ns():x}.matrix.npy"
+        np.save(matrix, self.matrix)
+        with open(f"{path}.tmp", "wb") as file:
+            np.savez(
+                file,
+                matrix_file=os.path.basename(matrix),
+                pages=self.pages,
+                ids=np.array(self.ids),
+                centroids=self.centroids,
+                assignments=self.assignments,
+            )
+        os.replace(f"{path}.tmp", path)
+        logger.info(f"ANN index with {self.n_lists} lists saved to '{path}'")
+        return matrix
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        try:
+            return cls.read(path)
+        except FileNotFoundError:
+            # Saved again since the index file was read, and the matrix it
+            # referenced removed: the new index file references the new one
+            return cls.read(path)
+
+    @classmethod
+    def read(cls, path: str) -> "IVFIndex":
+        with np.load(path) as data:
+            matrix = np.load(
+                os.path.join(os.path.dirname(path), str(data["matrix_file"])),
+                mmap_mode="r",
+            )
+            return cls(
+                matrix=matrix,
+                pages=data["pages"],
+                ids=data["ids"].tolist(),
+                centroids=data["centroids"],
+                assignments=data["assignments"],
+            )
+
+
+def index_path(collection_name: str) -> str:
+    return os.path.join(index_dir(collection_name), "ann.npz")
+
+
+def remove_matrix_files(path: str, keep: str = None):
+    """
+    Removes the matrix files written by the saves of the index at `path`,
+    except `keep`.
+    """
+    directory, filename = os.path.split(path)
+    if not os.path.isdir(directory):
+        return
+    pattern = re.compile(
+        rf"{re.escape(os.path.splitext(filename)[0])}\.[0-9a-f]+\.matrix\.npy"
+    )
+    for name in os.listdir(directory):
+        matrix = os.path.join(directory, name)
+        if pattern.fullmatch(name) and matrix != keep:
+            os.remove(matrix)
@@ -0,0 +1,231 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+import numpy as np
+
+from config.cfg import (
+    ANSWER_CACHE_MAX_ANSWERS,
+    ANSWER_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_SIMILARITY,
+    ANSWER_CACHE_TTL_SECONDS,
+)
+from config.logger import logger
+from core.history import format_message
+from core.lru import LRUCache
+
+
+class AnswerKey(NamedTuple):
+    """
+    What an answer depends on besides the question. The version of the
+    collection changes when it's ingested again, so the older answers stop
+    matching. `history` is the digest of the conversation before the
+    question (see `history_digest`).
+    """
+
+    collection_name: str
+    version: Optional[str]
+    model: str
+    temperature: float
+    top_p: float
+    max_tokens: int
+    user_type: str
+    top_k: int
+    history: str
+
+
+def history_digest(messages: List[dict]) -> str:
+    """
+    Digest of the messages sent with a question, so that a follow-up only
+    gets the answer given in the same conversation.
+    """
+    rendered = "".join(format_message(message) for message in messages)
+    return hashlib.sha256(rendered.encode("utf-8")).hexdigest()
+
+
+def normalize_question(question: str) -> str:
+    return " ".join(question.lower().split())
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    # Normalized embedding of the question, None for the lexical queries
+    # which are only matched by their text
+    embedding: Optional[np.ndarray]
+    answer: str
+    results: List[Dict]
+    created_at: float
+
+
+class AnswerCache:
+    """
+    Process-wide cache of the streamed answers. A question gets the answer
+    of a cached one with the same key when the cosine similarity of their
+    embeddings reaches `threshold`, so rephrasings and replayed FAQs skip
+    both the retrieval and the chat call. Questions that aren't embedded
+    (identifier lookups answered by BM25 alone) match on their normalized
+    text.
+
+    The answers are grouped by key: the least recently used keys are evicted
+    beyond `max_entries`, and the least recently used answers of a key
+    beyond `max_answers`. The answers expire after `ttl` seconds; they are
+    dropped when their key is next looked up. The answers of older versions
+    of a collection never match, as the version is part of the key.
+    """
+
+    def __init__(
+        self,
+        threshold: float = ANSWER_CACHE_SIMILARITY,
+        ttl: float = ANSWER_CACHE_TTL_SECONDS,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+        max_answers: int = ANSWER_CACHE_MAX_ANSWERS,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_answers = max_answers
+        # Key -> normalized question -> CachedAnswer, least recently used first
+        self.answers = LRUCache(max_entries)
+        # Time of the last invalidation of every collection
+        self.invalidated = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(
+        self, key: AnswerKey, embedding=None, question: str = None
+    ) -> Optional[CachedAnswer]:
+        """
+        The answer of a similar question when `embedding` is given, else of
+        the same `question`.
+        """
+        with self.lock:
+            answers = self.live_answers(key)
+            if embedding is None:
+                match = normalize_question(question)
+                if match not in answers:
+                    match = None
+            else:
+                match = self.most_similar(answers, embedding)
+
+            if match is None:
+                self.misses += 1
+                return None
+            answers.move_to_end(match)
+            self.hits += 1
+            logger.info(f"Answer cache hit: '{match}'")
+            return answers[match]
+
+    def live_answers(self, key: AnswerKey) -> "OrderedDict[str, CachedAnswer]":
+        """
+        The answers of the key, without the expired ones. Called with the
+        lock held.
+        """
+        answers = self.answers.get(key)
+        if answers is None:
+            return OrderedDict()
+        expired_before = time.monotonic() - self.ttl
+        invalidated_at = self.invalidated.get(key.collection_name)
+        for question, entry in list(answers.items()):
+            if entry.created_at < expired_before or (
+                invalidated_at is not None and entry.created_at <= invalidated_at
+            ):
+                del answers[question]
+        return answers
+
+    def most_similar(
+        self, answers: "OrderedDict[str, CachedAnswer]", embedding
+    ) -> Optional[str]:
+        """
+        The embedded question of `answers` most similar to `embedding`, if
+        similar enough.
+        """
+        candidates = [
+            question
+            for question, entry in answers.items()
+            if entry.embedding is not None
+        ]
+        if not candidates:
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / np.linalg.norm(query)
+        scores = np.stack([answers[question].embedding for question in candidates]) @ (
+            query
+        )
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        logger.debug(f"Answer cache similarity: {scores[best]:.3f}")
+        return candidates[best]
+
+    def store(
+        self,
+        key: AnswerKey,
+        embedding,
+        question: str,
+        answer: str,
+        results: List[Dict],
+    ):
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32)
+            embedding = embedding / np.linalg.norm(embedding)
+        with self.lock:
+            answers = self.live_answers(key)
+            if not answers:
+                self.answers.put(key, answers)
+            answers[normalize_question(question)] = CachedAnswer(
+                question=question,
+                embedding=embedding,
+                answer=answer,
+                results=results,
+                created_at=time.monotonic(),
+            )
+            answers.move_to_end(normalize_question(question))
+            while len(answers) > self.max_answers:
+                answers.popitem(last=False)
+
+    def record(
+        self,
+        chunks: Iterable[str],
+        key: AnswerKey,
+        embedding,
+        question: str,
+        results: List[Dict],
+    ) -> Iterator[str]:
+        """
+        Yields the chunks of a fresh answer, storing it once complete. An
+        interrupted stream is not stored.
+        """
+        text = []
+        for chunk in chunks:
+            text.append(chunk)
+            yield chunk
+        self.store(key, embedding, question, "".join(text), results)
+
+    def invalidate(self, collection_name: str):
+        """
+        Drops the answers about a collection, lazily: they no longer match.
+        """
+        with self.lock:
+            self.invalidated[collection_name] = time.monotonic()
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "keys": len(self.answers),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def replay(answer: str) -> Iterator[str]:
+    """
+    Streams a cached answer word by word, like the chat model does.
+    """
+    yield from re.findall(r"\s*\S+\s*", answer) or [answer]
@@ -0,0 +1,171 @@
+import os
+import re
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from config.cfg import BM25_B, BM25_K1
+from config.logger import logger
+from core.embedding_export import index_dir
+from core.scoring import top_k_pages
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9_]+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def is_identifier(term: str) -> bool:
+    """
+    Terms like payload field names ("anchor_id", "param2") that only an exact
+    match can find.
+    """
+    return "_" in term or (
+        any(char.isdigit() for char in term) and any(char.isalpha() for char in term)
+    )
+
+
+class BM25Index:
+    """
+    Okapi BM25 inverted index over the documents of a collection. The posting
+    lists are stored in CSR form: the documents containing the i-th term are
+    `postings[indptr[i]:indptr[i + 1]]`.
+    """
+
+    def __init__(
+        self,
+        terms: Sequence[str],
+        indptr: np.ndarray,
+        postings: np.ndarray,
+        frequencies: np.ndarray,
+        lengths: np.ndarray,
+        pages: np.ndarray,
+        ids: Sequence[str],
+    ):
+        self.terms = {term: i for i, term in enumerate(terms)}
+        self.indptr = indptr
+        self.postings = postings
+        self.frequencies = frequencies
+        self.lengths = lengths
+        self.pages = pages
+        self.ids = list(ids)
+
+        self.avg_length = lengths.mean() if len(lengths) else 0.0
+        document_frequency = np.diff(indptr)
+        self.idf = np.log(
+            1 + (len(lengths) - document_frequency + 0.5) / (document_frequency + 0.5)
+        )
+
+    @classmethod
+    def build(
+        cls, texts: List[str], pages: Sequence[int], ids: Sequence[str]
+    ) -> "BM25Index":
+        postings: Dict[str, Dict[int, int]] = {}
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths[row] = len(tokens)
+            for token in tokens:
+                counts = postings.setdefault(token, {})
+                counts[row] = counts.get(row, 0) + 1
+
+        terms = sorted(postings)
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(postings[term]) for term in terms], out=indptr[1:])
+        return cls(
+            terms=terms,
+            indptr=indptr,
+            postings=np.fromiter(
+                (row for term in terms for row in postings[term]),
+                dtype=np.int32,
+                count=indptr[-1],
+            ),
+            frequencies=np.fromiter(
+                (tf for term in terms for tf in postings[term].values()),
+                dtype=np.float32,
+                count=indptr[-1],
+            ),
+            lengths=lengths,
+            pages=np.asarray(pages, dtype=np.int64),
+            ids=ids,
+        )
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def is_lexical_query(self, terms: List[str]) -> bool:
+        """
+        True when every term is an identifier found in the index, so that the
+        lexical results are enough and the query needs no embedding.
+        """
+        return bool(terms) and all(
+            is_identifier(term) and term in self.terms for term in terms
+        )
+
+    def scores(self, terms: List[str]) -> np.ndarray:
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in set(terms):
+            i = self.terms.get(term)
+            if i is None:
+                continue
+            rows = self.postings[self.indptr[i] : self.indptr[i + 1]]
+            tf = self.frequencies[self.indptr[i] : self.indptr[i + 1]]
+            norm = BM25_K1 * (
+                1 - BM25_B + BM25_B * self.lengths[rows] / self.avg_length
+            )
+            scores[rows] += self.idf[i] * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, terms: List[str], top_k: int = 5) -> List[Dict]:
+        """
+        Returns the best row of the `top_k` best pages containing at least one
+        of the terms.
+        """
+        scores = self.scores(terms)
+        rows = np.flatnonzero(scores > 0)
+        if len(rows) == 0:
+            return []
+        best = top_k_pages(self.pages[rows], scores[rows], top_k)
+        return [
+            {
+                "_id": self.ids[rows[i]],
+                "page": int(self.pages[rows[i]]),
+                "score": float(scores[rows[i]]),
+            }
+            for i in best
+        ]
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Replaced atomically, the processes loading it never see a partial file
+        with open(f"{path}.tmp", "wb") as file:
+            np.savez(
+                file,
+                terms=np.array(sorted(self.terms, key=self.terms.get)),
+                indptr=self.indptr,
+                postings=self.postings,
+                frequencies=self.frequencies,
+                lengths=self.lengths,
+                pages=self.pages,
+                ids=np.array(self.ids),
+            )
+        os.replace(f"{path}.tmp", path)
+        logger.info(f"BM25 index with {len(self.terms)} terms saved to '{path}'")
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with np.load(path) as data:
+            return cls(
+                terms=data["terms"].tolist(),
+                indptr=data["indptr"],
+                postings=data["postings"],
+                frequencies=data["frequencies"],
+                lengths=data["lengths"],
+                pages=data["pages"],
+                ids=data["ids"].tolist(),
+            )
+
+
+def bm25_index_path(collection_name: str) -> str:
+    return os.path.join(index_dir(collection_name), "bm25.npz")
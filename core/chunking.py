@@ -0,0 +1,42 @@
+from typing import List
+
+from config.cfg import CHUNK_OVERLAP_TOKENS, CHUNK_SIZE_TOKENS
+from core.embeddings import get_encoding
+
+
+def chunk_text(
+    text: str,
+    chunk_size: int = CHUNK_SIZE_TOKENS,
+    overlap: int = CHUNK_OVERLAP_TOKENS,
+) -> List[dict]:
+    """
+    Splits the text in windows of `chunk_size` tokens, consecutive windows
+    sharing `overlap` tokens. Every chunk carries its char offsets in the
+    text. A chunk size of 0 keeps the text whole.
+    """
+    tokens = get_encoding().encode(text, disallowed_special=())
+    if chunk_size <= 0 or len(tokens) <= chunk_size:
+        return [{"chunk": 0, "start": 0, "end": len(text), "text": text}]
+
+    _, offsets = get_encoding().decode_with_offsets(tokens)
+    offsets.append(len(text))
+
+    chunks = []
+    step = max(chunk_size - overlap, 1)
+    for start in range(0, len(tokens), step):
+        stop = min(start + chunk_size, len(tokens))
+        begin, end = offsets[start], offsets[stop]
+        chunks.append(
+            {"chunk": len(chunks), "start": begin, "end": end, "text": text[begin:end]}
+        )
+        if stop == len(tokens):
+            break
+    return chunks
+
+
+def chunk_page(page: int, text: str, **document) -> List[dict]:
+    """
+    Returns the chunk documents of a page, each one carrying the page number
+    and the other given fields.
+    """
+    return [{"page": page, **chunk, **document} for chunk in chunk_text(text)]
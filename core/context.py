@@ -0,0 +1,121 @@
+import re
+from typing import Dict, Iterable, List, Set
+
+from config.cfg import (
+    CONTEXT_DUPLICATE_THRESHOLD,
+    CONTEXT_MAX_SENTENCES,
+    MAX_PROMPT_TOKENS,
+    PROMPT_TOKEN_BUDGETS,
+)
+from core.history import get_model_encoding
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?;:])\s+|\s*\n\s*")
+WORD = re.compile(r"\w+")
+# Average length of a token of the OpenAI tokenizers, for the estimates
+CHARS_PER_TOKEN = 4
+
+
+def prompt_budget(model: str) -> int:
+    return PROMPT_TOKEN_BUDGETS.get(model, MAX_PROMPT_TOKENS)
+
+
+def count_text_tokens(text: str, model: str) -> int:
+    return len(get_model_encoding(model).encode(text, disallowed_special=()))
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Token count estimated from the length of the text, without tokenizing it.
+    """
+    return len(text) // CHARS_PER_TOKEN
+
+
+def count_payload_tokens(payload: dict, model: str) -> int:
+    return sum(
+        count_text_tokens(message["content"], model) for message in payload["messages"]
+    )
+
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence for sentence in SENTENCE_BOUNDARY.split(text) if sentence]
+
+
+def shingles(text: str, size: int = 3) -> Set[tuple]:
+    words = WORD.findall(text.lower())
+    if len(words) < size:
+        return {tuple(words)}
+    return {tuple(words[i : i + size]) for i in range(len(words) - size + 1)}
+
+
+def is_near_duplicate(candidate: Set[tuple], kept: Iterable[Set[tuple]]) -> bool:
+    """
+    True when the shingles of a passage mostly overlap the ones of a passage
+    already kept (Jaccard similarity).
+    """
+    for other in kept:
+        union = len(candidate | other)
+        if union and len(candidate & other) / union >= CONTEXT_DUPLICATE_THRESHOLD:
+            return True
+    return False
+
+
+def relevant_sentences(
+    text: str, query_terms: Set[str], max_sentences: int = CONTEXT_MAX_SENTENCES
+) -> List[str]:
+    """
+    The sentences of a passage sharing the most terms with the query, in
+    their original order. Ties go to the earlier sentences, so a passage
+    with no term of the query keeps its beginning.
+    """
+    sentences = split_sentences(text)
+    if len(sentences) <= max_sentences:
+        return sentences
+    scores = [
+        len(query_terms.intersection(WORD.findall(sentence.lower())))
+        for sentence in sentences
+    ]
+    best = sorted(range(len(sentences)), key=lambda i: (-scores[i], i))
+    return [sentences[i] for i in sorted(best[:max_sentences])]
+
+
+def format_passage(page: int, sentences: List[str]) -> str:
+    return f"[Page {page}]\n" + " ".join(sentences)
+
+
+def assemble_context(
+    results: List[Dict], query_terms: Set[str], model: str, max_tokens: int
+) -> str:
+    """
+    Builds the context of the prompt from the search results, in ranking
+    order: near-duplicate passages are dropped, every passage is trimmed to
+    its sentences most relevant to the query, and the passages are packed
+    until `max_tokens` tokens of the model are used. The last passage that
+    doesn't fit whole keeps its sentences that fit.
+    """
+    query_terms = {term.lower() for term in query_terms}
+    passages = []
+    kept_shingles = []
+    used = 0
+    for result in results:
+        if used >= max_tokens:
+            break
+        text = result.get("text") or ""
+        passage_shingles = shingles(text)
+        if not text.strip() or is_near_duplicate(passage_shingles, kept_shingles):
+            continue
+
+        sentences = relevant_sentences(text, query_terms)
+        passage = format_passage(result["page"], sentences)
+        # The separator between the passages is counted with them
+        tokens = count_text_tokens(passage + "\n\n", model)
+        while tokens > max_tokens - used and len(sentences) > 1:
+            sentences = sentences[:-1]
+            passage = format_passage(result["page"], sentences)
+            tokens = count_text_tokens(passage + "\n\n", model)
+        if tokens > max_tokens - used:
+            break
+
+        passages.append(passage)
+        kept_shingles.append(passage_shingles)
+        used += tokens
+    return "\n\n".join(passages)
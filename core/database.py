@@ -1,33 +1,47 @@
+import copy
 import os
-import unicodedata
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
+from bson import ObjectId
 from dotenv import load_dotenv
-from langchain_openai import OpenAIEmbeddings
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 
+from config.cfg import INSERT_BATCH_SIZE, RESCORE_CANDIDATES
 from config.logger import logger
+from core.embedding_export import EmbeddingExport, export_dir, read_version
+from core.quantization import decode_embedding, embedding_fields
+from core.scoring import EmbeddingMatrix, QuantizedMatrix
+from core.vector_store import IndexedStore, remove_indexes
 
 load_dotenv()
 
+# Fields read by the coarse int8 pass and by the exact scoring
+COARSE_PROJECTION = {"page": 1, "embedding_i8": 1}
+FULL_PROJECTION = {"page": 1, "embedding": 1, "embedding_dtype": 1}
 
-class MongoDb:
+
+class MongoDb(IndexedStore):
     def __init__(
         self,
         uri: str = os.environ.get("MONGODB_ATLAS_CLUSTER_URI"),
         database_name: str = "mydatabase",
         collection_name: str = "mycollection",
         recreate_collection: bool = False,
+        embedding_model=None,
     ):
+        super().__init__(embedding_model)
 
         self.uri = uri
         if not self.uri:
             raise ValueError("MongoDB URI is not set in environment variables")
 
         self.client = MongoClient(self.uri, server_api=ServerApi("1"))
-        self.embedding_model = OpenAIEmbeddings()
+        # Memory-mapped snapshots of the collections, by name
+        self.exports = {}
 
         # self.ping()
 
@@ -36,6 +50,8 @@ class MongoDb:
         if recreate_collection:
             if collection_name in self.database_name.list_collection_names():
                 self.client[database_name].drop_collection(collection_name)
+            # The indexes of the dropped collection are stale
+            remove_indexes(collection_name)
 
         self.collection = self.database_name[collection_name]
         logger.info(f"Connected to the collection '{collection_name}'")
@@ -57,145 +73,257 @@ class MongoDb:
         logger.info(f"Collection '{collection_name}' does not exist")
         return False
 
-    def change_collection(self, collection_name: str):
-        self.collection = self.database_name[collection_name]
-        logger.info(f"Changed to collection '{collection_name}'")
-
-    def __getattr__(self, name):
+    def for_collection(self, collection_name: str) -> "MongoDb":
         """
-        Intercepts attribute access and delegates it to the MongoDB collection instance.
+        Handle on a collection sharing the client pool, the embedding model
+        and the loaded indexes of this store.
         """
-        if hasattr(self.collection, name):
-            return getattr(self.collection, name)
-        raise AttributeError(
-            f"'{self.__class__.__name__}' object has no attribute '{name}'"
-        )
-
-    def query_with_keyword_filter(
-        self, query_text: str, top_k: int = 5, keyword_filter: List[str] = None
-    ):
-        try:
-            # Generate query embedding
-            query_embedding = self.embedding_model.embed_query(query_text.lower())
-
-            # Cosine similarity function
-            def cosine_similarity(vec1, vec2):
-                return np.dot(vec1, vec2) / (
-                    np.linalg.norm(vec1) * np.linalg.norm(vec2)
-                )
+        handle = copy.copy(self)
+        handle.collection = self.database_name[collection_name]
+        return handle
 
-            # Get unique pages and their best matching segments
-            page_scores = {}  # Dictionary to store best score per page
+    @property
+    def collection_name(self) -> str:
+        return self.collection.name
 
-            # Get all documents
-            all_documents = list(self.collection.find({}))
-
-            # Apply keyword filter if provided
-            if keyword_filter:
-                filtered_documents = [
-                    doc
-                    for doc in all_documents
-                    if any(
-                        kw.lower() in doc.get("keywords", []) for kw in keyword_filter
-                    )
-                ]
-                documents_to_process = (
-                    filtered_documents if filtered_documents else all_documents
-                )
-            else:
-                documents_to_process = all_documents
+    def exact_search(
+        self,
+        query_embedding: List[float],
+        top_k: int,
+        candidates: Optional[np.ndarray],
+        keyword_filter: Optional[List[str]],
+    ) -> List[Dict]:
+        # The export is scanned in float32 in place; the int8 coarse pass of
+        # `rescore` is the fallback on the database, used before the first
+        # export and to filter on the keywords stored in the documents
+        export = self.get_export()
+        if export is not None and not keyword_filter:
+            return export.search(query_embedding, top_k, candidates)
+
+        query_filter = None
+        if candidates is not None:
+            query_filter = {"page": {"$in": candidates.tolist()}}
+        elif keyword_filter:
+            # No keyword index yet: filter on the multikey index
+            query_filter = {"keywords": {"$in": [kw.lower() for kw in keyword_filter]}}
+
+        # Only the fields needed for the coarse pass are transferred
+        documents = []
+        if query_filter is not None:
+            documents = list(self.collection.find(query_filter, COARSE_PROJECTION))
+
+        # Fall back to all the documents when the filter matches nothing
+        if not documents:
+            query_filter = {}
+            documents = list(self.collection.find(query_filter, COARSE_PROJECTION))
+
+        return self.rescore(documents, query_filter, query_embedding, top_k)
+
+    def get_export(self) -> Optional[EmbeddingExport]:
+        """
+        Maps the snapshot of the current version of the collection, if any.
+        """
+        name = self.collection_name
+        version = read_version(name)
+        if name in self.exports and self.exports[name][0] == version:
+            return self.exports[name][1]
+        with self.load_lock:
+            if name not in self.exports or self.exports[name][0] != version:
+                export = None
+                if version is not None:
+                    try:
+                        export = EmbeddingExport(export_dir(name, version))
+                    except FileNotFoundError:
+                        # Replaced by a newer version meanwhile
+                        pass
+                self.exports[name] = (version, export)
+            return self.exports[name][1]
+
+    def export(self, version: str):
+        documents = list(self.collection.find({}, {**FULL_PROJECTION, "text": 1}))
+        EmbeddingExport.write(
+            export_dir(self.collection_name, version),
+            embeddings=(
+                np.stack([decode_embedding(doc) for doc in documents])
+                if documents
+                else np.empty((0, 0), np.float32)
+            ),
+            pages=[doc["page"] for doc in documents],
+            ids=[str(doc["_id"]) for doc in documents],
+            texts=[doc["text"] for doc in documents],
+        )
 
-            # Process each document
-            for doc in documents_to_process:
-                page = doc["page"]
-                score = cosine_similarity(query_embedding, np.array(doc["embedding"]))
+    def rescore(
+        self,
+        documents: List[Dict],
+        query_filter: Dict,
+        query_embedding: List[float],
+        top_k: int,
+    ) -> List[Dict]:
+        """
+        Scores the int8 quantized embeddings of the documents, then rescores
+        the best ones with their exact embeddings. Documents stored before
+        the quantization (see `migrate_embeddings`) are always rescored.
+        """
+        quantized = [doc for doc in documents if "embedding_i8" in doc]
+        if not quantized:
+            rescored = list(self.collection.find(query_filter, FULL_PROJECTION))
+        else:
+            ids = QuantizedMatrix.from_documents(quantized).candidates(
+                query_embedding, max(RESCORE_CANDIDATES, top_k * 4)
+            )
+            ids += [doc["_id"] for doc in documents if "embedding_i8" not in doc]
+            rescored = list(
+                self.collection.find({"_id": {"$in": ids}}, FULL_PROJECTION)
+            )
 
-                # Update page_scores if this is a better match for the page
-                if page not in page_scores or score > page_scores[page]["score"]:
-                    page_scores[page] = {"text": doc["text"], "score": score}
+        # Score all the documents at once and keep the best segment per page
+        matrix = EmbeddingMatrix.from_documents(rescored)
+        return matrix.search(query_embedding, top_k=top_k)
 
-            # Convert to list and sort by score
-            results = [
-                {"page": page, "text": data["text"], "score": data["score"]}
-                for page, data in page_scores.items()
-            ]
+    def fetch_texts(self, hits: List[Dict]) -> List[Dict]:
+        """
+        Fetches the text of the winning segments only, keeping the order of
+        the hits. The indexes on disk store the ids as strings.
+        """
+        export = self.get_export()
+        if export is not None:
+            texts = export.fetch_texts(hits)
+            if texts is not None:
+                return texts
+
+        ids = [ObjectId(hit["_id"]) for hit in hits]
+        texts = {
+            doc["_id"]: doc["text"]
+            for doc in self.collection.find({"_id": {"$in": ids}}, {"text": 1})
+        }
+        return [
+            {
+                "page": hit["page"],
+                "text": texts.get(_id, ""),
+                "score": hit["score"],
+            }
+            for _id, hit in zip(ids, hits)
+        ]
+
+    def load_embeddings(self) -> Tuple[np.ndarray, List[int], List[str]]:
+        documents = list(self.collection.find({}, FULL_PROJECTION))
+        embeddings = [decode_embedding(doc) for doc in documents]
+        return (
+            np.stack(embeddings) if embeddings else np.empty((0, 0), np.float32),
+            [doc["page"] for doc in documents],
+            [str(doc["_id"]) for doc in documents],
+        )
 
-            # Sort by score and get top_k
-            results.sort(key=lambda x: x["score"], reverse=True)
-            return results[:top_k]
+    def load_texts(self) -> Tuple[List[str], List[int], List[str]]:
+        documents = list(self.collection.find({}, {"page": 1, "text": 1}))
+        return (
+            [doc["text"] for doc in documents],
+            [doc["page"] for doc in documents],
+            [str(doc["_id"]) for doc in documents],
+        )
 
-        except Exception as e:
-            print(f"Errore durante l'esecuzione della query: {e}")
-            return []
+    def create_indexes(self):
+        # Multikey index used by the keyword prefilter of the queries
+        self.collection.create_index("keywords")
+        # Used to fetch the candidate pages of the keyword index
+        self.collection.create_index("page")
 
-    def process_and_store_pages(self, path: str, keywords: Dict[int, List[str]]):
+    def insert_in_batches(
+        self, documents: List[Dict], batch_size: int = INSERT_BATCH_SIZE
+    ):
+        """
+        Inserts the documents with ordered bulk writes. A document that fails
+        is logged and skipped, the rest of its batch is inserted anyway.
         """
-        Process and store pages in the MongoDB database with their embeddings and keywords.
+        for start in range(0, len(documents), batch_size):
+            batch = documents[start : start + batch_size]
+            while batch:
+                try:
+                    self.collection.insert_many(batch, ordered=True)
+                    inserted, batch = batch, []
+                except BulkWriteError as e:
+                    # Ordered writes stop at the first failing document
+                    error = e.details["writeErrors"][0]
+                    failed = batch[error["index"]]
+                    logger.error(
+                        f"Error processing {failed['filename']} "
+                        f"(Page {failed['page']}): {error.get('errmsg')}"
+                    )
+                    inserted = batch[: error["index"]]
+                    batch = batch[error["index"] + 1 :]
+                except Exception as e:
+                    # e.g. DocumentTooLarge, raised while the batch is encoded
+                    logger.warning(
+                        f"Error inserting pages {batch[0]['page']}-{batch[-1]['page']}, "
+                        f"retrying one by one: {e}"
+                    )
+                    inserted, batch = self.insert_one_by_one(batch), []
+                for doc in inserted:
+                    logger.info(f"Processed: {doc['filename']} (Page {doc['page']})")
 
-        Args:
-            service_dir (str): Directory where the files are located.
-            keywords (Dict[int, List[str]]): Dictionary mapping page numbers to keywords.
-            db: MongoDB collection instance for storing documents.
-            embedding_model: Model instance for generating embeddings.
+    def insert_one_by_one(self, documents: List[Dict]) -> List[Dict]:
         """
-        service_dir = (
-            path.split("/")[-1]
-            .split(".pdf")[0]
-            .lower()
-            .replace("/", "_")
-            .replace("\\", "_")
-        )
-        for x, filename in enumerate(
-            sort_files(os.listdir(f"extracted_pages/{service_dir}"))
-        ):
+        Inserts the documents of a failed batch separately, so that a bad
+        document only loses itself. Returns the inserted documents.
+        """
+        inserted = []
+        for doc in documents:
             try:
-                # Open and read the file content
-                with open(
-                    f"extracted_pages/{service_dir}/{filename}", "r", encoding="utf-8"
-                ) as file:
-                    data = file.read()
-
-                # Clean the text
-                cleaned_data = clean_text(data)
-
-                # Extract keywords for the current page
-                page_keywords = sorted(keywords.get(x, []))
-
-                # Generate embedding for the document
-                embedding = self.embedding_model.embed_documents([cleaned_data])[0]
-
-                # Insert document into the database
-                self.insert_one(
-                    {
-                        "page": x,
-                        "text": cleaned_data,
-                        "embedding": embedding,
-                        "keywords": page_keywords,
-                        "filename": f"extracted_pages/{service_dir}/{filename}",
-                    }
-                )
-
-                logger.info(f"Processed: {filename} (Page {x})")
+                self.collection.insert_one(doc)
+            except DuplicateKeyError:
+                # Already inserted by the batch before it failed
+                pass
             except Exception as e:
-                logger.error(f"Error processing {filename} (Page {x}): {e}")
-
-
-# Order files by page number
-def sort_files(files: List[str]) -> List[str]:
-    def extract_page_number(filename):
-        return int(filename.replace("page_", "").replace(".txt", ""))
-
-    return sorted(files, key=extract_page_number)
+                logger.error(
+                    f"Error processing {doc['filename']} (Page {doc['page']}): {e}"
+                )
+                continue
+            inserted.append(doc)
+        return inserted
 
+    def migrate_embeddings(
+        self, storage: str = "binary", batch_size: int = INSERT_BATCH_SIZE
+    ) -> int:
+        """
+        Rewrites the embeddings stored as arrays of doubles in the binary
+        format with the int8 copy. The queries read both formats meanwhile.
+        """
+        migrated = 0
+        requests = []
+        for doc in self.collection.find(
+            {"embedding_i8": {"$exists": False}}, FULL_PROJECTION
+        ):
+            fields = embedding_fields(decode_embedding(doc).tolist(), storage=storage)
+            requests.append(UpdateOne({"_id": doc["_id"]}, {"$set": fields}))
+            if len(requests) == batch_size:
+                migrated += self.collection.bulk_write(requests).modified_count
+                requests = []
+        if requests:
+            migrated += self.collection.bulk_write(requests).modified_count
+
+        logger.info(f"Migrated {migrated} embeddings of '{self.collection.name}'")
+        # A new version, so every process drops the results and the export
+        # of the previous one
+        self.build_indexes(self.stored_keywords())
+        return migrated
+
+    def stored_keywords(self) -> Dict[int, List[str]]:
+        """
+        Keywords of the pages, as set on their documents by `update_keywords`.
+        """
+        keywords = {}
+        for doc in self.collection.find({}, {"page": 1, "keywords": 1}):
+            keywords.setdefault(doc["page"], set()).update(doc.get("keywords", []))
+        return {page: sorted(page_keywords) for page, page_keywords in keywords.items()}
 
-def clean_text(text):
-    """
-    Rimuove i caratteri speciali e normalizza il testo.
-    """
-    # Remove non-printable characters
-    text = "".join(char for char in text if char.isprintable())
-    # Normalize text
-    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("utf-8")
-    # Remove extra whitespaces
-    text = " ".join(text.split())
-    return text
+    def update_keywords(self, keywords: Dict[int, List[str]]):
+        """
+        Sets the keywords of the pages already stored in the collection.
+        """
+        requests = [
+            UpdateMany({"page": page}, {"$set": {"keywords": sorted(page_keywords)}})
+            for page, page_keywords in keywords.items()
+        ]
+        if requests:
+            self.collection.bulk_write(requests, ordered=False)
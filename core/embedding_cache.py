@@ -0,0 +1,219 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config.cfg import (
+    EMBEDDING_CACHE_MAX_BYTES,
+    EMBEDDING_CACHE_PATH,
+    QUERY_EMBEDDING_MEMO_SIZE,
+)
+from config.logger import logger
+from core.lru import LRUCache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    key TEXT PRIMARY KEY,
+    vector BLOB NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access);
+"""
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of embeddings keyed by a hash of the model name and of the
+    text. When the stored vectors exceed `max_bytes` the least recently used
+    ones are evicted.
+    """
+
+    def __init__(
+        self,
+        path: str = EMBEDDING_CACHE_PATH,
+        max_bytes: int = EMBEDDING_CACHE_MAX_BYTES,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        # Bytes of the stored vectors, kept up to date by the writes
+        self.total_bytes = self.size()
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self.lock:
+            # Bounded number of SQL variables per statement
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+                found.update(
+                    {key: np.frombuffer(vector).tolist() for key, vector in rows}
+                )
+            if found:
+                now = time.time()
+                self.connection.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self.connection.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]):
+        now = time.time()
+        rows = [
+            (key, np.asarray(vector, dtype=np.float64).tobytes(), now)
+            for key, vector in items.items()
+        ]
+        with self.lock:
+            # The replaced vectors no longer count
+            replaced = 0
+            keys = list(items)
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                replaced += self.connection.execute(
+                    "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings "
+                    f"WHERE key IN ({placeholders})",
+                    chunk,
+                ).fetchone()[0]
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows
+            )
+            self.connection.commit()
+            self.total_bytes += sum(len(row[1]) for row in rows) - replaced
+            self.evict()
+
+    def size(self) -> int:
+        return self.connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()[0]
+
+    def evict(self):
+        """
+        Called with the lock held.
+        """
+        excess = self.total_bytes - self.max_bytes
+        if excess <= 0:
+            return
+        # Delete the least recently used vectors until the excess is freed
+        freed = 0
+        keys = []
+        for key, length in self.connection.execute(
+            "SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_access"
+        ):
+            keys.append((key,))
+            freed += length
+            if freed >= excess:
+                break
+        self.connection.executemany("DELETE FROM embeddings WHERE key = ?", keys)
+        self.connection.commit()
+        self.total_bytes -= freed
+        logger.info(f"Evicted {len(keys)} embeddings from the cache")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class CachedEmbeddings:
+    """
+    Wraps an embedding model so that only the texts missing from the cache
+    are sent to it. The query embeddings are also kept in memory, so the
+    repeated questions touch neither the model nor the disk.
+    """
+
+    def __init__(
+        self,
+        embedding_model,
+        cache: Optional[EmbeddingCache] = None,
+        memo_size: int = QUERY_EMBEDDING_MEMO_SIZE,
+    ):
+        self.embedding_model = embedding_model
+        self.cache = cache if cache is not None else EmbeddingCache()
+        self.model = getattr(embedding_model, "model", type(embedding_model).__name__)
+        # Query embeddings by cache key, in front of the on-disk cache
+        self.memo = LRUCache(memo_size)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [EmbeddingCache.key(self.model, text) for text in texts]
+        found = self.cache.get_many(list(set(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing[key] = text
+        if missing:
+            vectors = self.embedding_model.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(computed)
+            found.update(computed)
+
+        return [found[key] for key in keys]
+
+    def query_key(self, text: str) -> Tuple[str, str]:
+        """
+        The query with its whitespace normalized, and its cache key.
+        """
+        text = " ".join(text.split())
+        return text, EmbeddingCache.key(self.model, text)
+
+    def recall(self, key: str) -> Optional[List[float]]:
+        """
+        Reads a query embedding from the on-disk cache into memory.
+        """
+        vector = self.cache.get_many([key]).get(key)
+        if vector is not None:
+            self.memo.put(key, vector)
+        return vector
+
+    def remember(self, key: str, vector: List[float]):
+        self.cache.put_many({key: vector})
+        self.memo.put(key, vector)
+
+    def embed_query(self, text: str) -> List[float]:
+        text, key = self.query_key(text)
+        vector = self.memo.get(key)
+        if vector is None:
+            vector = self.recall(key)
+        if vector is None:
+            vector = self.embedding_model.embed_query(text)
+            self.remember(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        text, key = self.query_key(text)
+        vector = self.memo.get(key)
+        # SQLite blocks, so the disk accesses run in a worker thread and the
+        # event loop keeps serving the other sessions
+        if vector is None:
+            vector = await asyncio.to_thread(self.recall, key)
+        if vector is None:
+            vector = await self.embedding_model.aembed_query(text)
+            await asyncio.to_thread(self.remember, key, vector)
+        return vector
@@ -0,0 +1,170 @@
+import os
+import shutil
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from config.cfg import ANN_INDEX_DIR
+from config.logger import logger
+from core.page_store import PageStore
+from core.scoring import normalize_rows, top_k_pages
+
+
+def index_dir(collection_name: str) -> str:
+    """
+    Directory of the indexes, version and exports of a collection. Every
+    collection has its own, so no file name can match another collection.
+    """
+    return os.path.join(ANN_INDEX_DIR, collection_name)
+
+
+def version_path(collection_name: str) -> str:
+    return os.path.join(index_dir(collection_name), "version")
+
+
+def export_root(collection_name: str) -> str:
+    return os.path.join(index_dir(collection_name), "export")
+
+
+def export_dir(collection_name: str, version: str) -> str:
+    return os.path.join(export_root(collection_name), version)
+
+
+def new_version() -> str:
+    return f"{time.time_ns():x}"
+
+
+def read_version(collection_name: str) -> Optional[str]:
+    """
+    Version stamp of the indexes of a collection, None before its first
+    ingestion.
+    """
+    try:
+        with open(version_path(collection_name)) as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def publish_version(collection_name: str, version: str):
+    """
+    Makes `version` the current one for every process, then removes the
+    older exports. The processes still mapping them keep their pages, as the
+    files are only unlinked.
+    """
+    path = version_path(collection_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as file:
+        file.write(version)
+    os.replace(f"{path}.tmp", path)
+
+    root = export_root(collection_name)
+    if os.path.isdir(root):
+        for old in os.listdir(root):
+            if old != version:
+                shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+    logger.info(f"Collection '{collection_name}' is at version {version}")
+
+
+class EmbeddingExport:
+    """
+    Read-only snapshot of the documents of a collection: the normalized
+    embedding matrix, the pages, the ids and the texts, stored as flat files
+    memory-mapped by every process. The pages of the files are shared
+    through the page cache, so the memory of a process does not grow with
+    the collection, and the queries do not touch the database.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.matrix = np.load(os.path.join(directory, "matrix.npy"), mmap_mode="r")
+        self.pages = np.load(os.path.join(directory, "pages.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(directory, "ids.npy"), mmap_mode="r")
+        # Ids sorted for the lookups by binary search, with their rows
+        self.sorted_ids = np.load(
+            os.path.join(directory, "sorted_ids.npy"), mmap_mode="r"
+        )
+        self.sorted_rows = np.load(
+            os.path.join(directory, "sorted_rows.npy"), mmap_mode="r"
+        )
+        self.texts = PageStore(os.path.join(directory, "texts.pages"))
+
+    @staticmethod
+    def write(
+        directory: str,
+        embeddings: np.ndarray,
+        pages: Sequence[int],
+        ids: Sequence[str],
+        texts: List[str],
+    ):
+        os.makedirs(directory, exist_ok=True)
+        ids = np.array(ids, dtype=str)
+        order = np.argsort(ids, kind="stable")
+        np.save(
+            os.path.join(directory, "matrix.npy"),
+            normalize_rows(np.asarray(embeddings, dtype=np.float32)),
+        )
+        np.save(os.path.join(directory, "pages.npy"), np.asarray(pages, np.int64))
+        np.save(os.path.join(directory, "ids.npy"), ids)
+        np.save(os.path.join(directory, "sorted_ids.npy"), ids[order])
+        np.save(os.path.join(directory, "sorted_rows.npy"), order)
+        PageStore.write(os.path.join(directory, "texts.pages"), texts)
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def rows(self, ids: Sequence[str]) -> np.ndarray:
+        """
+        Rows of the ids, -1 for the ids missing from the snapshot.
+        """
+        if len(self.sorted_ids) == 0:
+            return np.full(len(ids), -1)
+        ids = np.array([str(_id) for _id in ids], dtype=self.sorted_ids.dtype)
+        positions = np.searchsorted(self.sorted_ids, ids)
+        positions = np.minimum(positions, len(self.sorted_ids) - 1)
+        found = self.sorted_ids[positions] == ids
+        return np.where(found, self.sorted_rows[positions], -1)
+
+    def search(
+        self, query_embedding, top_k: int, candidates: np.ndarray = None
+    ) -> List[Dict]:
+        """
+        Exact search over the rows of the candidate pages (all of them when
+        None or when no row matches).
+        """
+        if len(self) == 0 or top_k <= 0:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / np.linalg.norm(query)
+
+        rows = None
+        if candidates is not None:
+            rows = np.flatnonzero(np.isin(self.pages, candidates))
+        if rows is None or len(rows) == 0:
+            # Scanning the mapped matrix in place avoids copying it
+            rows = np.arange(len(self))
+            scores = self.matrix @ query
+        else:
+            scores = self.matrix[rows] @ query
+        best = top_k_pages(self.pages[rows], scores, top_k)
+        return [
+            {
+                "_id": str(self.ids[rows[i]]),
+                "page": int(self.pages[rows[i]]),
+                "score": float(scores[i]),
+            }
+            for i in best
+        ]
+
+    def fetch_texts(self, hits: List[Dict]) -> Optional[List[Dict]]:
+        """
+        Texts of the hits, or None when one of them is not in the snapshot.
+        """
+        rows = self.rows([hit["_id"] for hit in hits]) if hits else []
+        if any(row < 0 for row in rows):
+            return None
+        return [
+            {"page": hit["page"], "text": self.texts[int(row)], "score": hit["score"]}
+            for row, hit in zip(rows, hits)
+        ]
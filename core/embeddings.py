@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Optional
+
+import tiktoken
+
+from config.cfg import (
+    EMBEDDING_BATCH_MAX_SIZE,
+    EMBEDDING_BATCH_MAX_TOKENS,
+    EMBEDDING_MAX_CONCURRENCY,
+    EMBEDDING_MAX_TOKENS,
+)
+from config.logger import logger
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str = "cl100k_base"):
+    # Loaded on first use, as tiktoken may need to download it
+    return tiktoken.get_encoding(name)
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+
+def batch_by_tokens(
+    texts: List[str],
+    max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+    max_size: int = EMBEDDING_BATCH_MAX_SIZE,
+) -> List[List[int]]:
+    """
+    Groups the indexes of the texts in batches that respect both the token
+    budget and the maximum number of inputs of an embedding request.
+    """
+    batches = []
+    current, current_tokens = [], 0
+    for i, text in enumerate(texts):
+        # A single input is truncated by the model to its context length
+        tokens = min(count_tokens(text), EMBEDDING_MAX_TOKENS)
+        if current and (
+            current_tokens + tokens > max_tokens or len(current) >= max_size
+        ):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def embed_in_batches(
+    embedding_model,
+    texts: List[str],
+    max_concurrency: int = EMBEDDING_MAX_CONCURRENCY,
+) -> List[Optional[List[float]]]:
+    """
+    Embeds the texts with token-aware batches sent concurrently.
+
+    When a batch fails its texts are embedded one by one, so that a single bad
+    input only loses its own embedding: the position of a text that could not
+    be embedded is None.
+    """
+    embeddings = [None] * len(texts)
+
+    def embed_batch(batch: List[int]):
+        try:
+            vectors = embedding_model.embed_documents([texts[i] for i in batch])
+            for i, vector in zip(batch, vectors):
+                embeddings[i] = vector
+        except Exception as e:
+            logger.warning(
+                f"Batch of {len(batch)} texts failed, retrying one by one: {e}"
+            )
+            for i in batch:
+                try:
+                    embeddings[i] = embedding_model.embed_documents([texts[i]])[0]
+                except Exception as e:
+                    logger.error(f"Error embedding text {i}: {e}")
+
+    batches = batch_by_tokens(texts)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        list(executor.map(embed_batch, batches))
+    logger.info(f"Embedded {len(texts)} texts in {len(batches)} batches")
+    return embeddings
@@ -0,0 +1,121 @@
+from collections import deque
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import tiktoken
+
+from config.cfg import HISTORY_TOKEN_BUDGETS, MAX_HISTORY_TOKENS
+
+
+@lru_cache(maxsize=None)
+def get_model_encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Unknown models are counted with the tokenizer of the GPT-4 family
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def history_budget(model: str) -> int:
+    return HISTORY_TOKEN_BUDGETS.get(model, MAX_HISTORY_TOKENS)
+
+
+def format_message(message: dict) -> str:
+    """
+    A message as it's written in the history of the prompt.
+    """
+    return message.get("role", "").upper() + ": " + message.get("content", "") + "\n"
+
+
+def count_message_tokens(message: dict, model: str) -> int:
+    return len(
+        get_model_encoding(model).encode(format_message(message), disallowed_special=())
+    )
+
+
+@dataclass
+class HistoryEntry:
+    role: str
+    content: str
+    # Tokens of the formatted message, by encoding
+    tokens: Dict[str, int] = field(default_factory=dict)
+
+    def as_message(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+    def count(self, model: str) -> int:
+        name = get_model_encoding(model).name
+        if name not in self.tokens:
+            self.tokens[name] = count_message_tokens(self.as_message(), model)
+        return self.tokens[name]
+
+
+class ConversationHistory:
+    """
+    History of a conversation as sent to the chat model. Every message is
+    tokenized once, when it's appended, with the tokenizer of the model, and
+    the messages falling out of the largest budget are dropped from the left,
+    so the history never grows with the length of the session.
+    """
+
+    def __init__(self, max_tokens: Optional[int] = None):
+        self.max_tokens = max_tokens or max(
+            [MAX_HISTORY_TOKENS, *HISTORY_TOKEN_BUDGETS.values()]
+        )
+        self.entries = deque()
+        # Tokens of the entries with the encoding of the last appended message
+        self.encoding_name = None
+        self.total = 0
+
+    @classmethod
+    def from_messages(cls, messages: List[dict], model: str) -> "ConversationHistory":
+        history = cls()
+        for message in messages:
+            history.append(message["role"], message["content"], model)
+        return history
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def append(self, role: str, content: str, model: str):
+        entry = HistoryEntry(role, content)
+        self.entries.append(entry)
+
+        name = get_model_encoding(model).name
+        if name != self.encoding_name:
+            # The model changed: the counts are recomputed once
+            self.encoding_name = name
+            self.total = sum(entry.count(model) for entry in self.entries)
+        else:
+            self.total += entry.count(model)
+
+        # The oldest message can't fit once the newer ones fill the budget
+        while (
+            len(self.entries) > 1
+            and self.total - self.entries[0].tokens[name] >= self.max_tokens
+        ):
+            self.total -= self.entries.popleft().tokens[name]
+
+    def window(self, model: str, max_tokens: Optional[int] = None) -> List[dict]:
+        """
+        Most recent messages fitting the token budget of the model, oldest
+        first.
+        """
+        if max_tokens is None:
+            max_tokens = history_budget(model)
+        messages = []
+        used = 0
+        for entry in reversed(self.entries):
+            tokens = entry.count(model)
+            if used + tokens > max_tokens:
+                break
+            messages.append(entry.as_message())
+            used += tokens
+        messages.reverse()
+        return messages
+
+    def render(self, model: str, max_tokens: Optional[int] = None) -> str:
+        return "".join(
+            format_message(message) for message in self.window(model, max_tokens)
+        )
@@ -0,0 +1,230 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from config.cfg import (
+    INGESTION_BUFFER_SIZE,
+    INGESTION_EMBED_BATCH_SIZE,
+    INGESTION_EXTRACT_RANGE_PAGES,
+)
+from config.logger import logger
+from core.chunking import chunk_page
+from core.vector_store import clean_text
+from core.embeddings import embed_in_batches
+from core.page_store import page_store_path
+from core.quantization import embedding_fields
+from core.text_extractor import DocumentAnalysis, TextExtractor
+from core.toc import TocResolution, resolve_toc
+
+STAGES = ["extract", "clean", "embed", "store"]
+
+# Marks the end of the stream between two stages
+END = None
+
+
+def drain(input: queue.Queue):
+    """
+    Discards the items left to a failed stage, so that the stage upstream
+    never blocks on a full queue.
+    """
+    while input.get() is not END:
+        pass
+
+
+@dataclass
+class IngestionStatus:
+    total_pages: int = 0
+    # Number of pages processed by each stage
+    processed: Dict[str, int] = field(default_factory=lambda: dict.fromkeys(STAGES, 0))
+    # Every page up to this one (0-indexed) has been stored and can be queried
+    ready_up_to: int = -1
+    done: bool = False
+    error: str = None
+    started_at: float = field(default_factory=time.time)
+
+    @property
+    def queryable(self) -> bool:
+        return self.ready_up_to >= 0
+
+
+class IngestionPipeline:
+    """
+    Streams the pages of a PDF through extract -> clean -> embed -> store
+    stages running in their own threads and connected by bounded queues, so
+    that the first pages can be queried while the rest of the document is
+    still being processed.
+
+    Once every page is stored the ToC and the keywords, which need the whole
+    document, are computed and the keywords are added to the stored pages.
+    """
+
+    def __init__(
+        self,
+        db,
+        path: str,
+        collection_name: str,
+        client=None,
+        buffer_size: int = INGESTION_BUFFER_SIZE,
+    ):
+        self.db = db.for_collection(collection_name)
+        self.path = path
+        self.collection_name = collection_name
+        self.client = client
+        self.buffer_size = buffer_size
+
+        self.text_extractor = TextExtractor(path=path)
+        self.status = IngestionStatus()
+        self.toc = []
+        self.full_text = ""
+        self.keywords = {}
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        try:
+            self.db.create_indexes()
+
+            queues = [queue.Queue(maxsize=self.buffer_size) for _ in STAGES[1:]]
+            stages = [
+                threading.Thread(target=self.extract, args=(queues[0],)),
+                threading.Thread(target=self.clean, args=(queues[0], queues[1])),
+                threading.Thread(target=self.embed, args=(queues[1], queues[2])),
+                threading.Thread(target=self.store, args=(queues[2],)),
+            ]
+            for stage in stages:
+                stage.start()
+            for stage in stages:
+                stage.join()
+
+            self.finalize()
+            logger.info(
+                f"Ingested {self.status.total_pages} pages in "
+                f"{time.time() - self.status.started_at:.1f}s"
+            )
+        except Exception as e:
+            self.status.error = str(e)
+            logger.error(f"Error ingesting {self.path}: {e}")
+        finally:
+            self.status.done = True
+
+    def extract(self, output: queue.Queue):
+        analysis = DocumentAnalysis()
+        try:
+            self.status.total_pages = self.text_extractor.page_count()
+            # Small ranges, so the first pages reach the next stages early
+            for partial in self.text_extractor.analyze_ranges(
+                range_pages=INGESTION_EXTRACT_RANGE_PAGES
+            ):
+                analysis.merge(partial)
+                for page in partial.pages:
+                    output.put((page.page_number - 1, page.text or ""))
+                    self.status.processed["extract"] += 1
+            # The ToC and the keywords reuse the analysis
+            self.text_extractor.analysis = analysis
+        except Exception as e:
+            self.fail("extract", e)
+        finally:
+            output.put(END)
+
+    def fail(self, stage: str, error: Exception):
+        self.status.error = str(error)
+        logger.error(f"Error in the {stage} stage of {self.path}: {error}")
+
+    def clean(self, input: queue.Queue, output: queue.Queue):
+        filename = page_store_path(self.text_extractor.service_dir)
+        try:
+            while (item := input.get()) is not END:
+                page, text = item
+                # The keywords are known once the whole document is analyzed
+                output.put(
+                    chunk_page(page, clean_text(text), keywords=[], filename=filename)
+                )
+                self.status.processed["clean"] += 1
+        except Exception as e:
+            self.fail("clean", e)
+            drain(input)
+        finally:
+            output.put(END)
+
+    def embed(self, input: queue.Queue, output: queue.Queue):
+        finished = False
+        try:
+            while not finished:
+                # Wait for one page, then take whatever else is already buffered
+                batch = [input.get()]
+                while batch[-1] is not END and len(batch) < INGESTION_EMBED_BATCH_SIZE:
+                    try:
+                        batch.append(input.get_nowait())
+                    except queue.Empty:
+                        break
+                if batch[-1] is END:
+                    batch.pop()
+                    finished = True
+                if not batch:
+                    break
+
+                # The chunks of a page always travel together
+                chunks = [chunk for page_chunks in batch for chunk in page_chunks]
+                embeddings = embed_in_batches(
+                    self.db.embedding_model, [chunk["text"] for chunk in chunks]
+                )
+                documents = []
+                for chunk, embedding in zip(chunks, embeddings):
+                    if embedding is None:
+                        logger.error(
+                            f"Error processing chunk {chunk['chunk']} of page "
+                            f"{chunk['page']}"
+                        )
+                        continue
+                    documents.append({**chunk, **embedding_fields(embedding)})
+                self.status.processed["embed"] += len(batch)
+                output.put((documents, len(batch), batch[-1][0]["page"]))
+        except Exception as e:
+            self.fail("embed", e)
+            if not finished:
+                drain(input)
+        finally:
+            output.put(END)
+
+    def store(self, input: queue.Queue):
+        try:
+            while (item := input.get()) is not END:
+                documents, page_count, last_page = item
+                if documents:
+                    self.db.insert_in_batches(documents)
+                self.status.processed["store"] += page_count
+                self.status.ready_up_to = last_page
+        except Exception as e:
+            self.fail("store", e)
+            drain(input)
+
+    def finalize(self):
+        try:
+            if self.status.error:
+                raise RuntimeError(self.status.error)
+
+            self.full_text = self.text_extractor.extract_full_text()
+            logger.info("Resolving the TOC and extracting the keywords...")
+            try:
+                resolution = resolve_toc(self.text_extractor, client=self.client)
+            except Exception as e:
+                # The document is usable without its ToC
+                logger.error(f"Error resolving the TOC of {self.path}: {e}")
+                resolution = TocResolution()
+            self.toc = resolution.toc
+
+            self.keywords = self.text_extractor.extract_keywords(pages=resolution.pages)
+            self.db.update_keywords(self.keywords)
+        finally:
+            # The stored pages are indexed and published whatever failed above
+            self.db.build_indexes(self.keywords)
+
+    def progress(self) -> List[str]:
+        total = self.status.total_pages or "?"
+        return [f"{stage}: {self.status.processed[stage]}/{total}" for stage in STAGES]
@@ -0,0 +1,84 @@
+import os
+from typing import Dict, Iterable, List, Sequence
+
+import numpy as np
+
+from config.logger import logger
+from core.embedding_export import index_dir
+
+
+class KeywordIndex:
+    """
+    Inverted index from every keyword to the sorted array of the pages
+    containing it, stored in CSR form: the pages of the i-th keyword are
+    `postings[indptr[i]:indptr[i + 1]]`.
+    """
+
+    def __init__(
+        self, keywords: Sequence[str], indptr: np.ndarray, postings: np.ndarray
+    ):
+        self.keywords = {keyword: i for i, keyword in enumerate(keywords)}
+        self.indptr = indptr
+        self.postings = postings
+
+    @classmethod
+    def build(cls, keywords: Dict[int, List[str]]) -> "KeywordIndex":
+        pages_by_keyword: Dict[str, set] = {}
+        for page, page_keywords in keywords.items():
+            for keyword in page_keywords:
+                pages_by_keyword.setdefault(keyword.lower(), set()).add(int(page))
+
+        sorted_keywords = sorted(pages_by_keyword)
+        lists = [sorted(pages_by_keyword[keyword]) for keyword in sorted_keywords]
+        indptr = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum([len(pages) for pages in lists], out=indptr[1:])
+        postings = np.fromiter(
+            (page for pages in lists for page in pages),
+            dtype=np.int32,
+            count=indptr[-1],
+        )
+        return cls(sorted_keywords, indptr, postings)
+
+    def __len__(self) -> int:
+        return len(self.keywords)
+
+    def pages(self, keyword: str) -> np.ndarray:
+        i = self.keywords.get(keyword.lower())
+        if i is None:
+            return np.empty(0, dtype=np.int32)
+        return self.postings[self.indptr[i] : self.indptr[i + 1]]
+
+    def union(self, keywords: Iterable[str]) -> np.ndarray:
+        """
+        Pages containing at least one of the keywords.
+        """
+        lists = [self.pages(keyword) for keyword in set(keywords)]
+        if not lists:
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate(lists))
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Replaced atomically, the processes loading it never see a partial file
+        with open(f"{path}.tmp", "wb") as file:
+            np.savez(
+                file,
+                keywords=np.array(sorted(self.keywords, key=self.keywords.get)),
+                indptr=self.indptr,
+                postings=self.postings,
+            )
+        os.replace(f"{path}.tmp", path)
+        logger.info(f"Keyword index with {len(self)} keywords saved to '{path}'")
+
+    @classmethod
+    def load(cls, path: str) -> "KeywordIndex":
+        with np.load(path) as data:
+            return cls(
+                keywords=data["keywords"].tolist(),
+                indptr=data["indptr"],
+                postings=data["postings"],
+            )
+
+
+def keyword_index_path(collection_name: str) -> str:
+    return os.path.join(index_dir(collection_name), "keywords.npz")
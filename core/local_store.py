@@ -0,0 +1,290 @@
+import copy
+import json
+import os
+import shutil
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config.cfg import INSERT_BATCH_SIZE, LOCAL_STORE_DIR
+from config.logger import logger
+from core.quantization import decode_embedding
+from core.scoring import normalize_rows, top_k_pages
+from core.vector_store import IndexedStore, remove_indexes
+
+# Files of a collection, all append-only: a row is stored once its embedding
+# is written, so readers never see a partial document
+META_FILE = "meta.json"
+EMBEDDINGS_FILE = "embeddings.f32"
+PAGES_FILE = "pages.i64"
+TEXT_FILE = "texts.bin"
+TEXT_OFFSETS_FILE = "text_offsets.u64"
+KEYWORDS_FILE = "keywords.json"
+
+
+class LocalVectorStore(IndexedStore):
+    """
+    Vector store keeping every collection in a directory of flat files: the
+    normalized embeddings and the pages as raw NumPy arrays memory-mapped at
+    query time, and the texts as concatenated UTF-8 with their end offsets.
+
+    The ids of the documents are their row numbers. It needs no server, so it
+    serves single-node deployments, benchmarks and offline runs.
+    """
+
+    def __init__(
+        self,
+        directory: str = LOCAL_STORE_DIR,
+        collection_name: str = "mycollection",
+        recreate_collection: bool = False,
+        embedding_model=None,
+    ):
+        super().__init__(embedding_model)
+        self.directory = directory
+        self.lock = threading.Lock()
+        # Memory maps of the collections, by name
+        self.maps = {}
+
+        if recreate_collection:
+            shutil.rmtree(self.path(collection_name), ignore_errors=True)
+            remove_indexes(collection_name)
+
+        self.collection_name = collection_name
+        logger.info(f"Connected to the local collection '{collection_name}'")
+
+    def path(self, collection_name: str, filename: str = "") -> str:
+        return os.path.join(self.directory, collection_name, filename)
+
+    def collection_exists(self, collection_name: str) -> bool:
+        if os.path.exists(self.path(collection_name, META_FILE)):
+            logger.info(f"Collection '{collection_name}' already exists")
+            return True
+        logger.info(f"Collection '{collection_name}' does not exist")
+        return False
+
+    def for_collection(self, collection_name: str) -> "LocalVectorStore":
+        """
+        Handle on a collection sharing the embedding model, the memory maps
+        and the loaded indexes of this store.
+        """
+        handle = copy.copy(self)
+        handle.collection_name = collection_name
+        return handle
+
+    def create_indexes(self):
+        os.makedirs(self.path(self.collection_name), exist_ok=True)
+
+    def dimensions(self) -> Optional[int]:
+        try:
+            with open(self.path(self.collection_name, META_FILE)) as file:
+                return json.load(file)["dimensions"]
+        except FileNotFoundError:
+            return None
+
+    def count(self) -> int:
+        dimensions = self.dimensions()
+        if not dimensions:
+            return 0
+        path = self.path(self.collection_name, EMBEDDINGS_FILE)
+        if not os.path.exists(path):
+            return 0
+        return os.path.getsize(path) // (4 * dimensions)
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Memory-mapped embeddings, pages and text offsets of the stored rows,
+        mapped again only when rows have been added.
+        """
+        name = self.collection_name
+        count = self.count()
+        if name not in self.maps or self.maps[name][0] != count:
+            if count == 0:
+                arrays = (
+                    np.empty((0, self.dimensions() or 0), np.float32),
+                    np.empty(0, np.int64),
+                    np.zeros(1, np.uint64),
+                )
+            else:
+                arrays = (
+                    np.memmap(
+                        self.path(name, EMBEDDINGS_FILE),
+                        dtype=np.float32,
+                        mode="r",
+                        shape=(count, self.dimensions()),
+                    ),
+                    np.memmap(
+                        self.path(name, PAGES_FILE),
+                        dtype=np.int64,
+                        mode="r",
+                        shape=(count,),
+                    ),
+                    np.concatenate(
+                        [
+                            np.zeros(1, np.uint64),
+                            np.memmap(
+                                self.path(name, TEXT_OFFSETS_FILE),
+                                dtype=np.uint64,
+                                mode="r",
+                                shape=(count,),
+                            ),
+                        ]
+                    ),
+                )
+            self.maps[name] = (count, arrays)
+        return self.maps[name][1]
+
+    def insert_in_batches(
+        self, documents: List[Dict], batch_size: int = INSERT_BATCH_SIZE
+    ):
+        """
+        Appends the documents to the files of the collection.
+        """
+        if not documents:
+            return
+        with self.lock:
+            self.create_indexes()
+            for start in range(0, len(documents), batch_size):
+                self.append(documents[start : start + batch_size])
+
+    def append(self, documents: List[Dict]):
+        embeddings = normalize_rows(
+            np.stack([decode_embedding(doc) for doc in documents])
+        )
+        dimensions = self.dimensions()
+        if dimensions is None:
+            dimensions = embeddings.shape[1]
+            with open(self.path(self.collection_name, META_FILE), "w") as file:
+                json.dump({"dimensions": dimensions}, file)
+        elif embeddings.shape[1] != dimensions:
+            raise ValueError(
+                f"Embeddings of {embeddings.shape[1]} dimensions can't be stored "
+                f"in a collection of {dimensions} dimensions"
+            )
+
+        texts = [doc["text"].encode("utf-8") for doc in documents]
+        _, _, offsets = self.arrays()
+        ends = int(offsets[-1]) + np.cumsum(
+            [len(text) for text in texts], dtype=np.uint64
+        )
+
+        # The embeddings are written last, as they define the stored rows
+        with open(self.path(self.collection_name, TEXT_FILE), "ab") as file:
+            file.write(b"".join(texts))
+        with open(self.path(self.collection_name, TEXT_OFFSETS_FILE), "ab") as file:
+            file.write(ends.astype(np.uint64).tobytes())
+        with open(self.path(self.collection_name, PAGES_FILE), "ab") as file:
+            file.write(np.array([doc["page"] for doc in documents], np.int64).tobytes())
+        with open(self.path(self.collection_name, EMBEDDINGS_FILE), "ab") as file:
+            file.write(embeddings.astype(np.float32).tobytes())
+
+        keywords = {
+            doc["page"]: doc["keywords"] for doc in documents if doc.get("keywords")
+        }
+        if keywords:
+            self.write_keywords(keywords)
+
+        for doc in documents:
+            logger.info(f"Processed: {doc.get('filename')} (Page {doc['page']})")
+
+    def read_keywords(self) -> Dict[int, List[str]]:
+        try:
+            with open(self.path(self.collection_name, KEYWORDS_FILE)) as file:
+                return {int(page): words for page, words in json.load(file).items()}
+        except FileNotFoundError:
+            return {}
+
+    def write_keywords(self, keywords: Dict[int, List[str]]):
+        stored = self.read_keywords()
+        stored.update({int(page): sorted(words) for page, words in keywords.items()})
+        path = self.path(self.collection_name, KEYWORDS_FILE)
+        with open(f"{path}.tmp", "w") as file:
+            json.dump(stored, file)
+        os.replace(f"{path}.tmp", path)
+
+    def update_keywords(self, keywords: Dict[int, List[str]]):
+        """
+        Sets the keywords of the pages already stored in the collection.
+        """
+        with self.lock:
+            self.create_indexes()
+            self.write_keywords(keywords)
+
+    def exact_search(
+        self,
+        query_embedding: List[float],
+        top_k: int,
+        candidates: Optional[np.ndarray],
+        keyword_filter: Optional[List[str]],
+    ) -> List[Dict]:
+        matrix, pages, _ = self.arrays()
+
+        if candidates is None and keyword_filter:
+            # No keyword index yet: filter on the stored keywords
+            words = {kw.lower() for kw in keyword_filter}
+            candidates = np.array(
+                [
+                    page
+                    for page, page_keywords in self.read_keywords().items()
+                    if words.intersection(kw.lower() for kw in page_keywords)
+                ],
+                dtype=np.int64,
+            )
+
+        if len(pages) == 0 or top_k <= 0:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / np.linalg.norm(query)
+
+        rows = None
+        if candidates is not None and len(candidates):
+            rows = np.flatnonzero(np.isin(pages, candidates))
+        # Fall back to all the documents when the filter matches nothing
+        if rows is None or len(rows) == 0:
+            # Scanning the mapped matrix in place avoids copying it
+            rows = np.arange(len(pages))
+            scores = matrix @ query
+        else:
+            scores = matrix[rows] @ query
+        best = top_k_pages(pages[rows], scores, top_k)
+        return [
+            {
+                "_id": str(rows[i]),
+                "page": int(pages[rows[i]]),
+                "score": float(scores[i]),
+            }
+            for i in best
+        ]
+
+    def fetch_texts(self, hits: List[Dict]) -> List[Dict]:
+        _, _, offsets = self.arrays()
+        results = []
+        with open(self.path(self.collection_name, TEXT_FILE), "rb") as file:
+            for hit in hits:
+                row = int(hit["_id"])
+                file.seek(int(offsets[row]))
+                text = file.read(int(offsets[row + 1] - offsets[row]))
+                results.append(
+                    {
+                        "page": hit["page"],
+                        "text": text.decode("utf-8"),
+                        "score": hit["score"],
+                    }
+                )
+        return results
+
+    def load_embeddings(self) -> Tuple[np.ndarray, List[int], List[str]]:
+        matrix, pages, _ = self.arrays()
+        return matrix, pages.tolist(), [str(row) for row in range(len(pages))]
+
+    def load_texts(self) -> Tuple[List[str], List[int], List[str]]:
+        _, pages, offsets = self.arrays()
+        if len(pages) == 0:
+            return [], [], []
+        with open(self.path(self.collection_name, TEXT_FILE), "rb") as file:
+            data = file.read(int(offsets[-1]))
+        texts = [
+            data[int(start) : int(end)].decode("utf-8")
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+        return texts, pages.tolist(), [str(row) for row in range(len(pages))]
@@ -0,0 +1,89 @@
+import mmap
+import os
+import struct
+from typing import List
+
+import numpy as np
+
+from config.cfg import PAGE_STORE_DIR
+
+MAGIC = b"PGS1"
+HEADER = struct.Struct("<4sI")
+
+
+class PageStore:
+    """
+    Read-only view over the pages of a document stored in a single file: a
+    header, a table of `count + 1` byte offsets and the concatenated UTF-8
+    text of the pages. The file is memory-mapped, so any page range is read
+    in O(1) without loading the others.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC:
+            self.mmap.close()
+            raise ValueError(f"'{path}' is not a page store")
+        self.offsets = np.frombuffer(
+            self.mmap, dtype="<u8", count=self.count + 1, offset=HEADER.size
+        )
+        self.data_start = HEADER.size + self.offsets.nbytes
+
+    def __enter__(self) -> "PageStore":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # The offsets view must be released before the map
+        self.offsets = None
+        self.mmap.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, page: int) -> str:
+        if not 0 <= page < self.count:
+            raise IndexError(f"Page {page} out of range")
+        return self.read(page, page + 1)
+
+    def read(self, start: int, stop: int) -> str:
+        """
+        Returns the concatenated text of the pages in [start, stop).
+        """
+        start, stop = max(start, 0), min(stop, self.count)
+        if start >= stop:
+            return ""
+        begin = self.data_start + int(self.offsets[start])
+        end = self.data_start + int(self.offsets[stop])
+        return self.mmap[begin:end].decode("utf-8")
+
+    def get_range(self, start: int, stop: int) -> List[str]:
+        return [self[page] for page in range(max(start, 0), min(stop, self.count))]
+
+    @staticmethod
+    def write(path: str, pages: List[str]):
+        """
+        Writes the pages to a new store, replacing the previous one atomically.
+        """
+        encoded = [(page or "").encode("utf-8") for page in pages]
+        offsets = np.zeros(len(encoded) + 1, dtype="<u8")
+        np.cumsum([len(page) for page in encoded], out=offsets[1:])
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, len(encoded)))
+            file.write(offsets.tobytes())
+            for page in encoded:
+                file.write(page)
+        os.replace(tmp_path, path)
+
+
+def page_store_path(service_dir: str) -> str:
+    return os.path.join(PAGE_STORE_DIR, f"{service_dir}.pages")
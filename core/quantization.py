@@ -0,0 +1,46 @@
+from typing import List, Tuple
+
+import numpy as np
+from bson.binary import Binary
+
+from config.cfg import EMBEDDING_DTYPE, EMBEDDING_STORAGE
+
+
+def quantize(vector: np.ndarray) -> Tuple[np.ndarray, float]:
+    """
+    Symmetric int8 quantization with a per-vector scale:
+    vector ~= quantized * scale.
+    """
+    scale = float(np.abs(vector).max()) / 127 or 1.0
+    return np.round(vector / scale).astype(np.int8), scale
+
+
+def embedding_fields(embedding: List[float], storage: str = EMBEDDING_STORAGE) -> dict:
+    """
+    Fields storing an embedding in a document, in the configured format:
+    a BSON array of doubles, or the raw vector as BSON Binary plus its int8
+    quantized copy used by the coarse search pass.
+    """
+    if storage != "binary":
+        return {"embedding": embedding}
+
+    vector = np.asarray(embedding, dtype=EMBEDDING_DTYPE)
+    quantized, scale = quantize(vector.astype(np.float32))
+    return {
+        "embedding": Binary(vector.tobytes()),
+        "embedding_dtype": EMBEDDING_DTYPE,
+        "embedding_i8": Binary(quantized.tobytes()),
+        "embedding_scale": scale,
+    }
+
+
+def decode_embedding(document: dict) -> np.ndarray:
+    """
+    Reads the embedding of a document in any of the storage formats.
+    """
+    embedding = document["embedding"]
+    if isinstance(embedding, bytes):
+        return np.frombuffer(
+            embedding, dtype=document.get("embedding_dtype", "float32")
+        ).astype(np.float32)
+    return np.asarray(embedding, dtype=np.float32)
@@ -0,0 +1,149 @@
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from config.cfg import RRF_K
+from core.quantization import decode_embedding
+
+
+class EmbeddingMatrix:
+    """
+    Holds the embeddings of a collection as a single pre-normalized float32
+    matrix, so that a query is scored with one matrix-vector product.
+    """
+
+    def __init__(self, pages: Sequence[int], embeddings, ids: Sequence):
+        self.pages = np.asarray(pages, dtype=np.int64)
+        self.ids = list(ids)
+        self.matrix = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+
+    @classmethod
+    def from_documents(cls, documents: List[dict]) -> "EmbeddingMatrix":
+        return cls(
+            pages=[doc["page"] for doc in documents],
+            embeddings=(
+                np.stack([decode_embedding(doc) for doc in documents])
+                if documents
+                else np.empty((0, 0), dtype=np.float32)
+            ),
+            ids=[doc["_id"] for doc in documents],
+        )
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def scores(self, query_embedding) -> np.ndarray:
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / np.linalg.norm(query)
+        return self.matrix @ query
+
+    def search(self, query_embedding, top_k: int = 5) -> List[Dict]:
+        """
+        Returns the best matching segment of the `top_k` best pages, sorted by
+        score, as dictionaries with the `_id`, `page` and `score` of the row.
+        """
+        if len(self) == 0 or top_k <= 0:
+            return []
+
+        scores = self.scores(query_embedding)
+        rows = top_k_pages(self.pages, scores, top_k)
+        return [
+            {
+                "_id": self.ids[row],
+                "page": int(self.pages[row]),
+                "score": float(scores[row]),
+            }
+            for row in rows
+        ]
+
+
+class QuantizedMatrix:
+    """
+    The int8 quantized embeddings of a collection, used for a coarse pass
+    whose best rows are then rescored with the exact embeddings.
+    """
+
+    def __init__(self, quantized: np.ndarray, ids: Sequence):
+        self.ids = list(ids)
+        # Cosine similarity does not depend on the per-vector scale
+        self.matrix = normalize_rows(quantized.astype(np.float32))
+
+    @classmethod
+    def from_documents(cls, documents: List[dict]) -> "QuantizedMatrix":
+        quantized = np.frombuffer(
+            b"".join(doc["embedding_i8"] for doc in documents), dtype=np.int8
+        ).reshape(len(documents), -1)
+        return cls(quantized, ids=[doc["_id"] for doc in documents])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def candidates(self, query_embedding, count: int) -> List:
+        """
+        Ids of the `count` rows with the best approximate score.
+        """
+        query = np.asarray(query_embedding, dtype=np.float32)
+        scores = self.matrix @ (query / np.linalg.norm(query))
+        if count < len(scores):
+            rows = np.argpartition(-scores, count - 1)[:count]
+        else:
+            rows = np.arange(len(scores))
+        return [self.ids[row] for row in rows]
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def best_row_per_page(pages: np.ndarray, scores: np.ndarray) -> np.ndarray:
+    """
+    Vectorized group-max: returns the index of the best scoring row of every
+    page. On ties the first row of the page wins.
+    """
+    # Sort by page, then by descending score (lexsort is stable)
+    order = np.lexsort((-scores, pages))
+    sorted_pages = pages[order]
+    first_of_group = np.ones(len(order), dtype=bool)
+    first_of_group[1:] = sorted_pages[1:] != sorted_pages[:-1]
+    return order[first_of_group]
+
+
+def top_k_pages(pages: np.ndarray, scores: np.ndarray, top_k: int) -> np.ndarray:
+    """
+    Returns the rows of the `top_k` best pages sorted by descending score.
+    """
+    rows = best_row_per_page(pages, scores)
+    # Keep the order in which the pages are first seen, as ties are broken by it
+    _, first_seen = np.unique(pages, return_index=True)
+    rows = rows[np.argsort(first_seen, kind="stable")]
+    best_scores = scores[rows]
+
+    if top_k < len(rows):
+        candidates = np.argpartition(-best_scores, top_k - 1)[:top_k]
+        # Include every row tied with the k-th score to keep the ordering stable
+        threshold = best_scores[candidates].min()
+        candidates = np.flatnonzero(best_scores >= threshold)
+    else:
+        candidates = np.arange(len(rows))
+
+    ranked = candidates[np.argsort(-best_scores[candidates], kind="stable")]
+    return rows[ranked[:top_k]]
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[Dict]], top_k: int = 5, k: int = RRF_K
+) -> List[Dict]:
+    """
+    Fuses rankings of pages: a page scores the sum of 1 / (k + rank) over the
+    rankings it appears in. The row of a page is taken from the first ranking
+    containing it.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, hit in enumerate(ranking, start=1):
+            if hit["page"] not in fused:
+                fused[hit["page"]] = {**hit, "score": 0.0}
+            fused[hit["page"]]["score"] += 1 / (k + rank)
+    return sorted(fused.values(), key=lambda hit: hit["score"], reverse=True)[:top_k]
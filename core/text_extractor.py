@@ -1,12 +1,127 @@
-import os
+import multiprocessing
 import re
-import statistics
-from typing import Dict, List
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from fractions import Fraction
+from typing import Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
 import pdfplumber
-
-from config.cfg import DEFAULT_KEYWORDS_TO_IGNORE, TOC_KEYWORDS
+import pypdfium2
+
+from config.cfg import (
+    DEFAULT_KEYWORDS_TO_IGNORE,
+    EXTRACTION_MIN_PAGES_PER_WORKER,
+    EXTRACTION_WORKERS,
+    TOC_KEYWORDS,
+    TOC_SCAN_PAGES,
+)
 from config.logger import logger
+from core.page_store import PageStore, page_store_path
+
+
+@dataclass
+class PageAnalysis:
+    """
+    Everything the extractor needs from a single page of the PDF.
+    """
+
+    page_number: int
+    text: str
+    # The texts of the chars, concatenated, and one entry per char: its font
+    # size and whether it is bold or coloured
+    chars: str = ""
+    char_sizes: array = field(default_factory=lambda: array("d"))
+    char_bold: bytearray = field(default_factory=bytearray)
+    char_coloured: bytearray = field(default_factory=bytearray)
+    # Code points of the text of every char, None when they are all single
+    char_lengths: Optional[array] = None
+
+    def char_codes(self) -> np.ndarray:
+        """
+        Code points of `chars`.
+        """
+        return np.frombuffer(self.chars.encode("utf-32-le"), dtype=np.uint32)
+
+    def select(self, mask: np.ndarray) -> str:
+        """
+        Text of the chars selected by a boolean mask.
+        """
+        if self.char_lengths is not None:
+            mask = np.repeat(mask, np.frombuffer(self.char_lengths, dtype=np.uintc))
+        return self.char_codes()[mask].tobytes().decode("utf-32-le")
+
+
+@dataclass
+class DocumentAnalysis:
+    pages: List[PageAnalysis] = field(default_factory=list)
+    # Exact sum of the font sizes, so that partial sums can be merged
+    size_sum: Fraction = Fraction(0)
+    size_count: int = 0
+
+    @property
+    def avg_font_size(self) -> float:
+        return float(self.size_sum / self.size_count) if self.size_count else 10
+
+    def add_page(self, page):
+        text = page.extract_text()
+        chars = page.chars
+        texts = [char.get("text", "") for char in chars]
+        page_analysis = PageAnalysis(
+            page_number=page.page_number,
+            text=text,
+            chars="".join(texts),
+            char_sizes=array("d", [char.get("size", 0) for char in chars]),
+            char_bold=bytearray("Bold" in char.get("fontname", "") for char in chars),
+            char_coloured=bytearray(
+                char.get("stroking_color", None) != (0,) for char in chars
+            ),
+        )
+        if len(page_analysis.chars) != len(texts):
+            page_analysis.char_lengths = array("I", map(len, texts))
+
+        self.pages.append(page_analysis)
+        self.size_sum += exact_sum(page_analysis.char_sizes)
+        self.size_count += len(page_analysis.char_sizes)
+
+    def merge(self, other: "DocumentAnalysis"):
+        """
+        Appends the analysis of the pages following the ones of this analysis.
+        """
+        self.pages.extend(other.pages)
+        self.size_sum += other.size_sum
+        self.size_count += other.size_count
+
+
+def worker_context():
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def iter_page_range(path: str, start: int, stop: int) -> Iterator[DocumentAnalysis]:
+    """
+    Analyzes the pages in [start, stop), yielding the analysis of each page.
+    """
+    with pdfplumber.open(path) as pdf:
+        for page in pdf.pages[start:stop]:
+            analysis = DocumentAnalysis()
+            analysis.add_page(page)
+            # Release the parsed layout of the page
+            page.close()
+            yield analysis
+
+
+def analyze_page_range(path: str, start: int, stop: int) -> DocumentAnalysis:
+    """
+    Analyzes the pages in [start, stop). Runs in the worker processes too, so
+    it opens the file by itself.
+    """
+    analysis = DocumentAnalysis()
+    for page_analysis in iter_page_range(path, start, stop):
+        analysis.merge(page_analysis)
+    return analysis
 
 
 class TextExtractor:
@@ -24,6 +139,7 @@ class TextExtractor:
         else:
             self.keywords_to_ignore = keywords_to_ignore
         self.pages = []
+        self.analysis = None
 
         self.service_dir = (
             path.split("/")[-1]
@@ -33,6 +149,64 @@ class TextExtractor:
             .replace("\\", "_")
         )
 
+    def page_count(self) -> int:
+        with pdfplumber.open(self.path) as pdf:
+            return len(pdf.pages)
+
+    def analyze_ranges(
+        self, workers: int = EXTRACTION_WORKERS, range_pages: int = None
+    ) -> Iterator[DocumentAnalysis]:
+        """
+        Yields the analyses of consecutive page ranges, in page order. They
+        are not cached.
+
+        With one worker every page is yielded as soon as it's parsed. With
+        more the document is split into ranges of `range_pages` pages (one
+        range per worker by default) analyzed by a process pool, each worker
+        opening the file by itself.
+        """
+        page_count = self.page_count()
+        workers = min(workers, page_count // EXTRACTION_MIN_PAGES_PER_WORKER)
+        logger.info(f"Analyzing {page_count} pages with {max(workers, 1)} workers")
+        if workers <= 1:
+            yield from iter_page_range(self.path, 0, page_count)
+            return
+
+        if range_pages:
+            bounds = list(range(0, page_count, range_pages)) + [page_count]
+        else:
+            bounds = [page_count * i // workers for i in range(workers + 1)]
+        ranges = len(bounds) - 1
+        # The app runs threads (Streamlit, the background event loop), so the
+        # workers aren't forked from it
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=worker_context()
+        ) as executor:
+            yield from executor.map(
+                analyze_page_range,
+                [self.path] * ranges,
+                bounds[:-1],
+                bounds[1:],
+            )
+
+    def analyze(self, workers: int = EXTRACTION_WORKERS) -> DocumentAnalysis:
+        """
+        Opens the PDF once and visits every page once, collecting the page
+        text and the char statistics used by the other methods. The result
+        is cached.
+
+        With more than one worker the page range is split across a process
+        pool; the partial analyses are merged in page order.
+        """
+        if self.analysis is not None:
+            return self.analysis
+
+        analysis = DocumentAnalysis()
+        for partial in self.analyze_ranges(workers):
+            analysis.merge(partial)
+        self.analysis = analysis
+        return self.analysis
+
     def extract_useful_metadata(self) -> dict:
         with pdfplumber.open(self.path) as pdf:
             metadata = pdf.metadata
@@ -83,163 +257,153 @@ class TextExtractor:
             res.append({"title": titolo.strip(), "page": pagina})
         return res
 
-    def generate_toc(self) -> tuple:
-        toc = []
+    def outline_toc(self) -> List[dict]:
+        """
+        ToC from the bookmarks of the PDF, read without extracting any text.
+        Empty when the document has no outline.
+
+        The bookmarks point to page indexes, while the scanned or generated
+        ToCs hold the numbers printed in the document: the pages are given
+        by the page labels of the PDF when it defines them (e.g. "iv", "12"
+        after the front matter), else by their position from 1.
+        """
+        pdf = pypdfium2.PdfDocument(self.path)
+        try:
+            toc = [
+                {
+                    "title": item.title.strip(),
+                    "page": pdf.get_page_label(item.page_index)
+                    or str(item.page_index + 1),
+                    "level": item.level,
+                }
+                for item in pdf.get_toc()
+                if item.page_index is not None and item.title.strip()
+            ]
+        finally:
+            pdf.close()
+        logger.info(f"Found {len(toc)} entries in the outline")
+        return toc
+
+    def first_page_texts(self, max_pages: int) -> Iterator[Tuple[int, str]]:
+        """
+        Number and text of the first pages, from the analysis when it's
+        done, otherwise extracted one page at a time as they are consumed.
+        """
+        if self.analysis is not None:
+            for page in self.analysis.pages[:max_pages]:
+                yield page.page_number, page.text or ""
+            return
         with pdfplumber.open(self.path) as pdf:
-            index_toc = []
-            for i, page in enumerate(pdf.pages):
-                text = page.extract_text()
-                if text and any(keyword in text for keyword in self.toc_keywords):
-                    index_toc.append(
-                        i + 1
-                    )  # Le pagine in pdfplumber sono 0-indexed, mentre per l'utente sono 1-indexed
-
-                    list_lines = text.split("\n")
-
-                    for line in list_lines:
-                        # Remove multiple spaces or dots
-                        line = re.sub(r"\s+", " ", line)
-                        line = re.sub(r"\.{2,}", "", line)
-
-                        # Extract number title, title name, and page title
-                        match = re.match(r"(\d+(?:\.\d+)?)\s+(.+?)\s+(\d+)$", line)
-                        if match:
-                            main_chapters = match.groups()
-                            # Create a toc dictionary
-                            toc.append(
-                                {
-                                    "number": main_chapters[0],
-                                    "title": main_chapters[1].strip(),
-                                    "page": main_chapters[2],
-                                }
-                            )
-            logger.info(f"Found {len(toc)} entries in the ToC")
-
-            found_additional_toc_entries = False
-            if index_toc.__len__() > 0:
-                for i, page in enumerate(pdf.pages):
-                    # Try to find additional toc in the next page
-                    if index_toc[0] + 1 == i:
-                        next_page = pdf.pages[i - 1]
-                        next_page_text = next_page.extract_text()
-                        next_page_lines = next_page_text.split("\n")
-
-                        for next_line in next_page_lines:
-                            next_line = re.sub(r"\s+", " ", next_line)
-                            next_line = re.sub(r"\.{2,}", "", next_line)
-                            next_match = re.match(
-                                r"(\d+(?:\.\d+)?)\s+(.+?)\s+(\d+)$", next_line
-                            )
-                            if next_match:
-                                next_chapters = next_match.groups()
-                                toc.append(
-                                    {
-                                        "number": next_chapters[0],
-                                        "title": next_chapters[1].strip(),
-                                        "page": next_chapters[2],
-                                    }
-                                )
-                                found_additional_toc_entries = True
-                                page_index = i
-
-                if found_additional_toc_entries:
-                    logger.info("Found additional entries in the next page.")
-                    index_toc.append(page_index)
-        return (toc, index_toc)
+            for page in pdf.pages[:max_pages]:
+                text = page.extract_text() or ""
+                page.close()
+                yield page.page_number, text
+
+    def scan_toc(self, max_pages: int = TOC_SCAN_PAGES) -> tuple:
+        """
+        Looks for the ToC in the first `max_pages` pages: from the first
+        page containing a ToC keyword whose lines parse as entries, up to
+        the first following page without entries, where the scan stops.
+        """
+        toc, pages = [], []
+        for page_number, text in self.first_page_texts(max_pages):
+            if not pages and not any(keyword in text for keyword in self.toc_keywords):
+                continue
+            entries = parse_toc_lines(text)
+            if entries:
+                toc.extend(entries)
+                pages.append(page_number)
+            elif pages:
+                break
+        logger.info(f"Found {len(toc)} entries in the ToC pages {pages}")
+        return (toc, pages)
 
     def extract_full_text(self):
-        if os.path.exists("extracted_pages") is False:
-            logger.info("Creating directory to store extracted pages.")
-            os.mkdir("extracted_pages")
-        if os.path.exists(f"extracted_pages/{self.service_dir}") is False:
-            os.mkdir(f"extracted_pages/{self.service_dir}")
-        with pdfplumber.open(self.path) as pdf:
-            complete_text = ""
-            for i, page in enumerate(pdf.pages):
-                page_text = page.extract_text()
-                with open(
-                    f"extracted_pages/{self.service_dir}/page_{i}.txt",
-                    "w",
-                    encoding="utf-8",
-                ) as file:
-                    file.write(page_text or "")
-                    file.close()
-                complete_text += page_text or ""
+        texts = [page.text or "" for page in self.analyze().pages]
+        # One file per document holding every page
+        PageStore.write(page_store_path(self.service_dir), texts)
         logger.info("Text extracted from all pages")
-        return complete_text
+        return "".join(texts)
 
     def extract_keywords(self, pages: List[int]) -> dict:
-        bold_text = {}
-
-        with pdfplumber.open(self.path) as pdf:
-            # Compute global text statistics across all pages
-            all_char_sizes = [
-                char.get("size", 0) for page in pdf.pages for char in page.chars
-            ]
-
-            # Calculate size thresholds
-            avg_font_size = statistics.mean(all_char_sizes) if all_char_sizes else 10
-            size_threshold = avg_font_size * 1.2
-
-            for page in pdf.pages:
-                if (
-                    page.page_number not in pages
-                ):  # Se la pagina non è una pagina di indice
-                    page_chars = []
-                    for char in page.chars:
-                        if (
-                            "Bold" in char.get("fontname", "")
-                            or
-                            # char.get("stroking_color", None) in significant_colors or
-                            char.get("stroking_color", None) != (0,)
-                        ) or char.get("size", 0) > size_threshold:
-                            page_chars.append(char.get("text", ""))
-                    full_text = "".join(page_chars)
-
-                    char_list = [char for char in full_text.split(" ") if char]
-
-                    refactored_char_list = []
-                    for char in char_list:
-                        for keyword in self.keywords_to_ignore:
-                            replaced_char = char.replace(keyword, "")
-                            if replaced_char != "":
-                                refactored_char_list.append(replaced_char.lower())
-                            break
-                    unique_chars = list(set(refactored_char_list))
-                    unified_chars = " ".join(unique_chars)
-                    # Remove punctuation
-                    bold_text[page.page_number] = clean_text(unified_chars)
+        """
+        Words of every page written in bold, coloured or larger than 1.2 times
+        the average font size, without the keywords to ignore, by 0-indexed
+        page. The ToC pages in `pages` are skipped.
+
+        The chars of a page are selected with a mask over its size, bold and
+        colour columns, and the ignored keywords are stripped from its unique
+        words at once.
+        """
+        analysis = self.analyze()
+
+        # Calculate size thresholds from the global text statistics
+        size_threshold = analysis.avg_font_size * 1.2
+        ignored = ignore_matcher(self.keywords_to_ignore)
+        toc_pages = set(pages)
 
         keywords = {}
-        for key, value in bold_text.items():
-            values_list = value.split(" ")
-            new_value_list = []
-
-            for v in values_list:
-                # Check if any keyword to ignore is in the word
-                is_ignored = any(
-                    keywords_to_ignore in v
-                    for keywords_to_ignore in self.keywords_to_ignore
-                )
-
-                if is_ignored:
-                    # Remove the keywords to ignore and add the cleaned word
-                    new_value = v
-                    for keywords_to_ignore in self.keywords_to_ignore:
-                        new_value = new_value.replace(keywords_to_ignore, "")
-                    new_value_list.append(new_value.lower())
-                else:
-                    # If no keywords to ignore, add the original word
-                    new_value_list.append(v.lower())
-
-            # Remove duplicates
-            new_value_list = list(set(new_value_list))
-            keywords[key - 1] = new_value_list
+        for page in analysis.pages:
+            if page.page_number in toc_pages:
+                continue
+            mask = (
+                np.frombuffer(page.char_bold, dtype=np.bool_)
+                | np.frombuffer(page.char_coloured, dtype=np.bool_)
+                | (np.frombuffer(page.char_sizes, dtype=np.float64) > size_threshold)
+            )
+            words = set(page.select(mask).split(" "))
+            # The keywords to ignore hold no space, so the unique words are
+            # cleaned all at once
+            text = ignored.sub("", " ".join(words).lower().translate(PUNCTUATION))
+            keywords[page.page_number - 1] = sorted(set(text.split(" ")))
 
         # Clean up the keywords
         return clean_keywords(keywords)
 
 
+def parse_toc_lines(text: str) -> List[dict]:
+    entries = []
+    for line in text.split("\n"):
+        # Remove multiple spaces or dots
+        line = re.sub(r"\s+", " ", line)
+        line = re.sub(r"\.{2,}", "", line)
+
+        # Extract number title, title name, and page title
+        match = re.match(r"(\d+(?:\.\d+)?)\s+(.+?)\s+(\d+)$", line)
+        if match:
+            main_chapters = match.groups()
+            # Create a toc dictionary
+            entries.append(
+                {
+                    "number": main_chapters[0],
+                    "title": main_chapters[1].strip(),
+                    "page": main_chapters[2],
+                }
+            )
+    return entries
+
+
+def exact_sum(values) -> Fraction:
+    """
+    Sums the values without rounding errors, like `statistics.mean` does.
+    """
+    partials = {}
+    for value in values:
+        numerator, denominator = value.as_integer_ratio()
+        partials[denominator] = partials.get(denominator, 0) + numerator
+    return sum(
+        (
+            Fraction(numerator, denominator)
+            for denominator, numerator in partials.items()
+        ),
+        Fraction(0),
+    )
+
+
+# Punctuation removed by `clean_text`
+PUNCTUATION = str.maketrans("", "", ":,.;’‘()")
+
+
 def clean_text(text: str) -> str:
     text = (
         text.strip()
@@ -255,15 +419,24 @@ def clean_text(text: str) -> str:
     return text
 
 
+def ignore_matcher(keywords_to_ignore: List[str]) -> re.Pattern:
+    """
+    Single pattern matching any of the keywords, the longest first.
+    """
+    return re.compile(
+        "|".join(
+            re.escape(keyword)
+            for keyword in sorted(keywords_to_ignore, key=len, reverse=True)
+        )
+    )
+
+
+def is_keyword(word: str) -> bool:
+    return 2 <= len(word) <= 15 and not word.isdigit()
+
+
 def clean_keywords(keywords: Dict[int, List[str]]) -> Dict[int, List[str]]:
-    for key, value in keywords.items():
-        for keyword in value:
-            if (
-                keyword == ""
-                or keyword == " "
-                or len(keyword) < 2
-                or keyword.isdigit()
-                or len(keyword) > 15
-            ):
-                value.remove(keyword)
-    return keywords
+    return {
+        key: [keyword for keyword in value if is_keyword(keyword)]
+        for key, value in keywords.items()
+    }
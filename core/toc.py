@@ -0,0 +1,85 @@
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from config.cfg import TOC_METRICS_PATH
+from config.logger import logger
+from core.text_extractor import TextExtractor
+from core.util_functions import call_llm_for_toc
+
+
+@dataclass
+class TocResolution:
+    toc: List[dict] = field(default_factory=list)
+    # Pages holding the printed ToC, left out of the keywords
+    pages: List = field(default_factory=list)
+    # Stage that found the ToC: "outline", "scan", "llm" or None
+    stage: Optional[str] = None
+    # Seconds spent in every stage tried
+    timings: Dict[str, float] = field(default_factory=dict)
+
+
+def resolve_toc(text_extractor: TextExtractor, client=None) -> TocResolution:
+    """
+    Resolves the ToC with the cheapest stage that finds it: the outline of
+    the PDF, then a bounded scan of its first pages, then the LLM (only
+    with a client). The latency of every stage is logged and appended to
+    `TOC_METRICS_PATH`.
+    """
+    resolution = TocResolution()
+
+    started = time.perf_counter()
+    toc = text_extractor.outline_toc()
+    resolution.timings["outline"] = time.perf_counter() - started
+    if toc:
+        resolution.toc, resolution.stage = toc, "outline"
+        # The printed ToC is still left out of the keywords, when finding it
+        # needs no extraction
+        if text_extractor.analysis is not None:
+            _, resolution.pages = text_extractor.scan_toc()
+        return record_resolution(text_extractor.path, resolution)
+
+    started = time.perf_counter()
+    toc, pages = text_extractor.scan_toc()
+    resolution.timings["scan"] = time.perf_counter() - started
+    if toc and pages:
+        resolution.toc, resolution.pages, resolution.stage = toc, pages, "scan"
+        return record_resolution(text_extractor.path, resolution)
+
+    if client is not None:
+        logger.info("TOC not found. Using LLM to generate TOC...")
+        started = time.perf_counter()
+        resolution.toc, resolution.pages = call_llm_for_toc(
+            path=text_extractor.path, client=client
+        )
+        resolution.timings["llm"] = time.perf_counter() - started
+        resolution.stage = "llm"
+    return record_resolution(text_extractor.path, resolution)
+
+
+def record_resolution(path: str, resolution: TocResolution) -> TocResolution:
+    timings = {
+        stage: round(seconds, 4) for stage, seconds in resolution.timings.items()
+    }
+    logger.info(
+        f"ToC resolved by '{resolution.stage}' with {len(resolution.toc)} entries "
+        f"in {sum(resolution.timings.values()):.3f}s: {timings}"
+    )
+    try:
+        with open(TOC_METRICS_PATH, "a") as file:
+            file.write(
+                json.dumps(
+                    {
+                        "document": os.path.basename(path),
+                        "stage": resolution.stage,
+                        "entries": len(resolution.toc),
+                        "timings": timings,
+                    }
+                )
+                + "\n"
+            )
+    except OSError as e:
+        logger.warning(f"Error saving the ToC metrics: {e}")
+    return resolution
@@ -1,21 +1,39 @@
+import asyncio
 import json
 import os
 import re
-from typing import List
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 import nltk
 import yaml
 from dotenv import load_dotenv
 from nltk.corpus import stopwords
 
-from config.cfg import AGENTS_DIR, MAX_HISTORY_TOKENS, REQUIRED_DIRS
+from config.cfg import AGENTS_DIR, REQUIRED_DIRS, VECTOR_STORE
 from config.logger import logger
+from core.answer_cache import AnswerCache, AnswerKey, CachedAnswer
+from core.context import (
+    assemble_context,
+    count_payload_tokens,
+    count_text_tokens,
+    estimate_tokens,
+    prompt_budget,
+)
+from core.history import ConversationHistory, count_message_tokens, history_budget
+from core.page_store import PageStore, page_store_path
 
 
 def load_env():
     load_dotenv()
     if os.environ.get("OPENAI_API_KEY") is None:
         raise ValueError("API KEY NOT FOUND")
+    # The local vector store needs no database
+    if VECTOR_STORE != "mongodb":
+        return str(os.environ.get("OPENAI_API_KEY")), None
     if os.environ.get("MONGODB_ATLAS_CLUSTER_URI") is None:
         raise ValueError("MONGODB URI NOT FOUND")
 
@@ -24,11 +42,16 @@ def load_env():
     )
 
 
-def process_question(text: str) -> str:
+@lru_cache(maxsize=None)
+def get_stop_words() -> frozenset:
+    # Checked once per process, the download hits the network
     nltk.download("stopwords", quiet=True)
+    return frozenset(stopwords.words("italian"))
+
 
+def process_question(text: str) -> str:
     # Obtain the Italian stopwords
-    stop_words = set(stopwords.words("italian"))
+    stop_words = get_stop_words()
 
     # Convert text to lowercase
     text = text.lower()
@@ -53,26 +76,17 @@ def load_service_data(service_dir: str) -> str:
         return "Nessuna informazione disponibile"
 
 
-def call_llm_for_question(
-    path: str,
-    question: str,
-    external_knowledge: str,
-    client,
-    model: str = "gpt-4-turbo",
-    temperature: float = 0.5,
-    top_p: float = 0.95,
-    max_tokens: int = 4000,
-    user_type: str = "PM",
-    history: List[str] = None,
-):
+def get_user_type(user_type):
+    if user_type == "PM":
+        return (
+            "un product manager con poca o nessuna conoscenza tecnica dell'applicazione"
+        )
+    else:
+        return "un utente tecnico con conoscenze avanzate in ambito informatico e dell'applicazione"
 
-    def get_user_type(user_type):
-        if user_type == "PM":
-            return "un product manager con poca o nessuna conoscenza tecnica dell'applicazione"
-        else:
-            return "un utente tecnico con conoscenze avanzate in ambito informatico e dell'applicazione"
 
-    service_dir = (
+def get_service_dir(path: str) -> str:
+    return (
         path.split("/")[-1]
         .split(".pdf")[0]
         .lower()
@@ -80,8 +94,18 @@ def call_llm_for_question(
         .replace("\\", "_")
     )
 
-    # print("Message history: ",refactor_history(truncate_history(history, MAX_HISTORY_TOKENS)))
 
+def build_question_payload(
+    service_dir: str,
+    question: str,
+    external_knowledge: str,
+    service_data: str,
+    history: str,
+    temperature: float,
+    top_p: float,
+    max_tokens: int,
+    user_type: str,
+) -> dict:
     # Costruzione del payload
     payload = {
         "messages": [
@@ -96,7 +120,7 @@ def call_llm_for_question(
                 Il tuo compito è rispondere in modo chiaro, conciso e informativo, adattando il tuo linguaggio al livello di conoscenza dell'utente.
 
                 Ecco le informazioni principali che conosci sul servizio "{service_dir}":
-                {load_service_data(service_dir)}
+                {service_data}
 
                 Usa queste informazioni come base per rispondere alle domande dell'utente.
                 Se non hai abbastanza informazioni nella tua knowledge base, utilizza le informazioni fornite dall'utente o comunica chiaramente che non puoi rispondere.
@@ -109,7 +133,7 @@ def call_llm_for_question(
                 {question}
 
                 Data la conversazione precedente:
-                {refactor_history(truncate_history(history, MAX_HISTORY_TOKENS))}
+                {history}
 
                 Date le informazioni estratte dal documento correlato:
                 {external_knowledge}
@@ -123,9 +147,87 @@ def call_llm_for_question(
         "top_p": top_p,
         "max_tokens": max_tokens,
     }
+    return payload
 
-    with open("./chatbot_output/payload.json", "w") as file:
-        json.dump(payload, file, ensure_ascii=False, indent=4)
+
+def pack_question_payload(
+    service_dir: str,
+    question: str,
+    external_knowledge,
+    service_data: str,
+    history: str,
+    temperature: float,
+    top_p: float,
+    max_tokens: int,
+    user_type: str,
+    model: str,
+) -> dict:
+    """
+    `build_question_payload` with the search results assembled into a
+    context fitting the prompt budget of the model, after the system prompt,
+    the history and the question. A context already formatted is used as is.
+    """
+    fields = dict(
+        service_dir=service_dir,
+        question=question,
+        service_data=service_data,
+        history=history,
+        temperature=temperature,
+        top_p=top_p,
+        max_tokens=max_tokens,
+        user_type=user_type,
+    )
+    if isinstance(external_knowledge, str):
+        return build_question_payload(external_knowledge=external_knowledge, **fields)
+
+    base_tokens = count_payload_tokens(
+        build_question_payload(external_knowledge="", **fields), model
+    )
+    context = assemble_context(
+        external_knowledge,
+        query_terms=set(process_question(question).split()),
+        model=model,
+        max_tokens=max(prompt_budget(model) - base_tokens, 0),
+    )
+    # Tokenizing the raw results only for the log would cost as much as the
+    # assembly, their count is estimated
+    logger.info(
+        f"Prompt tokens: ~{base_tokens + estimate_tokens(str(external_knowledge))}"
+        f" with the raw results, {base_tokens + count_text_tokens(context, model)}"
+        f" with the assembled context"
+    )
+    return build_question_payload(external_knowledge=context, **fields)
+
+
+def call_llm_for_question(
+    path: str,
+    question: str,
+    external_knowledge: str,
+    client,
+    model: str = "gpt-4-turbo",
+    temperature: float = 0.5,
+    top_p: float = 0.95,
+    max_tokens: int = 4000,
+    user_type: str = "PM",
+    history: List[str] = None,
+):
+    service_dir = get_service_dir(path)
+
+    payload = pack_question_payload(
+        service_dir=service_dir,
+        question=question,
+        external_knowledge=external_knowledge,
+        service_data=load_service_data(service_dir),
+        history=refactor_history(
+            truncate_history(history, history_budget(model), model)
+        ),
+        temperature=temperature,
+        top_p=top_p,
+        max_tokens=max_tokens,
+        user_type=user_type,
+        model=model,
+    )
+    save_payload(payload)
 
     # Model call
     response = client.chat.completions.create(
@@ -140,6 +242,216 @@ def call_llm_for_question(
                 yield content
 
 
+async def acall_llm_for_question(
+    path: str,
+    question: str,
+    external_knowledge: str,
+    client,
+    model: str = "gpt-4-turbo",
+    temperature: float = 0.5,
+    top_p: float = 0.95,
+    max_tokens: int = 4000,
+    user_type: str = "PM",
+    history: List[str] = None,
+    service_data: str = None,
+    history_text: str = None,
+):
+    """
+    Async variant of `call_llm_for_question` for an `openai.AsyncClient`.
+    The service data and the formatted history can be given when they were
+    prepared beforehand (see `aprepare_question`).
+    """
+    service_dir = get_service_dir(path)
+    if service_data is None:
+        service_data = await asyncio.to_thread(load_service_data, service_dir)
+    if history_text is None:
+        history_text = refactor_history(
+            truncate_history(history, history_budget(model), model)
+        )
+
+    # Tokenizing the results would block the loop
+    payload = await asyncio.to_thread(
+        pack_question_payload,
+        service_dir=service_dir,
+        question=question,
+        external_knowledge=external_knowledge,
+        service_data=service_data,
+        history=history_text,
+        temperature=temperature,
+        top_p=top_p,
+        max_tokens=max_tokens,
+        user_type=user_type,
+        model=model,
+    )
+    # The payload is only a debugging aid, it's not worth delaying the call
+    saved = asyncio.get_running_loop().run_in_executor(None, save_payload, payload)
+    saved.add_done_callback(log_save_error)
+
+    response = await client.chat.completions.create(
+        model=model, messages=payload["messages"], max_tokens=max_tokens, stream=True
+    )
+    async for chunk in response:
+        if chunk is not None and chunk.choices:
+            content = chunk.choices[0].delta.content
+            if content is not None:
+                yield content
+
+
+async def aprepare_question(
+    db,
+    path: str,
+    question: str,
+    top_k: int,
+    history: ConversationHistory = None,
+    model: str = "gpt-4-turbo",
+):
+    """
+    Runs the independent steps before the chat call concurrently: the
+    retrieval (question cleaning, query embedding and search) and the loading
+    of the service data. The history is already tokenized, so it's formatted
+    within the budget of the model in the meantime.
+
+    Returns the search results, the service data and the formatted history.
+    """
+
+    async def retrieve():
+        query_text = await asyncio.to_thread(process_question, question)
+        return await db.aquery_with_keyword_filter(
+            query_text=query_text,
+            top_k=top_k,
+            keyword_filter=question.split(" "),
+            lexical_query=question,
+        )
+
+    tasks = asyncio.gather(
+        retrieve(), asyncio.to_thread(load_service_data, get_service_dir(path))
+    )
+    history_text = history.render(model) if history is not None else ""
+    results, service_data = await tasks
+    return results, service_data, history_text
+
+
+async def alookup_answer(
+    db, answer_cache: AnswerCache, key: AnswerKey, question: str, top_k: int
+) -> Tuple[Optional[CachedAnswer], Optional[List[float]], bool]:
+    """
+    Looks the question up in the answer cache. The query is embedded as the
+    retrieval does, so on a miss `aprepare_question` gets the embedding from
+    the memory of the embedding cache instead of the model. Identifier
+    lookups are retrieved without an embedding, so they are matched by their
+    text.
+
+    Returns the cached answer, if any, the embedding of the question and
+    whether its answer can be cached.
+    """
+    embedding = None
+    lexical_only = False
+    try:
+        query_text = await asyncio.to_thread(process_question, question)
+        _, lexical_only = await asyncio.to_thread(
+            db.lexical_search, query_text, top_k, question
+        )
+        if not lexical_only:
+            embedding = await db.embedding_model.aembed_query(query_text.lower())
+    except Exception as e:
+        logger.warning(f"Answer cache skipped: {e}")
+    cacheable = lexical_only or embedding is not None
+    if not cacheable:
+        return None, None, False
+    return answer_cache.lookup(key, embedding, question), embedding, True
+
+
+def save_payload(payload: dict):
+    with open("./chatbot_output/payload.json", "w") as file:
+        json.dump(payload, file, ensure_ascii=False, indent=4)
+
+
+def log_save_error(saved: asyncio.Future):
+    """
+    Logs the error of a `save_payload` running in the background, as
+    nobody awaits it.
+    """
+    if not saved.cancelled() and saved.exception() is not None:
+        logger.error(f"Error saving the payload: {saved.exception()}")
+
+
+@dataclass
+class StreamMetrics:
+    """
+    Time to first token and throughput of a streamed answer, timed from
+    `started_at` (when the question is asked). The tokens are counted with
+    the tokenizer of the chat `model`.
+    """
+
+    model: str
+    started_at: float = field(default_factory=time.perf_counter)
+    first_token_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    tokens: int = 0
+    # Replayed from the answer cache
+    cached: bool = False
+
+    def track(self, chunks: Iterable[str]) -> Iterator[str]:
+        """
+        Yields the chunks of the stream, timing them.
+        """
+        text = []
+        for chunk in chunks:
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+            text.append(chunk)
+            yield chunk
+        self.finished_at = time.perf_counter()
+        self.tokens = count_text_tokens("".join(text), self.model)
+
+    @property
+    def time_to_first_token(self) -> float:
+        return (self.first_token_at or self.finished_at) - self.started_at
+
+    @property
+    def tokens_per_second(self) -> float:
+        elapsed = self.finished_at - (self.first_token_at or self.finished_at)
+        return self.tokens / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "time_to_first_token": round(self.time_to_first_token, 3),
+            "tokens_per_second": round(self.tokens_per_second, 1),
+            "tokens": self.tokens,
+            "cached": self.cached,
+        }
+
+
+class BackgroundLoop:
+    """
+    Event loop running in a daemon thread. The async clients are bound to
+    the loop they first run on, so sharing one loop keeps their connection
+    pools alive across the Streamlit reruns.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def iterate(self, generator):
+        """
+        Iterates an async generator from synchronous code. When the consumer
+        stops early (e.g. a Streamlit rerun interrupts the stream) the
+        generator is closed on the loop, releasing the HTTP response.
+        """
+        try:
+            while True:
+                try:
+                    yield self.run(generator.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.run(generator.aclose())
+
+
 def call_llm_for_toc(
     path: str,
     client,
@@ -227,31 +539,34 @@ def refactor_history(history):
         return str_history
 
 
-def truncate_history(history, max_tokens):
-    # Calculate the number of tokens in the history
+def truncate_history(history, max_tokens, model: str = "gpt-4-turbo"):
+    """
+    Most recent messages of the history fitting `max_tokens`, counted with
+    the tokenizer of the model. See `ConversationHistory` to count every
+    message only once.
+    """
     current_tokens = 0
     truncated_history = []
-    for msg in reversed(history):
-        msg_tokens = len(msg["content"].split())  # Tokenize the message
+    for msg in reversed(history or []):
+        msg_tokens = count_message_tokens(msg, model)
         if current_tokens + msg_tokens > max_tokens:
             break
-        truncated_history.insert(0, msg)
+        truncated_history.append(msg)
         current_tokens += msg_tokens
+    truncated_history.reverse()
     return truncated_history
 
 
 def get_first_pages_text(service_dir: str) -> str:
     full_text = ""
-    for page in range(1, 6):
-        with open(
-            f"extracted_pages/{service_dir}/page_{page}.txt", "r", encoding="utf-8"
-        ) as file:
-            data = file.read()
+    with PageStore(page_store_path(service_dir)) as page_store:
+        for page, data in enumerate(page_store.get_range(1, 6), start=1):
             full_text += "\n PAGE NUMBER " + str(page) + "\n" + data
     return full_text
 
 
 def validate_answer(res: dict) -> tuple:
+    cleaned = res
     if "json" in res[:10] or "python" in res[:10] or "dict" in res[:10]:
         cleaned = (
             res.replace("json", "").replace("python", "").strip().replace("```", "")
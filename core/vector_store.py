@@ -0,0 +1,532 @@
+import abc
+import asyncio
+import os
+import shutil
+import threading
+import unicodedata
+from typing import Dict, List, Optional, Protocol, Tuple
+
+import numpy as np
+
+from config.cfg import (
+    ANN_ENABLED,
+    ANN_MIN_DOCUMENTS,
+    HYBRID_SEARCH,
+    INSERT_BATCH_SIZE,
+    RETRIEVAL_CACHE_MAX_ENTRIES,
+    RRF_DEPTH,
+    VECTOR_STORE,
+)
+from config.logger import logger
+from core.ann_index import IVFIndex, index_path, remove_matrix_files
+from core.bm25 import BM25Index, bm25_index_path, tokenize
+from core.chunking import chunk_page
+from core.embedding_cache import CachedEmbeddings
+from core.embedding_export import (
+    index_dir,
+    new_version,
+    publish_version,
+    read_version,
+)
+from core.embeddings import embed_in_batches
+from core.keyword_index import KeywordIndex, keyword_index_path
+from core.lru import LRUCache
+from core.page_store import PageStore, page_store_path
+from core.quantization import embedding_fields
+from core.scoring import reciprocal_rank_fusion
+
+
+class VectorStore(Protocol):
+    """
+    Storage interface used by the app and by the ingestion pipeline.
+
+    A store owns the process-wide resources (database clients, embedding
+    model, loaded indexes) and is bound to a single collection:
+    `for_collection` returns a handle on another collection sharing them.
+    Handles never change collection, so they can be shared between sessions
+    and threads.
+    """
+
+    embedding_model: CachedEmbeddings
+
+    def collection_exists(self, collection_name: str) -> bool: ...
+
+    def for_collection(self, collection_name: str) -> "VectorStore": ...
+
+    def create_indexes(self): ...
+
+    def insert_in_batches(
+        self, documents: List[Dict], batch_size: int = INSERT_BATCH_SIZE
+    ): ...
+
+    def update_keywords(self, keywords: Dict[int, List[str]]): ...
+
+    def build_indexes(self, keywords: Dict[int, List[str]]): ...
+
+    def process_and_store_pages(self, path: str, keywords: Dict[int, List[str]]): ...
+
+    def query_with_keyword_filter(
+        self,
+        query_text: str,
+        top_k: int = 5,
+        keyword_filter: List[str] = None,
+        lexical_query: str = None,
+    ) -> List[Dict]: ...
+
+    async def aquery_with_keyword_filter(
+        self,
+        query_text: str,
+        top_k: int = 5,
+        keyword_filter: List[str] = None,
+        lexical_query: str = None,
+    ) -> List[Dict]: ...
+
+
+class IndexedStore(abc.ABC):
+    """
+    Search logic shared by the backends: hybrid queries over the ANN, BM25
+    and keyword indexes saved on disk, and the ingestion of the pages of a
+    document.
+
+    The backends store the documents and implement `exact_search`,
+    `fetch_texts`, `load_embeddings` and `load_texts`.
+    """
+
+    collection_name: str
+
+    def __init__(self, embedding_model=None):
+        self.embedding_model = embedding_model or default_embedding_model()
+        # Search indexes loaded from disk, by collection name
+        self.ann_indexes = {}
+        self.bm25_indexes = {}
+        self.keyword_indexes = {}
+        # Shared by the handles: a session loads an index while the others
+        # wait for it, instead of loading it again
+        self.load_lock = threading.Lock()
+        # Results of the queries of the current versions of the collections
+        self.result_cache = LRUCache(RETRIEVAL_CACHE_MAX_ENTRIES)
+
+    @abc.abstractmethod
+    def exact_search(
+        self,
+        query_embedding: List[float],
+        top_k: int,
+        candidates: Optional[np.ndarray],
+        keyword_filter: Optional[List[str]],
+    ) -> List[Dict]:
+        """
+        Scores every document of the candidate pages (all of them when None).
+        `keyword_filter` is only given when the collection has no keyword
+        index yet.
+        """
+
+    @abc.abstractmethod
+    def fetch_texts(self, hits: List[Dict]) -> List[Dict]:
+        """
+        Page, text and score of the winning segment of every hit, in order.
+        """
+
+    @abc.abstractmethod
+    def load_embeddings(self) -> Tuple[np.ndarray, List[int], List[str]]:
+        """
+        Embeddings, pages and ids of every document of the collection.
+        """
+
+    @abc.abstractmethod
+    def load_texts(self) -> Tuple[List[str], List[int], List[str]]:
+        """
+        Texts, pages and ids of every document of the collection.
+        """
+
+    def query_with_keyword_filter(
+        self,
+        query_text: str,
+        top_k: int = 5,
+        keyword_filter: List[str] = None,
+        lexical_query: str = None,
+    ):
+        """
+        Hybrid search: the vector results are fused with the BM25 results of
+        `lexical_query` (default: `query_text`) by reciprocal rank. Queries
+        made only of identifiers found in the collection skip the embedding.
+        """
+        key = self.result_key(query_text, top_k, keyword_filter, lexical_query)
+        cached = self.cached_results(key)
+        if cached is not None:
+            return cached
+        try:
+            lexical_hits, lexical_only = self.lexical_search(
+                query_text, top_k, lexical_query
+            )
+            if lexical_only:
+                logger.info("Lexical query: the embedding is skipped")
+                return self.cache_results(key, self.fetch_texts(lexical_hits[:top_k]))
+
+            # Generate query embedding
+            query_embedding = self.embedding_model.embed_query(query_text.lower())
+            return self.cache_results(
+                key,
+                self.hybrid_search(
+                    query_embedding, top_k, keyword_filter, lexical_hits
+                ),
+            )
+
+        except Exception as e:
+            logger.error(f"Errore durante l'esecuzione della query: {e}")
+            return []
+
+    async def aquery_with_keyword_filter(
+        self,
+        query_text: str,
+        top_k: int = 5,
+        keyword_filter: List[str] = None,
+        lexical_query: str = None,
+    ):
+        """
+        Async variant of `query_with_keyword_filter`: the query embedding is
+        awaited and the searches run in worker threads, so the event loop
+        is free to prepare the prompt meanwhile.
+        """
+        key = self.result_key(query_text, top_k, keyword_filter, lexical_query)
+        cached = self.cached_results(key)
+        if cached is not None:
+            return cached
+        try:
+            lexical_hits, lexical_only = await asyncio.to_thread(
+                self.lexical_search, query_text, top_k, lexical_query
+            )
+            if lexical_only:
+                logger.info("Lexical query: the embedding is skipped")
+                return self.cache_results(
+                    key,
+                    await asyncio.to_thread(self.fetch_texts, lexical_hits[:top_k]),
+                )
+
+            query_embedding = await self.embedding_model.aembed_query(
+                query_text.lower()
+            )
+            return self.cache_results(
+                key,
+                await asyncio.to_thread(
+                    self.hybrid_search,
+                    query_embedding,
+                    top_k,
+                    keyword_filter,
+                    lexical_hits,
+                ),
+            )
+
+        except Exception as e:
+            logger.error(f"Errore durante l'esecuzione della query: {e}")
+            return []
+
+    def hybrid_search(
+        self,
+        query_embedding: List[float],
+        top_k: int,
+        keyword_filter: Optional[List[str]],
+        lexical_hits: List[Dict],
+    ) -> List[Dict]:
+        """
+        Vector search of the query embedding, fused with the BM25 hits. More
+        vector hits are kept when there are lexical ones to fuse them with.
+        """
+        vector_hits = self.vector_search(
+            query_embedding,
+            top_k=max(top_k, RRF_DEPTH) if lexical_hits else top_k,
+            keyword_filter=keyword_filter,
+        )
+        return self.fuse(vector_hits, lexical_hits, top_k)
+
+    def result_key(
+        self,
+        query_text: str,
+        top_k: int,
+        keyword_filter: Optional[List[str]],
+        lexical_query: Optional[str],
+    ) -> Optional[tuple]:
+        """
+        Key of the results of a query on the current version of the
+        collection, None while it's being ingested (no version yet). The
+        version is replaced atomically once the indexes are rebuilt, so
+        results of an older ingestion never match.
+        """
+        version = read_version(self.collection_name)
+        if version is None:
+            return None
+        return (
+            self.collection_name,
+            version,
+            " ".join(query_text.lower().split()),
+            top_k,
+            tuple(keyword_filter or ()),
+            " ".join((lexical_query or "").lower().split()),
+        )
+
+    def cached_results(self, key: Optional[tuple]) -> Optional[List[Dict]]:
+        if key is None:
+            return None
+        results = self.result_cache.get(key)
+        if results is None:
+            return None
+        logger.debug(f"Retrieval cache hit: {self.result_cache.stats()}")
+        # Copies, the callers may modify the results
+        return [dict(result) for result in results]
+
+    def cache_results(self, key: Optional[tuple], results: List[Dict]) -> List[Dict]:
+        if key is not None:
+            self.result_cache.put(key, [dict(result) for result in results])
+        return results
+
+    def lexical_search(
+        self, query_text: str, top_k: int, lexical_query: str = None
+    ) -> Tuple[List[Dict], bool]:
+        """
+        BM25 hits of the query, and whether they are enough on their own
+        (see `BM25Index.is_lexical_query`).
+        """
+        bm25_index = self.get_bm25_index()
+        if bm25_index is None:
+            return [], False
+        terms = tokenize(lexical_query or query_text)
+        lexical_hits = bm25_index.search(terms, top_k=max(top_k, RRF_DEPTH))
+        return lexical_hits, bool(lexical_hits) and bm25_index.is_lexical_query(terms)
+
+    def fuse(
+        self, vector_hits: List[Dict], lexical_hits: List[Dict], top_k: int
+    ) -> List[Dict]:
+        if lexical_hits:
+            return self.fetch_texts(
+                reciprocal_rank_fusion([vector_hits, lexical_hits], top_k)
+            )
+        return self.fetch_texts(vector_hits)
+
+    def vector_search(
+        self, query_embedding: List[float], top_k: int, keyword_filter: List[str]
+    ) -> List[Dict]:
+        # Candidate pages from the posting lists of the keywords
+        candidates = None
+        keyword_index = self.get_keyword_index()
+        if keyword_filter and keyword_index is not None:
+            candidates = keyword_index.union(kw.lower() for kw in keyword_filter)
+            # Fall back to all the documents when the filter matches nothing
+            if len(candidates) == 0:
+                candidates = None
+
+        ann_index = self.get_ann_index()
+        if ann_index is not None:
+            return self.query_ann_index(ann_index, query_embedding, top_k, candidates)
+
+        return self.exact_search(
+            query_embedding,
+            top_k,
+            candidates,
+            keyword_filter if keyword_index is None else None,
+        )
+
+    def get_ann_index(self) -> Optional[IVFIndex]:
+        """
+        Lazily loads the ANN index of the current collection. Returns None
+        when the collection has no index (e.g. it is too small).
+        """
+        if not ANN_ENABLED:
+            return None
+        return self.load_index(self.ann_indexes, index_path, IVFIndex)
+
+    def get_bm25_index(self) -> Optional[BM25Index]:
+        if not HYBRID_SEARCH:
+            return None
+        return self.load_index(self.bm25_indexes, bm25_index_path, BM25Index)
+
+    def get_keyword_index(self) -> Optional[KeywordIndex]:
+        return self.load_index(self.keyword_indexes, keyword_index_path, KeywordIndex)
+
+    def load_index(self, loaded: dict, index_path_of, index_class):
+        """
+        Loads an index of the current collection from disk the first time it
+        is needed, and again once the collection is ingested anew (by any
+        process). Returns None when the collection has no such index.
+        """
+        name = self.collection_name
+        version = read_version(name)
+        if name in loaded and loaded[name][0] == version:
+            return loaded[name][1]
+        with self.load_lock:
+            if name not in loaded or loaded[name][0] != version:
+                path = index_path_of(name)
+                index = index_class.load(path) if os.path.exists(path) else None
+                if index is not None:
+                    logger.info(f"Loaded {index_class.__name__} of collection '{name}'")
+                loaded[name] = (version, index)
+            return loaded[name][1]
+
+    def query_ann_index(
+        self,
+        ann_index: IVFIndex,
+        query_embedding: List[float],
+        top_k: int,
+        candidates: np.ndarray = None,
+    ) -> List[Dict]:
+        mask = ann_index.page_mask(candidates)
+        if mask is not None and mask.sum() < ANN_MIN_DOCUMENTS:
+            # Few documents match the filter: an exact scan is cheaper
+            return ann_index.search(
+                query_embedding, top_k, n_probe=ann_index.n_lists, mask=mask
+            )
+        return ann_index.search(query_embedding, top_k, mask=mask)
+
+    def build_bm25_index(self):
+        name = self.collection_name
+        self.bm25_indexes.pop(name, None)
+        texts, pages, ids = self.load_texts()
+        BM25Index.build(texts=texts, pages=pages, ids=ids).save(bm25_index_path(name))
+
+    def build_keyword_index(self, keywords: Dict[int, List[str]]):
+        name = self.collection_name
+        self.keyword_indexes.pop(name, None)
+        KeywordIndex.build(keywords).save(keyword_index_path(name))
+
+    def build_indexes(self, keywords: Dict[int, List[str]]):
+        """
+        Builds the search indexes of the current collection once its
+        documents are stored, then stamps them with a new version so that
+        every process reloads them.
+        """
+        version = new_version()
+        matrix = self.build_ann_index()
+        self.build_bm25_index()
+        self.build_keyword_index(keywords)
+        self.export(version)
+        publish_version(self.collection_name, version)
+        # The processes still on the previous version may be mapping its
+        # matrix until they see the new one
+        remove_matrix_files(index_path(self.collection_name), keep=matrix)
+
+    def export(self, version: str):
+        """
+        Writes a snapshot of the collection for the given version, for the
+        backends that need one to serve queries without the database.
+        """
+
+    def build_ann_index(self) -> Optional[str]:
+        """
+        Builds and saves the ANN index of the current collection. Small
+        collections are not indexed and are searched exactly. Returns the
+        path of the saved matrix, None when the collection is not indexed.
+        """
+        name = self.collection_name
+        path = index_path(name)
+        self.ann_indexes.pop(name, None)
+
+        embeddings, pages, ids = self.load_embeddings()
+        if not ANN_ENABLED or len(pages) < ANN_MIN_DOCUMENTS:
+            if os.path.exists(path):
+                os.remove(path)
+            logger.info(
+                f"Collection '{name}' has {len(pages)} documents: exact search will be used"
+            )
+            return None
+
+        return IVFIndex.build(embeddings=embeddings, pages=pages, ids=ids).save(path)
+
+    def process_and_store_pages(self, path: str, keywords: Dict[int, List[str]]):
+        """
+        Process and store pages in the database with their embeddings and keywords.
+
+        Args:
+            path (str): Path of the PDF, whose pages are read from its page store.
+            keywords (Dict[int, List[str]]): Dictionary mapping page numbers to keywords.
+        """
+        service_dir = (
+            path.split("/")[-1]
+            .split(".pdf")[0]
+            .lower()
+            .replace("/", "_")
+            .replace("\\", "_")
+        )
+        self.create_indexes()
+
+        documents = []
+        filename = page_store_path(service_dir)
+        with PageStore(filename) as page_store:
+            for x in range(len(page_store)):
+                try:
+                    # Clean the text
+                    cleaned_data = clean_text(page_store[x])
+
+                    # Extract keywords for the current page
+                    page_keywords = sorted(keywords.get(x, []))
+
+                    # Split the page in chunks sharing its keywords
+                    documents.extend(
+                        chunk_page(
+                            x,
+                            cleaned_data,
+                            keywords=page_keywords,
+                            filename=filename,
+                        )
+                    )
+                except Exception as e:
+                    logger.error(f"Error processing {filename} (Page {x}): {e}")
+
+        # Generate the embeddings with batched, concurrent requests
+        embeddings = embed_in_batches(
+            self.embedding_model, [doc["text"] for doc in documents]
+        )
+        embedded_documents = []
+        for doc, embedding in zip(documents, embeddings):
+            if embedding is None:
+                logger.error(f"Error processing {doc['filename']} (Page {doc['page']})")
+                continue
+            doc.update(embedding_fields(embedding))
+            embedded_documents.append(doc)
+
+        self.insert_in_batches(embedded_documents)
+        logger.info(f"Embedding cache: {self.embedding_model.cache.stats()}")
+
+        self.build_indexes(keywords)
+
+
+def default_embedding_model() -> CachedEmbeddings:
+    from langchain_openai import OpenAIEmbeddings
+
+    return CachedEmbeddings(OpenAIEmbeddings())
+
+
+def remove_indexes(collection_name: str):
+    """
+    Removes the search indexes saved for a collection, e.g. once it is dropped.
+    """
+    shutil.rmtree(index_dir(collection_name), ignore_errors=True)
+
+
+def create_vector_store(
+    backend: str = VECTOR_STORE, uri: str = None, **kwargs
+) -> VectorStore:
+    """
+    Returns the configured backend: "mongodb" (MongoDB Atlas, at `uri`) or
+    "local" (NumPy arrays memory-mapped from disk, no server needed).
+    """
+    # Each backend only imports its own dependencies
+    if backend == "mongodb":
+        from core.database import MongoDb
+
+        return MongoDb(uri=uri or os.environ.get("MONGODB_ATLAS_CLUSTER_URI"), **kwargs)
+    if backend == "local":
+        from core.local_store import LocalVectorStore
+
+        return LocalVectorStore(**kwargs)
+    raise ValueError(f"Unknown vector store '{backend}'")
+
+
+def clean_text(text):
+    """
+    Rimuove i caratteri speciali e normalizza il testo.
+    """
+    # Remove non-printable characters
+    text = "".join(char for char in text if char.isprintable())
+    # Normalize text
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("utf-8")
+    # Remove extra whitespaces
+    text = " ".join(text.split())
+    return text
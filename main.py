@@ -5,16 +5,23 @@ import openai
 import yaml
 import streamlit as st
 
-from config.cfg import FAQ
+from config.cfg import ANSWER_CACHE_ENABLED, FAQ
 from config.logger import logger
-from core.database import MongoDb
+from core.answer_cache import AnswerCache, AnswerKey, history_digest, replay
+from core.embedding_export import read_version
+from core.history import ConversationHistory
+from core.ingestion import IngestionPipeline
 from core.text_extractor import TextExtractor
+from core.toc import resolve_toc
+from core.vector_store import create_vector_store
 from core.util_functions import (
-    call_llm_for_question,
-    call_llm_for_toc,
+    BackgroundLoop,
+    StreamMetrics,
+    acall_llm_for_question,
+    alookup_answer,
+    aprepare_question,
     create_required_folders,
     load_env,
-    process_question,
 )
 from dotenv import load_dotenv
 
@@ -43,6 +50,37 @@ def initialize_session_state():
         st.session_state.user_type = "PM"
     if "message_ratings" not in st.session_state:
         st.session_state.message_ratings = {}
+    if "history" not in st.session_state:
+        st.session_state.history = ConversationHistory.from_messages(
+            st.session_state.messages, st.session_state.model
+        )
+
+
+@st.cache_resource
+def get_clients(mongodb_uri: str):
+    """
+    Creates the OpenAI client and the vector store (with its connection pool
+    and embedding model) once per process. Both are thread-safe: sessions
+    query their collections through `db.for_collection`.
+    """
+    logger.info("Creating the shared clients...")
+    return openai.Client(), create_vector_store(uri=mongodb_uri)
+
+
+@st.cache_resource
+def get_async_runtime():
+    """
+    Async OpenAI client of the question path, with the event loop it runs on.
+    """
+    return openai.AsyncClient(), BackgroundLoop()
+
+
+@st.cache_resource
+def get_answer_cache() -> AnswerCache:
+    """
+    Answers shared by all the sessions of the process.
+    """
+    return AnswerCache()
 
 
 # Funzione per caricare il file .env
@@ -67,51 +105,137 @@ def load_env_file():
 @st.cache_data
 def process_pdf(_client):
     text_extract = TextExtractor(path=st.session_state.local_file_path)
+    # Parse the PDF once, the following steps reuse the analysis
+    text_extract.analyze()
     full_text = text_extract.extract_full_text()
-    logger.info("Extracting TOC and keywords manually...")
-    toc, pages = text_extract.generate_toc()
-
-    if len(pages) == 0 or len(toc) == 0:
-        logger.info("TOC not found. Using LLM to generate TOC...")
-        toc, pages = call_llm_for_toc(
-            path=st.session_state.local_file_path, client=_client
-        )
-
-    keywords = text_extract.extract_keywords(pages=pages)
-    return toc, full_text, keywords
+    logger.info("Resolving the TOC and extracting the keywords...")
+    resolution = resolve_toc(text_extract, client=_client)
 
+    keywords = text_extract.extract_keywords(pages=resolution.pages)
+    return resolution.toc, full_text, keywords
 
-@st.cache_data
-def save_vectors(_db):
-    # Check if the collection exists
-    if not _db.collection_exists(collection_name=st.session_state.collection_name):
-        logger.info(
-            f"Collection {st.session_state.collection_name} does not exist. Creating it..."
-        )
-        _db.process_and_store_pages(
-            path=st.session_state.local_file_path, keywords=st.session_state.keywords
-        )
-
-    else:
-        # Set up MongoDB with the collection name
-        _db.change_collection(collection_name=st.session_state.collection_name)
-        logger.info(f"Collection in use: {st.session_state.collection_name}.")
-        st.session_state.db = _db
 
+def start_ingestion(db, client) -> IngestionPipeline:
+    logger.info(
+        f"Collection {st.session_state.collection_name} does not exist. Streaming the pages into it..."
+    )
+    st.session_state.ingestion = IngestionPipeline(
+        db=db,
+        path=st.session_state.local_file_path,
+        collection_name=st.session_state.collection_name,
+        client=client,
+    ).start()
+    get_answer_cache().invalidate(st.session_state.collection_name)
+    return st.session_state.ingestion
+
+
+@st.fragment(run_every=2)
+def display_ingestion_progress():
+    pipeline = st.session_state.ingestion
+    if pipeline.status.done:
+        # Show the ToC and the summary
+        st.rerun()
 
-def query_db(user_question, db):
-    logger.info("Database not found. Creating a new instance...")
-    db.change_collection(collection_name=st.session_state.collection_name)
+    with st.expander("⏳ Ingestion", expanded=True):
+        status = pipeline.status
+        total = status.total_pages or 1
+        st.progress(min(status.processed["store"] / total, 1.0))
+        st.markdown("\n".join(f"- {line}" for line in pipeline.progress()))
+        if status.queryable:
+            st.caption(f"Pages up to {status.ready_up_to} can already be queried.")
+
+
+def add_message(role: str, content: str, **fields):
+    """
+    Appends a message to the chat and to the history sent to the model,
+    where it's tokenized once.
+    """
+    st.session_state.messages.append({"role": role, "content": content, **fields})
+    st.session_state.history.append(role, content, st.session_state.model)
+
+
+def answer_question(question, db):
+    """
+    Retrieves the context of the question and starts streaming the answer.
+    The retrieval, the service data and the history are prepared
+    concurrently before the chat call.
+
+    Returns the search results, an iterator over the chunks of the answer
+    and the metrics of the answer, timed from now. Answers to similar
+    questions are replayed from the answer cache.
+    """
+    metrics = StreamMetrics(model=st.session_state.model)
+    async_client, loop = get_async_runtime()
+    # Handles are bound to a collection, the shared store is never modified
+    db = db.for_collection(st.session_state.collection_name)
     st.session_state.db = db
 
-    return db.query_with_keyword_filter(
-        query_text=process_question(text=user_question),
+    answer_cache = get_answer_cache()
+    # The question itself is the last message of the history
+    earlier_messages = st.session_state.history.window(st.session_state.model)[:-1]
+    key = AnswerKey(
+        collection_name=st.session_state.collection_name,
+        version=read_version(st.session_state.collection_name),
+        model=st.session_state.model,
+        temperature=st.session_state.temperature,
+        top_p=st.session_state.top_p,
+        max_tokens=st.session_state.max_tokens,
+        user_type=st.session_state.user_type,
         top_k=st.session_state.top_k,
-        keyword_filter=user_question.split(" "),
+        history=history_digest(earlier_messages),
     )
+    path = st.session_state.local_file_path
+    top_k = st.session_state.top_k
+    history = st.session_state.history
+    model = st.session_state.model
+
+    async def prepare():
+        # The lookup embeds the question, the retrieval reuses the embedding
+        cached, embedding, cacheable = None, None, False
+        if ANSWER_CACHE_ENABLED:
+            cached, embedding, cacheable = await alookup_answer(
+                db, answer_cache, key, question, top_k
+            )
+        if cached is not None:
+            return cached, embedding, cacheable, None
+        prepared = await aprepare_question(
+            db=db,
+            path=path,
+            question=question,
+            top_k=top_k,
+            history=history,
+            model=model,
+        )
+        return cached, embedding, cacheable, prepared
+
+    cached, embedding, cacheable, prepared = loop.run(prepare())
+    if cached is not None:
+        metrics.cached = True
+        return cached.results, replay(cached.answer), metrics
+
+    results, service_data, history_text = prepared
+    stream = loop.iterate(
+        acall_llm_for_question(
+            path=st.session_state.local_file_path,
+            question=question,
+            external_knowledge=results,
+            client=async_client,
+            model=st.session_state.model,
+            temperature=st.session_state.temperature,
+            top_p=st.session_state.top_p,
+            max_tokens=st.session_state.max_tokens,
+            user_type=st.session_state.user_type,
+            service_data=service_data,
+            history_text=history_text,
+        )
+    )
+    # Answers are stored once the collection is fully indexed
+    if cacheable and key.version is not None:
+        stream = answer_cache.record(stream, key, embedding, question, results)
+    return results, stream, metrics
 
 
-def create_sidebar_configuration(db, client):
+def create_sidebar_configuration(db):
     # File Upload Section
     with st.sidebar:
         with st.expander("📄 File", expanded=True):
@@ -215,10 +339,10 @@ def create_sidebar_configuration(db, client):
                 step=256,
             )
 
-    create_faq_section(db=db, client=client)
+    create_faq_section(db=db)
 
 
-def create_faq_section(db, client):
+def create_faq_section(db):
     if st.session_state.get("collection_name") in FAQ:
         with st.sidebar.expander("❓ FAQ", expanded=True):
             st.markdown(f"### {st.session_state.collection_name}")
@@ -232,37 +356,9 @@ def create_faq_section(db, client):
                             "⚠️ Upload a PDF file to start the conversation."
                         )
                         return
-                    # Simulate chat input when button is clicked
-                    st.session_state.messages.append(
-                        {"role": "user", "content": question}
-                    )
-                    # Get response
-                    results = query_db(question, db)
-                    display_vector_results(results, question)
-
-                    message_history = st.session_state.messages.copy()
-
-                    # Generate assistant response
-                    streamed_text = ""
-                    for chunk in call_llm_for_question(
-                        path=st.session_state.local_file_path,
-                        question=question,
-                        external_knowledge=results,
-                        client=client,
-                        model=st.session_state.model,
-                        temperature=st.session_state.temperature,
-                        top_p=st.session_state.top_p,
-                        max_tokens=st.session_state.max_tokens,
-                        user_type=st.session_state.user_type,
-                        history=message_history,
-                    ):
-                        streamed_text += chunk
-
-                    st.session_state.messages.append(
-                        {"role": "assistant", "content": streamed_text}
-                    )
-                    # Force a rerun to update the chat
-                    st.rerun()
+                    # Simulate chat input when button is clicked: the chat
+                    # streams the answer
+                    st.session_state.faq_question = question
 
 
 def display_feedback_section():
@@ -357,26 +453,55 @@ def display_feedback_section():
 
 
 def display_vector_results(results: list, question: str):
+    """
+    Returns a placeholder for the metrics of the answer, filled once it is
+    streamed.
+    """
     with st.sidebar:
         with st.expander("🔍 Vector Search Results", expanded=True):
             st.markdown("### {}".format(question))
+            metrics_placeholder = st.empty()
             for i, result in enumerate(results, 1):
                 st.markdown(
                     f"""
                 **Result {i}**
                 - 📄 Page: {result['page']}
-                - 🎯 Score: {result['score']:.4f}
+                - 🎯 Relevance (RRF): {result['score']:.4f}
                 ---
                 """
                 )
+    return metrics_placeholder
 
 
-def display_chat(db, client):
+def display_stream_metrics(placeholder, metrics: StreamMetrics):
+    placeholder.markdown(
+        f"""
+        - ⏱️ Time to first token: {metrics.time_to_first_token:.2f}s
+        - ⚡ Tokens/s: {metrics.tokens_per_second:.1f} ({metrics.tokens} tokens)
+        {"- ♻️ Served from the answer cache" if metrics.cached else ""}
+        """
+    )
+
+
+def display_chat(db):
     if "collection_name" not in st.session_state:
         st.warning("⚠️ Upload a PDF file to start the conversation.")
         return
 
-    if st.session_state.get("toc"):
+    # While streaming, the pages already stored can be queried
+    pipeline = st.session_state.get("ingestion")
+    if pipeline is not None and not pipeline.status.done:
+        if not pipeline.status.queryable:
+            st.info("⏳ The document is being processed, please wait...")
+            return
+        st.info(
+            f"⏳ The document is being processed: pages up to "
+            f"{pipeline.status.ready_up_to} can already be queried."
+        )
+
+    if st.session_state.get("toc") or (
+        pipeline is not None and pipeline.status.queryable
+    ):
         if "messages" not in st.session_state:
             st.session_state["messages"] = [
                 {"role": "assistant", "content": "How can I help you?"}
@@ -389,40 +514,27 @@ def display_chat(db, client):
             for idx, msg in enumerate(st.session_state.messages):
                 st.chat_message(msg["role"]).write(msg["content"])
 
-        # Handle new messages
-        if question := st.chat_input():
+        # Handle new messages, typed or chosen among the FAQ
+        question = st.chat_input() or st.session_state.pop("faq_question", None)
+        if question:
             # Add user message
-            st.session_state.messages.append({"role": "user", "content": question})
+            add_message("user", question)
             st.chat_message("user").write(question)
 
             # Process response
             with st.spinner("Analizying the question..."):
-                results = query_db(question, db)
+                results, stream, metrics = answer_question(question, db)
                 # Display vector search results in sidebar
-                display_vector_results(results, question)
-
-            message_history = st.session_state.messages.copy()
-
-            # Generate and display assistant response
-            streamed_text = ""
-            for chunk in call_llm_for_question(
-                path=st.session_state.local_file_path,
-                question=question,
-                external_knowledge=results,
-                client=client,
-                model=st.session_state.model,
-                temperature=st.session_state.temperature,
-                top_p=st.session_state.top_p,
-                max_tokens=st.session_state.max_tokens,
-                user_type=st.session_state.user_type,
-                history=message_history,
-            ):
-                streamed_text += chunk
-
-            st.session_state.messages.append(
-                {"role": "assistant", "content": streamed_text}
+                metrics_placeholder = display_vector_results(results, question)
+
+            # Display the assistant response as it is generated
+            streamed_text = st.chat_message("assistant").write_stream(
+                metrics.track(stream)
             )
-            st.rerun()
+            display_stream_metrics(metrics_placeholder, metrics)
+            logger.info(f"Answer streamed: {metrics.as_dict()}")
+
+            add_message("assistant", streamed_text, metrics=metrics.as_dict())
 
 
 def main():
@@ -445,26 +557,42 @@ def main():
 
     OPENAI_API_KEY, MONGODB_ATLAS_CLUSTER_URI = load_env()
 
-    # Create client and database instances
-    client = openai.Client()
-    db = MongoDb(MONGODB_ATLAS_CLUSTER_URI)
+    # Clients shared by every session and rerun
+    client, db = get_clients(MONGODB_ATLAS_CLUSTER_URI)
 
     # Create sidebar
-    create_sidebar_configuration(db=db, client=client)
+    create_sidebar_configuration(db=db)
 
     # Handle file processing
     if st.session_state.local_file_path:
 
-        with st.spinner("Generating TOC and keywords..."):
-            toc, full_text, keywords = process_pdf(_client=client)
+        pipeline = st.session_state.get("ingestion")
+        if pipeline is None or pipeline.path != st.session_state.local_file_path:
+            if db.collection_exists(collection_name=st.session_state.collection_name):
+                logger.info(f"Collection in use: {st.session_state.collection_name}.")
+                pipeline = st.session_state.ingestion = None
+            else:
+                pipeline = start_ingestion(db=db, client=client)
+
+        if pipeline is not None:
+            # The pages are being streamed into the database
+            if not pipeline.status.done:
+                with st.sidebar:
+                    display_ingestion_progress()
+            elif pipeline.status.error:
+                st.error(f"Error processing the document: {pipeline.status.error}")
+            toc = pipeline.toc
             st.session_state.toc = toc
-            st.session_state.full_text = full_text
-            st.session_state.keywords = keywords
+            st.session_state.full_text = pipeline.full_text
+            st.session_state.keywords = pipeline.keywords
+        else:
+            with st.spinner("Generating TOC and keywords..."):
+                toc, full_text, keywords = process_pdf(_client=client)
+                st.session_state.toc = toc
+                st.session_state.full_text = full_text
+                st.session_state.keywords = keywords
 
-        with st.spinner("Saving vectors to the database..."):
-            save_vectors(_db=db)
-            db.change_collection(collection_name=st.session_state.collection_name)
-            st.session_state.db = db
+        st.session_state.db = db.for_collection(st.session_state.collection_name)
 
         with st.sidebar.expander("📚 Summary", expanded=True):
             formatted_toc = "\n".join(
@@ -475,7 +603,7 @@ def main():
             )
             st.markdown(f"### {st.session_state.collection_name}\n{formatted_toc}")
 
-    display_chat(db=db, client=client)
+    display_chat(db=db)
 
     display_feedback_section()
 
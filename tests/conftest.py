@@ -0,0 +1,136 @@
+import re
+import zlib
+
+import mongomock
+import numpy as np
+import pytest
+
+import core.chunking
+import core.database
+import core.embeddings
+from core.chunking import chunk_page
+from core.embedding_cache import CachedEmbeddings, EmbeddingCache
+from core.embeddings import embed_in_batches
+from core.quantization import embedding_fields
+from core.vector_store import create_vector_store
+
+
+class FakeEmbeddings:
+    """
+    Deterministic embeddings (hashed bags of words) that record every text
+    sent to the model.
+    """
+
+    model = "fake-embedding"
+    dimensions = 256
+
+    def __init__(self):
+        self.embedded = []
+
+    def vector(self, text: str):
+        vector = np.zeros(self.dimensions)
+        for word in re.findall(r"\w+", text.lower()):
+            vector[zlib.crc32(word.encode("utf-8")) % self.dimensions] += 1
+        vector[0] += 0.01
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return [self.vector(text) for text in texts]
+
+    def embed_query(self, text):
+        self.embedded.append(text)
+        return self.vector(text)
+
+    async def aembed_query(self, text):
+        return self.embed_query(text)
+
+
+@pytest.fixture
+def fake_embeddings():
+    return FakeEmbeddings()
+
+
+class WhitespaceEncoding:
+    """
+    Stand-in for a tiktoken encoding: one token per word with its trailing
+    whitespace.
+    """
+
+    name = "whitespace"
+
+    def encode(self, text, disallowed_special=()):
+        return re.findall(r"\S+\s*|\s+", text)
+
+    def decode_with_offsets(self, tokens):
+        offsets, position = [], 0
+        for token in tokens:
+            offsets.append(position)
+            position += len(token)
+        return "".join(tokens), offsets
+
+
+@pytest.fixture(autouse=True)
+def whitespace_tokens(monkeypatch):
+    # tiktoken may need to download its encodings
+    encoding = WhitespaceEncoding()
+    for module in (core.embeddings, core.chunking):
+        monkeypatch.setattr(module, "get_encoding", lambda name=None: encoding)
+
+
+@pytest.fixture
+def embedding_model(tmp_path, fake_embeddings):
+    return CachedEmbeddings(
+        fake_embeddings, EmbeddingCache(str(tmp_path / "embeddings.sqlite"))
+    )
+
+
+@pytest.fixture
+def mongo_store(monkeypatch, tmp_path, embedding_model):
+    # The indexes and their versions are written in the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(core.database, "MongoClient", mongomock.MongoClient)
+    return create_vector_store(
+        "mongodb", uri="mongodb://localhost", embedding_model=embedding_model
+    )
+
+
+@pytest.fixture
+def local_store(monkeypatch, tmp_path, embedding_model):
+    monkeypatch.chdir(tmp_path)
+    return create_vector_store(
+        "local", directory=str(tmp_path / "local"), embedding_model=embedding_model
+    )
+
+
+def ingest_pages(store, collection_name, texts, keywords=None):
+    """
+    Stores the pages of a document as the ingestion does, then builds and
+    publishes its indexes. Returns the handle on the collection.
+    """
+    keywords = keywords or {}
+    handle = store.for_collection(collection_name)
+    handle.create_indexes()
+    chunks = [
+        chunk
+        for page, text in enumerate(texts)
+        for chunk in chunk_page(
+            page, text, keywords=keywords.get(page, []), filename=""
+        )
+    ]
+    embeddings = embed_in_batches(
+        handle.embedding_model, [chunk["text"] for chunk in chunks]
+    )
+    handle.insert_in_batches(
+        [
+            {**chunk, **embedding_fields(embedding)}
+            for chunk, embedding in zip(chunks, embeddings)
+        ]
+    )
+    handle.build_indexes(keywords)
+    return handle
+
+
+@pytest.fixture
+def ingest():
+    return ingest_pages
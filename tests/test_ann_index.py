@@ -0,0 +1,131 @@
+import numpy as np
+import pytest
+
+from core.ann_index import IVFIndex, index_path, remove_matrix_files
+from core.bm25 import bm25_index_path
+from core.vector_store import remove_indexes
+from core.scoring import EmbeddingMatrix
+
+DIMENSIONS = 64
+TOP_K = 10
+
+
+@pytest.fixture(scope="module")
+def collection():
+    """
+    Segments drawn around 40 topics, four per page, and queries near the
+    topics.
+    """
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(40, DIMENSIONS))
+    topics = rng.integers(0, len(centers), size=4000)
+    embeddings = centers[topics] + rng.normal(scale=0.6, size=(4000, DIMENSIONS))
+    pages = np.arange(len(embeddings)) // 4
+    ids = [str(i) for i in range(len(embeddings))]
+    queries = centers[rng.integers(0, len(centers), size=50)] + rng.normal(
+        scale=0.6, size=(50, DIMENSIONS)
+    )
+    return embeddings, pages, ids, queries
+
+
+def recall(expected, found) -> float:
+    expected_pages = {hit["page"] for hit in expected}
+    return len(expected_pages & {hit["page"] for hit in found}) / len(expected_pages)
+
+
+def mean_recall(index, exact, queries, n_probe, mask=None) -> float:
+    return float(
+        np.mean(
+            [
+                recall(
+                    exact.search(query, top_k=TOP_K),
+                    index.search(query, top_k=TOP_K, n_probe=n_probe, mask=mask),
+                )
+                for query in queries
+            ]
+        )
+    )
+
+
+def test_recall_against_exact_scan(collection):
+    embeddings, pages, ids, queries = collection
+    index = IVFIndex.build(embeddings, pages, ids)
+    exact = EmbeddingMatrix(pages, embeddings, ids)
+
+    recalls = {
+        n_probe: mean_recall(index, exact, queries, n_probe)
+        for n_probe in (1, 4, 8, index.n_lists)
+    }
+    assert recalls[4] >= 0.8
+    assert recalls[8] >= 0.9
+    # Probing every list is an exact search
+    assert recalls[index.n_lists] == 1.0
+    assert recalls[1] <= recalls[4] <= recalls[8] <= recalls[index.n_lists]
+
+
+def test_recall_with_page_filter(collection):
+    embeddings, pages, ids, queries = collection
+    index = IVFIndex.build(embeddings, pages, ids)
+    allowed = np.random.default_rng(1).choice(pages.max() + 1, 100, replace=False)
+    mask = index.page_mask(allowed)
+    rows = np.flatnonzero(mask)
+    exact = EmbeddingMatrix(pages[rows], embeddings[rows], [ids[i] for i in rows])
+
+    for n_probe in (1, 8, index.n_lists):
+        for query in queries:
+            found = index.search(query, top_k=TOP_K, n_probe=n_probe, mask=mask)
+            assert set(hit["page"] for hit in found) <= set(allowed.tolist())
+    assert mean_recall(index, exact, queries, 8, mask) >= 0.9
+    assert mean_recall(index, exact, queries, index.n_lists, mask) == 1.0
+
+
+def test_save_and_load(collection, tmp_path):
+    embeddings, pages, ids, queries = collection
+    index = IVFIndex.build(embeddings, pages, ids)
+    path = str(tmp_path / "collection.npz")
+    index.save(path)
+    loaded = IVFIndex.load(path)
+
+    for query in queries[:5]:
+        assert loaded.search(query, top_k=TOP_K) == index.search(query, top_k=TOP_K)
+
+
+def test_loaded_index_survives_the_next_save(collection, tmp_path):
+    embeddings, pages, ids, queries = collection
+    index = IVFIndex.build(embeddings, pages, ids)
+    path = str(tmp_path / "collection.npz")
+    index.save(path)
+    loaded = IVFIndex.load(path)
+
+    # A new version is published, then the previous matrix is removed
+    matrix = index.save(path)
+    remove_matrix_files(path, keep=matrix)
+    assert [p.name for p in tmp_path.glob("*.matrix.npy")] == [matrix.split("/")[-1]]
+    # The mapped matrix is only unlinked
+    assert loaded.search(queries[0]) == index.search(queries[0])
+    assert IVFIndex.load(path).search(queries[0]) == index.search(queries[0])
+
+
+def test_collections_with_a_common_prefix_keep_their_files(
+    collection, monkeypatch, tmp_path
+):
+    monkeypatch.chdir(tmp_path)
+    embeddings, pages, ids, queries = collection
+    index = IVFIndex.build(embeddings, pages, ids)
+    for name in ("spec_v1", "spec_v1.2"):
+        index.save(index_path(name))
+        with open(bm25_index_path(name), "wb"):
+            pass
+
+    # Saving spec_v1 again, then removing its previous matrix only
+    remove_matrix_files(index_path("spec_v1"), keep=index.save(index_path("spec_v1")))
+    assert IVFIndex.load(index_path("spec_v1.2")).search(queries[0]) == index.search(
+        queries[0]
+    )
+
+    remove_indexes("spec_v1")
+    assert not (tmp_path / index_path("spec_v1")).exists()
+    assert IVFIndex.load(index_path("spec_v1.2")).search(queries[0]) == index.search(
+        queries[0]
+    )
+    assert (tmp_path / bm25_index_path("spec_v1.2")).exists()
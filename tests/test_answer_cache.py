@@ -0,0 +1,133 @@
+import asyncio
+from types import SimpleNamespace
+
+import core.answer_cache
+import core.util_functions
+from core.answer_cache import AnswerCache, AnswerKey, history_digest
+from core.util_functions import alookup_answer, aprepare_question
+
+FIRST_QUESTION = history_digest([])
+
+
+def answer_key(**fields) -> AnswerKey:
+    return AnswerKey(
+        **{
+            "collection_name": "manual",
+            "version": "1",
+            "model": "gpt-4o",
+            "temperature": 0.7,
+            "top_p": 0.9,
+            "max_tokens": 4096,
+            "user_type": "PM",
+            "top_k": 10,
+            "history": FIRST_QUESTION,
+            **fields,
+        }
+    )
+
+
+def test_similar_questions_share_an_answer():
+    cache = AnswerCache(threshold=0.95)
+    cache.store(answer_key(), [1.0, 0.0], "What is the pump?", "A pump.", [])
+
+    assert cache.lookup(answer_key(), [0.99, 0.05]).answer == "A pump."
+    assert cache.lookup(answer_key(), [0.0, 1.0]) is None
+
+
+def test_answers_depend_on_the_conversation_and_top_k():
+    cache = AnswerCache(threshold=0.95)
+    cache.store(answer_key(), [1.0, 0.0], "And its pressure?", "12 bar.", [])
+
+    follow_up = history_digest(
+        [
+            {"role": "user", "content": "What is the pump P-101?"},
+            {"role": "assistant", "content": "The feed pump."},
+        ]
+    )
+    assert cache.lookup(answer_key(history=follow_up), [1.0, 0.0]) is None
+    assert cache.lookup(answer_key(top_k=3), [1.0, 0.0]) is None
+    assert cache.lookup(answer_key(), [1.0, 0.0]).answer == "12 bar."
+
+
+def test_lexical_questions_match_on_their_text():
+    cache = AnswerCache()
+    cache.store(answer_key(), None, "P-101  valve", "On page 4.", [])
+
+    assert cache.lookup(answer_key(), question="p-101 VALVE").answer == "On page 4."
+    assert cache.lookup(answer_key(), question="P-102 valve") is None
+    # They never match an embedded question
+    assert cache.lookup(answer_key(), [1.0, 0.0], "P-101 valve") is None
+
+
+def test_expired_and_invalidated_answers_stop_matching(monkeypatch):
+    clock = SimpleNamespace(now=0.0)
+    monkeypatch.setattr(
+        core.answer_cache, "time", SimpleNamespace(monotonic=lambda: clock.now)
+    )
+    cache = AnswerCache(ttl=60)
+    cache.store(answer_key(), [1.0, 0.0], "What is the pump?", "A pump.", [])
+    cache.store(answer_key(collection_name="specs"), None, "P-101", "Page 4.", [])
+
+    clock.now = 30.0
+    cache.store(answer_key(), [0.0, 1.0], "What is the valve?", "A valve.", [])
+    clock.now = 61.0
+    assert cache.lookup(answer_key(), [1.0, 0.0]) is None
+    assert cache.lookup(answer_key(), [0.0, 1.0]).answer == "A valve."
+
+    cache.invalidate("manual")
+    assert cache.lookup(answer_key(), [0.0, 1.0]) is None
+    # Only the answers stored before the invalidation are dropped
+    clock.now = 62.0
+    cache.store(answer_key(), [0.0, 1.0], "What is the valve?", "The valve.", [])
+    assert cache.lookup(answer_key(), [0.0, 1.0]).answer == "The valve."
+    assert cache.stats()["hits"] == 2
+
+
+def test_least_recently_used_keys_and_answers_are_evicted():
+    cache = AnswerCache(max_entries=2, max_answers=2)
+    for question in ("one", "two", "three"):
+        cache.store(answer_key(), None, question, question.upper(), [])
+    assert cache.lookup(answer_key(), question="one") is None
+    assert cache.lookup(answer_key(), question="three").answer == "THREE"
+
+    cache.store(answer_key(top_k=3), None, "one", "ONE", [])
+    # The key looked up last is kept
+    cache.lookup(answer_key(), question="two")
+    cache.store(answer_key(top_k=5), None, "one", "ONE", [])
+    assert cache.lookup(answer_key(top_k=3), question="one") is None
+    assert cache.lookup(answer_key(), question="two").answer == "TWO"
+    assert cache.stats()["keys"] == 2
+
+
+def test_the_retrieval_reuses_the_embedding_of_the_lookup(
+    local_store, ingest, fake_embeddings, monkeypatch
+):
+    # NLTK downloads its stop words
+    monkeypatch.setattr(core.util_functions, "get_stop_words", lambda: frozenset())
+    handle = ingest(
+        local_store,
+        "manual",
+        [f"Page {page}: the pump{page} runs at {page} bar." for page in range(8)],
+    )
+    cache = AnswerCache()
+    question = "How fast does the pump3 run?"
+
+    async def ask():
+        cached, embedding, cacheable = await alookup_answer(
+            handle, cache, answer_key(), question, top_k=3
+        )
+        assert cached is None and cacheable
+        cache.store(answer_key(), embedding, question, "At 3 bar.", [])
+        results, _, _ = await aprepare_question(handle, "manual.pdf", question, top_k=3)
+        return results
+
+    fake_embeddings.embedded.clear()
+    results = asyncio.run(ask())
+    assert results[0]["page"] == 3
+    # One call to the model for the lookup and the retrieval
+    assert len(fake_embeddings.embedded) == 1
+
+    cached, _, _ = asyncio.run(
+        alookup_answer(handle, cache, answer_key(), question, top_k=3)
+    )
+    assert cached.answer == "At 3 bar."
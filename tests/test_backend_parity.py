@@ -0,0 +1,38 @@
+PAGES = 12
+KEYWORDS = {page: ["valve"] if page % 3 == 0 else ["motor"] for page in range(PAGES)}
+QUESTIONS = [
+    ("How is the valve of unit 4 serviced?", None),
+    ("Pressure of the pump in unit 7", None),
+    ("How is the valve of unit 9 serviced?", ["valve"]),
+    ("unit10", None),
+]
+
+
+def page_text(page: int) -> str:
+    return (
+        f"Unit {page}: the valve of unit{page} is serviced every {page + 1} "
+        f"months, the pump keeps a pressure of {page * 2} bar."
+    )
+
+
+def search(store, ingest):
+    handle = ingest(
+        store, "manual", [page_text(page) for page in range(PAGES)], KEYWORDS
+    )
+    return [
+        [
+            (result["page"], result["text"], round(result["score"], 6))
+            for result in handle.query_with_keyword_filter(
+                question, top_k=4, keyword_filter=keyword_filter
+            )
+        ]
+        for question, keyword_filter in QUESTIONS
+    ]
+
+
+def test_backends_return_the_same_results(request, ingest):
+    mongodb = search(request.getfixturevalue("mongo_store"), ingest)
+    local = search(request.getfixturevalue("local_store"), ingest)
+
+    assert all(mongodb)
+    assert mongodb == local
@@ -0,0 +1,21 @@
+from core.util_functions import BackgroundLoop
+
+
+def test_stopping_early_closes_the_generator():
+    events = []
+
+    async def stream():
+        try:
+            for i in range(10):
+                yield i
+        finally:
+            events.append("closed")
+
+    loop = BackgroundLoop()
+    chunks = loop.iterate(stream())
+    assert [next(chunks) for _ in range(3)] == [0, 1, 2]
+    chunks.close()
+    assert events == ["closed"]
+
+    assert list(loop.iterate(stream())) == list(range(10))
+    assert events == ["closed", "closed"]
@@ -0,0 +1,70 @@
+import pytest
+
+import core.chunking
+import core.context
+from config.cfg import CONTEXT_MAX_SENTENCES
+from core.context import assemble_context, count_text_tokens
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch, whitespace_tokens):
+    encoding = core.chunking.get_encoding()
+    monkeypatch.setattr(core.context, "get_model_encoding", lambda model: encoding)
+
+
+def filler(page: int, count: int) -> list:
+    return [f"Filler sentence {i} of page {page} about nothing." for i in range(count)]
+
+
+def test_near_duplicates_are_dropped():
+    text = "The pump P-101 feeds the boiler. It runs at 12 bar."
+    results = [
+        {"page": 3, "text": text},
+        # The same passage, extracted again from a repeated page
+        {"page": 7, "text": text + " Page 7."},
+        {"page": 9, "text": "The valve V-2 protects the boiler."},
+    ]
+    context = assemble_context(results, {"pump"}, "gpt-4o", max_tokens=1000)
+
+    assert context == (
+        f"[Page 3]\n{text}\n\n[Page 9]\nThe valve V-2 protects the boiler."
+    )
+
+
+def test_passages_keep_their_most_relevant_sentences():
+    sentences = filler(1, CONTEXT_MAX_SENTENCES + 5)
+    sentences[4] = "The pressure of the pump is 12 bar."
+    sentences[-1] = "Check the pressure gauge of the pump monthly."
+    results = [{"page": 1, "text": " ".join(sentences)}]
+
+    context = assemble_context(results, {"Pump", "pressure"}, "gpt-4o", 1000)
+    kept = context.split("\n", 1)[1]
+
+    assert sentences[4] in kept and sentences[-1] in kept
+    # In their order, the ties going to the first sentences
+    fillers = [s for s in sentences if s.startswith("Filler")]
+    expected = [sentences[4], sentences[-1]] + fillers[: CONTEXT_MAX_SENTENCES - 2]
+    assert kept == " ".join(s for s in sentences if s in expected)
+
+
+def test_passages_are_packed_into_the_budget():
+    results = [
+        {"page": page, "text": " ".join(filler(page, 4))} for page in range(1, 5)
+    ]
+    passage_tokens = count_text_tokens(
+        f"[Page 1]\n{' '.join(filler(1, 4))}\n\n", "gpt-4o"
+    )
+    # Two passages, and two sentences of the third one
+    max_tokens = 2 * passage_tokens + passage_tokens // 2 + 2
+
+    context = assemble_context(results, set(), "gpt-4o", max_tokens)
+    passages = context.split("\n\n")
+
+    assert [passage.split("\n")[0] for passage in passages] == [
+        "[Page 1]",
+        "[Page 2]",
+        "[Page 3]",
+    ]
+    assert passages[2] == "[Page 3]\n" + " ".join(filler(3, 2))
+    assert count_text_tokens(context, "gpt-4o") <= max_tokens
+    assert assemble_context(results, set(), "gpt-4o", max_tokens=3) == ""
@@ -0,0 +1,102 @@
+from bson import BSON
+from pymongo.errors import DocumentTooLarge
+
+from core.quantization import embedding_fields
+
+MAX_DOCUMENT_SIZE = 4096
+
+
+def documents(fake_embeddings, texts, storage="array"):
+    return [
+        {
+            "page": page,
+            "chunk": 0,
+            "text": text,
+            "filename": "manual.pdf",
+            "keywords": [],
+            **embedding_fields(fake_embeddings.vector(text), storage=storage),
+        }
+        for page, text in enumerate(texts)
+    ]
+
+
+def limit_document_size(collection, monkeypatch):
+    """
+    Raises DocumentTooLarge as pymongo does for the documents over the size
+    limit, which mongomock does not enforce.
+    """
+    insert_many, insert_one = collection.insert_many, collection.insert_one
+
+    def check(document):
+        if len(BSON.encode(document)) > MAX_DOCUMENT_SIZE:
+            raise DocumentTooLarge("BSON document too large")
+
+    def checked_insert_many(batch, ordered=True):
+        # The documents before the large one are already sent
+        for document in batch:
+            check(document)
+            insert_many([document], ordered=ordered)
+
+    def checked_insert_one(document):
+        check(document)
+        return insert_one(document)
+
+    monkeypatch.setattr(collection, "insert_many", checked_insert_many)
+    monkeypatch.setattr(collection, "insert_one", checked_insert_one)
+
+
+def test_a_bad_document_only_skips_itself(mongo_store, fake_embeddings, monkeypatch):
+    handle = mongo_store.for_collection("manual")
+    limit_document_size(handle.collection, monkeypatch)
+    texts = [f"Page {page} of the manual." for page in range(6)]
+    texts[3] = "x" * MAX_DOCUMENT_SIZE
+
+    handle.insert_in_batches(documents(fake_embeddings, texts), batch_size=4)
+
+    stored = sorted(doc["page"] for doc in handle.collection.find({}, {"page": 1}))
+    assert stored == [0, 1, 2, 4, 5]
+
+
+def record_finds(collection, monkeypatch):
+    finds = []
+    find = collection.find
+
+    def recording_find(query_filter=None, projection=None, *args, **kwargs):
+        finds.append((query_filter, projection))
+        return find(query_filter, projection, *args, **kwargs)
+
+    monkeypatch.setattr(collection, "find", recording_find)
+    return finds
+
+
+def test_keyword_prefilter_reads_the_coarse_fields(
+    mongo_store, fake_embeddings, monkeypatch
+):
+    handle = mongo_store.for_collection("manual")
+    texts = [f"Page {page}: pump{page} and its valve." for page in range(8)]
+    stored = documents(fake_embeddings, texts, storage="binary")
+    for doc in stored:
+        doc["keywords"] = ["pump"] if doc["page"] in (2, 5) else ["valve"]
+    handle.insert_in_batches(stored)
+    finds = record_finds(handle.collection, monkeypatch)
+    query = fake_embeddings.vector("pump6 and its valve")
+
+    # No export nor keyword index yet: the filter runs on the collection
+    hits = handle.exact_search(query, 3, None, ["Pump"])
+    assert {hit["page"] for hit in hits} == {2, 5}
+    coarse_filter, coarse_projection = finds[0]
+    assert coarse_filter == {"keywords": {"$in": ["pump"]}}
+    assert set(coarse_projection) - {"_id"} == {"page", "embedding_i8"}
+    # Only the candidates are read with their exact embeddings
+    rescore_filter, rescore_projection = finds[1]
+    assert set(rescore_filter) == {"_id"}
+    assert "text" not in rescore_projection and "embedding" in rescore_projection
+
+    # No document has the keyword: every document is searched
+    finds.clear()
+    hits = handle.exact_search(query, 3, None, ["gearbox"])
+    assert hits[0]["page"] == 6
+    assert [query_filter for query_filter, _ in finds[:2]] == [
+        {"keywords": {"$in": ["gearbox"]}},
+        {},
+    ]
@@ -0,0 +1,79 @@
+import asyncio
+import threading
+
+from core.embedding_cache import CachedEmbeddings, EmbeddingCache
+from core.embeddings import embed_in_batches
+
+
+def test_unchanged_pages_are_not_embedded_again(fake_embeddings, tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite"))
+    model = fake_embeddings
+    embeddings = CachedEmbeddings(model, cache)
+    pages = [f"Text of page {page}" for page in range(50)]
+
+    first = embed_in_batches(embeddings, pages)
+    assert model.embedded == pages
+
+    # The same document ingested again, with one page edited
+    model.embedded.clear()
+    pages[7] = "Edited text of page 7"
+    second = embed_in_batches(embeddings, pages)
+    assert model.embedded == ["Edited text of page 7"]
+    assert second[:7] == first[:7] and second[8:] == first[8:]
+    assert second[7] == model.vector("Edited text of page 7")
+
+    # The cache is on disk, so a new process needs no model call either
+    model.embedded.clear()
+    embed_in_batches(
+        CachedEmbeddings(model, EmbeddingCache(str(tmp_path / "embeddings.sqlite"))),
+        pages,
+    )
+    assert model.embedded == []
+
+
+def test_size_is_tracked_across_writes_and_evictions(fake_embeddings, tmp_path):
+    vector_bytes = 8 * fake_embeddings.dimensions
+    cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite"), 10 * vector_bytes)
+    model = fake_embeddings
+
+    cache.put_many({str(i): model.vector(str(i)) for i in range(6)})
+    # Replacing a vector doesn't count it twice
+    cache.put_many({"0": model.vector("0")})
+    assert cache.total_bytes == cache.size() == 6 * vector_bytes
+
+    cache.put_many({str(i): model.vector(str(i)) for i in range(6, 14)})
+    assert cache.total_bytes == cache.size() <= 10 * vector_bytes
+    # The least recently used vectors went first
+    assert cache.get_many(["1", "13"]).keys() == {"13"}
+
+    reopened = EmbeddingCache(str(tmp_path / "embeddings.sqlite"), 10 * vector_bytes)
+    assert reopened.total_bytes == cache.total_bytes
+
+
+def test_async_queries_read_the_disk_off_the_event_loop(fake_embeddings, tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite"))
+    threads = []
+    for name in ("get_many", "put_many"):
+        method = getattr(cache, name)
+
+        def recorded(*args, method=method):
+            threads.append(threading.get_ident())
+            return method(*args)
+
+        setattr(cache, name, recorded)
+
+    async def ask(embeddings):
+        loop_thread = threading.get_ident()
+        vector = await embeddings.aembed_query("pump  pressure")
+        return loop_thread, vector
+
+    # Embedded, then remembered, then read from the disk by a new process
+    for embeddings in [CachedEmbeddings(fake_embeddings, cache)] * 2 + [
+        CachedEmbeddings(fake_embeddings, cache)
+    ]:
+        loop_thread, vector = asyncio.run(ask(embeddings))
+        assert vector == fake_embeddings.vector("pump pressure")
+    assert fake_embeddings.embedded == ["pump pressure"]
+    # A read and a write for the first query, a read for the second process
+    assert len(threads) == 3
+    assert loop_thread not in threads
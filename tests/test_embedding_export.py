@@ -0,0 +1,53 @@
+import numpy as np
+
+from core.embedding_export import EmbeddingExport
+
+PAGES = 12
+
+
+def page_text(page: int) -> str:
+    return f"Maintenance manual, page {page}: procedure{page} for the pump."
+
+
+class UnreachableCollection:
+    """
+    Fails on any access, as a database that cannot be reached.
+    """
+
+    name = "manual"
+
+    def __getattr__(self, name):
+        raise AssertionError(f"the collection was read ({name})")
+
+
+def test_queries_are_served_by_the_export(mongo_store, ingest, fake_embeddings):
+    handle = ingest(mongo_store, "manual", [page_text(page) for page in range(PAGES)])
+    export = handle.get_export()
+    assert len(export) == PAGES
+
+    handle.collection = UnreachableCollection()
+    hits = export.search(fake_embeddings.vector("procedure7"), top_k=3)
+    assert hits[0]["page"] == 7
+    assert (
+        handle.exact_search(fake_embeddings.vector("procedure7"), 3, None, None) == hits
+    )
+    texts = handle.fetch_texts(hits)
+    assert [text["page"] for text in texts] == [hit["page"] for hit in hits]
+    assert texts[0]["text"] == page_text(7)
+
+    results = handle.query_with_keyword_filter("procedure3 for the pump", top_k=3)
+    assert results[0]["page"] == 3
+    assert results[0]["text"] == page_text(3)
+
+
+def test_empty_export(tmp_path):
+    directory = str(tmp_path / "export")
+    EmbeddingExport.write(
+        directory, np.empty((0, 0), np.float32), pages=[], ids=[], texts=[]
+    )
+    export = EmbeddingExport(directory)
+
+    assert len(export) == 0
+    assert export.rows(["64f1c0ffee"]).tolist() == [-1]
+    assert export.fetch_texts([{"_id": "64f1c0ffee", "page": 0, "score": 1.0}]) is None
+    assert export.search(np.ones(8), top_k=3) == []
@@ -0,0 +1,32 @@
+from core.embeddings import embed_in_batches
+
+
+class FailingEmbeddings:
+    """
+    Rejects every request holding a text marked as bad.
+    """
+
+    def __init__(self, fake_embeddings):
+        self.fake_embeddings = fake_embeddings
+        self.requests = []
+
+    def embed_documents(self, texts):
+        self.requests.append(list(texts))
+        if any("bad" in text for text in texts):
+            raise ValueError("invalid input")
+        return self.fake_embeddings.embed_documents(texts)
+
+
+def test_a_failed_batch_is_retried_text_by_text(fake_embeddings):
+    texts = [f"page {i}" for i in range(6)]
+    texts[2] = "bad page"
+    model = FailingEmbeddings(fake_embeddings)
+
+    embeddings = embed_in_batches(model, texts)
+
+    assert embeddings[2] is None
+    assert [embeddings[i] for i in (0, 1, 3, 4, 5)] == [
+        fake_embeddings.vector(texts[i]) for i in (0, 1, 3, 4, 5)
+    ]
+    # One batch, then every text of the batch alone
+    assert model.requests == [texts] + [[text] for text in texts]
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+from core.page_store import PageStore, page_store_path
+from core.text_extractor import TextExtractor
+
+pytest.importorskip("reportlab")
+
+from benchmarks.bench_extraction import (  # noqa: E402
+    make_pdf,
+    per_page_full_text,
+    per_page_toc_pages,
+)
+
+PAGES = 6
+
+
+def test_same_text_as_the_per_page_extraction(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_pdf("manual.pdf", pages=PAGES)
+    expected = per_page_full_text("manual.pdf", "per_page")
+
+    text_extractor = TextExtractor("manual.pdf")
+    assert text_extractor.extract_full_text() == expected
+    assert "la pressione è di 3 bar" in expected
+
+    # The page store holds what the per-page files held
+    with PageStore(page_store_path(text_extractor.service_dir)) as page_store:
+        assert len(page_store) == PAGES
+        for page in range(PAGES):
+            with open(
+                os.path.join("per_page", f"page_{page}.txt"), encoding="utf-8"
+            ) as file:
+                assert page_store[page] == file.read()
+
+    _, toc_pages = text_extractor.scan_toc()
+    assert toc_pages == per_page_toc_pages("manual.pdf") == [2]
@@ -0,0 +1,89 @@
+import re
+
+import pytest
+
+import core.history
+from core.history import ConversationHistory, format_message
+
+
+class Encoding:
+    """
+    One token per word (with its trailing whitespace) or per char, counting
+    the texts it encodes.
+    """
+
+    def __init__(self, name: str, pattern: str):
+        self.name = name
+        self.pattern = pattern
+        self.encoded = 0
+
+    def encode(self, text, disallowed_special=()):
+        self.encoded += 1
+        return re.findall(self.pattern, text)
+
+
+@pytest.fixture
+def encodings(monkeypatch):
+    encodings = {
+        "words": Encoding("words", r"\S+\s*|\s+"),
+        "chars": Encoding("chars", r"(?s)."),
+    }
+    # Both models of the family share the tokenizer
+    encodings["words-mini"] = encodings["words"]
+    monkeypatch.setattr(core.history, "get_model_encoding", encodings.__getitem__)
+    monkeypatch.setattr(
+        core.history, "HISTORY_TOKEN_BUDGETS", {"words": 10, "words-mini": 5}
+    )
+    monkeypatch.setattr(core.history, "MAX_HISTORY_TOKENS", 1000)
+    return encodings
+
+
+def message(i: int) -> dict:
+    # "USER: message i of history\n", 5 words
+    return {"role": "user", "content": f"message {i} of history"}
+
+
+def test_window_of_the_model(encodings):
+    messages = [message(i) for i in range(6)]
+    history = ConversationHistory.from_messages(messages, "words")
+
+    assert history.window("words") == messages[-2:]
+    assert history.window("words-mini") == messages[-1:]
+    # Models without a budget get the default one
+    assert history.window("chars") == messages
+    assert history.window("words", max_tokens=4) == []
+    assert history.render("words") == "".join(map(format_message, messages[-2:]))
+
+
+def test_append_drops_the_oldest_messages(encodings):
+    history = ConversationHistory(max_tokens=12)
+    for i in range(5):
+        history.append("user", message(i)["content"], "words")
+
+    # The newest messages covering the largest budget are kept
+    assert [entry.content for entry in history.entries] == [
+        message(i)["content"] for i in (2, 3, 4)
+    ]
+    assert history.total == 15
+    # Every message was tokenized once
+    assert encodings["words"].encoded == 5
+
+
+def test_counts_follow_the_encoding(encodings):
+    messages = [message(i) for i in range(3)]
+    history = ConversationHistory.from_messages(messages, "words")
+    assert history.total == 15
+
+    # Another model with the same tokenizer reuses the counts
+    history.append("assistant", "ok", "words-mini")
+    assert history.total == 15 + len(["ASSISTANT: ", "ok\n"])
+    assert encodings["words"].encoded == 4
+
+    # A model with another tokenizer recounts every message, once
+    history.append("user", "why", "chars")
+    formatted = [format_message(entry.as_message()) for entry in history.entries]
+    assert history.encoding_name == "chars"
+    assert history.total == sum(map(len, formatted))
+    assert encodings["chars"].encoded == 5
+    history.window("chars")
+    assert encodings["chars"].encoded == 5
@@ -0,0 +1,40 @@
+import pytest
+
+from core.scoring import reciprocal_rank_fusion
+
+PAGES = 6
+
+
+def page_text(page: int) -> str:
+    return f"The field param{page} of the payload sets the pressure of pump {page}."
+
+
+def hits(*pages):
+    return [{"page": page, "score": 1.0 - rank / 10} for rank, page in enumerate(pages)]
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([hits(1, 2, 3), hits(3, 4, 1)], top_k=4, k=60)
+
+    # Pages 1 and 3 are in both rankings, 1 ranks first in one and third in
+    # the other, as 3 does: their tie keeps the order of the first ranking
+    assert [hit["page"] for hit in fused] == [1, 3, 2, 4]
+    assert fused[0]["score"] == pytest.approx(1 / 61 + 1 / 63)
+    assert fused[1]["score"] == pytest.approx(1 / 63 + 1 / 61)
+    assert fused[2]["score"] == pytest.approx(1 / 62)
+    assert fused[3]["score"] == pytest.approx(1 / 62)
+    assert reciprocal_rank_fusion([hits(1, 2), hits(2)], top_k=1)[0]["page"] == 2
+
+
+def test_identifier_query_skips_the_embedding(mongo_store, ingest, fake_embeddings):
+    handle = ingest(mongo_store, "manual", [page_text(page) for page in range(PAGES)])
+    fake_embeddings.embedded.clear()
+
+    results = handle.query_with_keyword_filter("param4", top_k=3)
+    assert results[0]["page"] == 4
+    assert fake_embeddings.embedded == []
+
+    # Prose needs the embedding, fused with the lexical hits
+    results = handle.query_with_keyword_filter("pressure of pump param4", top_k=3)
+    assert results[0]["page"] == 4
+    assert fake_embeddings.embedded == ["pressure of pump param4"]
@@ -0,0 +1,104 @@
+import pytest
+
+import core.ingestion
+from core.ingestion import IngestionPipeline
+from core.text_extractor import DocumentAnalysis, PageAnalysis
+
+
+class FakeStore:
+    def __init__(self, embedding_model=None):
+        self.embedding_model = embedding_model
+        self.keywords = None
+        self.indexed_with = None
+        self.documents = []
+
+    def for_collection(self, collection_name):
+        return self
+
+    def create_indexes(self):
+        pass
+
+    def insert_in_batches(self, documents):
+        self.documents.extend(documents)
+
+    def update_keywords(self, keywords):
+        self.keywords = keywords
+
+    def build_indexes(self, keywords):
+        self.indexed_with = keywords
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    pipeline = IngestionPipeline(FakeStore(), "manual.pdf", "manual")
+    monkeypatch.setattr(pipeline.text_extractor, "extract_full_text", lambda: "")
+    monkeypatch.setattr(
+        pipeline.text_extractor, "extract_keywords", lambda pages: {0: ["pump"]}
+    )
+    return pipeline
+
+
+def test_toc_failure_is_not_fatal(pipeline, monkeypatch):
+    def resolve_toc(text_extractor, client=None):
+        # What an LLM reply without a json prefix used to raise
+        raise UnboundLocalError("cleaned")
+
+    monkeypatch.setattr(core.ingestion, "resolve_toc", resolve_toc)
+    pipeline.finalize()
+
+    assert pipeline.toc == []
+    assert pipeline.db.keywords == {0: ["pump"]}
+    assert pipeline.db.indexed_with == {0: ["pump"]}
+
+
+def test_stored_pages_are_indexed_when_the_keywords_fail(pipeline, monkeypatch):
+    def extract_keywords(pages):
+        raise ValueError("no pages")
+
+    monkeypatch.setattr(pipeline.text_extractor, "extract_keywords", extract_keywords)
+    with pytest.raises(ValueError):
+        pipeline.finalize()
+    assert pipeline.db.indexed_with == {}
+
+
+def test_stored_pages_are_indexed_when_a_stage_failed(pipeline):
+    pipeline.status.error = "broken page"
+    with pytest.raises(RuntimeError):
+        pipeline.finalize()
+    assert pipeline.db.indexed_with == {}
+
+
+def test_a_failed_stage_does_not_block_the_pipeline(fake_embeddings, monkeypatch):
+    pages = 40
+
+    def analyze_ranges(range_pages):
+        for page_number in range(1, pages + 1):
+            analysis = DocumentAnalysis()
+            analysis.pages.append(
+                PageAnalysis(page_number=page_number, text=f"page {page_number}")
+            )
+            yield analysis
+
+    def chunk_page(page, text, keywords, filename):
+        if page == 3:
+            raise ValueError("broken page")
+        return [{"page": page, "chunk": 0, "text": text, "keywords": keywords}]
+
+    # A buffer of one page: the extraction blocks unless the failed stage
+    # keeps draining its queue
+    pipeline = IngestionPipeline(
+        FakeStore(fake_embeddings), "manual.pdf", "manual", buffer_size=1
+    )
+    monkeypatch.setattr(pipeline.text_extractor, "page_count", lambda: pages)
+    monkeypatch.setattr(pipeline.text_extractor, "analyze_ranges", analyze_ranges)
+    monkeypatch.setattr(core.ingestion, "chunk_page", chunk_page)
+
+    pipeline.start()
+    pipeline.thread.join(timeout=10)
+
+    assert not pipeline.thread.is_alive()
+    assert pipeline.status.done
+    assert pipeline.status.error == "broken page"
+    assert pipeline.status.processed["extract"] == pages
+    assert {document["page"] for document in pipeline.db.documents} <= {0, 1, 2}
+    assert pipeline.db.indexed_with == {}
@@ -0,0 +1,46 @@
+import os
+
+from core.keyword_index import KeywordIndex
+
+KEYWORDS = {0: ["Pump", "valve"], 1: ["valve"], 2: ["motor"], 5: ["pump", "PUMP"]}
+PAGES = 8
+
+
+def page_text(page: int) -> str:
+    return f"Service manual, page {page}: item{page} of the assembly."
+
+
+def test_union_of_the_posting_lists():
+    index = KeywordIndex.build(KEYWORDS)
+
+    assert len(index) == 3
+    assert index.pages("PUMP").tolist() == [0, 5]
+    assert index.union(["pump", "valve"]).tolist() == [0, 1, 5]
+    assert index.union(["motor", "motor", "unknown"]).tolist() == [2]
+    assert index.union(["unknown"]).tolist() == []
+    assert index.union([]).tolist() == []
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "manual" / "keywords.npz")
+    KeywordIndex.build(KEYWORDS).save(path)
+    loaded = KeywordIndex.load(path)
+
+    assert os.listdir(tmp_path / "manual") == ["keywords.npz"]
+    assert loaded.union(["pump", "valve"]).tolist() == [0, 1, 5]
+
+
+def test_candidates_filter_the_vector_search(mongo_store, ingest, fake_embeddings):
+    handle = ingest(
+        mongo_store, "manual", [page_text(page) for page in range(PAGES)], KEYWORDS
+    )
+    query = fake_embeddings.vector("item7 of the assembly")
+
+    # Page 7 is the best match, but only the pages of the keywords are searched
+    assert handle.vector_search(query, 3, None)[0]["page"] == 7
+    hits = handle.vector_search(query, 3, ["Valve", "motor"])
+    assert {hit["page"] for hit in hits} == {0, 1, 2}
+    # No page has the keyword: every page is searched
+    hits = handle.vector_search(query, 3, ["gearbox"])
+    assert hits[0]["page"] == 7
+    assert len(hits) == 3
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from benchmarks.bench_keywords import (
+    TRICKY_WORDS,
+    char_texts,
+    loop_extract_keywords,
+    make_analysis,
+)
+from core.text_extractor import TextExtractor, clean_keywords
+
+
+def keyword_sets(keywords):
+    return {page: set(words) for page, words in keywords.items()}
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_same_keywords_as_the_loops(seed):
+    analysis = make_analysis(np.random.default_rng(seed), pages=20)
+    text_extractor = TextExtractor("manual.pdf")
+    text_extractor.analysis = analysis
+    texts = {page.page_number: char_texts(page) for page in analysis.pages}
+
+    for toc_pages in ([], [2, 3]):
+        expected = loop_extract_keywords(analysis, texts, toc_pages)
+        found = text_extractor.extract_keywords(pages=toc_pages)
+        assert keyword_sets(found) == keyword_sets(expected)
+        # Sorted, without duplicates
+        assert all(words == sorted(set(words)) for words in found.values())
+
+
+def test_tricky_words():
+    analysis = make_analysis(np.random.default_rng(0), pages=1)
+    page = analysis.pages[0]
+    text = " ".join(TRICKY_WORDS) + " (cid:3)ab "
+    page.chars = text
+    page.char_lengths = None
+    page.char_sizes = page.char_sizes[: len(text)]
+    page.char_bold = bytearray([1] * len(text))
+    page.char_coloured = bytearray(len(text))
+    text_extractor = TextExtractor("manual.pdf")
+    text_extractor.analysis = analysis
+
+    # "gen(erali)" loses its parentheses, then the ignored "generali"; the
+    # "[int]" stripped from "pro[int]ject" leaves "project", as it did
+    assert text_extractor.extract_keywords(pages=[]) == {
+        0: ["12ab", "ab", "cid3ab", "foo", "project", "quoted", "xy", "σigma"]
+    }
+
+
+def test_clean_keywords_checks_every_word():
+    # Removing the words from the list being iterated skipped the word
+    # following each removed one
+    keywords = {0: ["a", "1", "ok", "", " ", "12", "x" * 16, "x" * 15, "b"]}
+    assert clean_keywords(keywords) == {0: ["ok", "x" * 15]}
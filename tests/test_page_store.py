@@ -0,0 +1,59 @@
+import pytest
+
+from core.page_store import PageStore
+
+PAGES = ["Indice", "", "La pressione è di 3 bar, 40 °C.", None, "Σigma ‘quoted’ 日本語"]
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / "pages" / "manual.pages")
+    PageStore.write(path, PAGES)
+    return path
+
+
+def test_round_trip(path):
+    with PageStore(path) as store:
+        assert len(store) == len(PAGES)
+        assert [store[page] for page in range(len(store))] == [
+            page or "" for page in PAGES
+        ]
+        assert store.read(0, len(store)) == "".join(page or "" for page in PAGES)
+
+
+def test_bounds(path):
+    with PageStore(path) as store:
+        assert store.read(2, 3) == PAGES[2]
+        assert store.read(-3, 2) == "Indice"
+        assert store.read(4, 100) == PAGES[4]
+        assert store.read(3, 3) == ""
+        assert store.read(5, 2) == ""
+        assert store.get_range(-1, 3) == ["Indice", "", PAGES[2]]
+        assert store.get_range(3, 100) == ["", PAGES[4]]
+        assert store.get_range(100, 200) == []
+        with pytest.raises(IndexError):
+            store[5]
+        with pytest.raises(IndexError):
+            store[-1]
+
+
+def test_empty_store(tmp_path):
+    path = str(tmp_path / "empty.pages")
+    PageStore.write(path, [])
+    with PageStore(path) as store:
+        assert len(store) == 0
+        assert store.read(0, 10) == ""
+        assert store.get_range(0, 10) == []
+
+
+def test_rewrite_replaces_the_store(path):
+    PageStore.write(path, ["new"])
+    with PageStore(path) as store:
+        assert store.get_range(0, 10) == ["new"]
+
+
+def test_not_a_page_store(tmp_path):
+    path = tmp_path / "manual.txt"
+    path.write_bytes(b"not a store at all")
+    with pytest.raises(ValueError):
+        PageStore(str(path))
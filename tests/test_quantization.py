@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+from core.embedding_export import read_version
+from core.quantization import embedding_fields
+from core.scoring import EmbeddingMatrix
+
+PAGES = 30
+
+
+def apply_updates(collection):
+    """
+    mongomock does not pass the update requests of pymongo to `bulk_write`:
+    they are applied one by one.
+    """
+
+    def bulk_write(requests, ordered=True):
+        modified = sum(
+            collection.update_one(request._filter, request._doc).modified_count
+            for request in requests
+        )
+        return SimpleNamespace(modified_count=modified)
+
+    return bulk_write
+
+
+def page_text(page: int) -> str:
+    return f"Wiring diagram, page {page}: terminal{page} of the control board."
+
+
+def test_mixed_storage_formats(mongo_store, fake_embeddings, monkeypatch):
+    handle = mongo_store.for_collection("manual")
+    embeddings = [fake_embeddings.vector(page_text(page)) for page in range(PAGES)]
+    # The first pages were stored before the binary format
+    handle.insert_in_batches(
+        [
+            {
+                "page": page,
+                "chunk": 0,
+                "text": page_text(page),
+                "filename": "",
+                "keywords": [f"terminal{page}"],
+                **embedding_fields(
+                    embedding, storage="array" if page < PAGES // 2 else "binary"
+                ),
+            }
+            for page, embedding in enumerate(embeddings)
+        ]
+    )
+    assert handle.get_export() is None
+
+    exact = EmbeddingMatrix(range(PAGES), embeddings, range(PAGES))
+    for page in (3, 20):
+        query = fake_embeddings.vector(f"terminal{page} control board")
+        hits = handle.exact_search(query, 5, None, None)
+        expected = exact.search(query, top_k=5)
+        assert [hit["page"] for hit in hits] == [hit["page"] for hit in expected]
+        assert hits[0]["page"] == page
+
+    monkeypatch.setattr(
+        handle.collection, "bulk_write", apply_updates(handle.collection)
+    )
+    assert handle.migrate_embeddings() == PAGES // 2
+    assert handle.collection.count_documents({"embedding_i8": {"$exists": False}}) == 0
+    # The migration publishes a new version with the keywords of the pages
+    assert read_version("manual") is not None
+    assert handle.get_keyword_index() is not None
+    results = handle.query_with_keyword_filter(
+        "terminal3 control board", top_k=3, keyword_filter=["terminal3"]
+    )
+    assert results[0]["page"] == 3
+    assert handle.get_export() is not None
@@ -0,0 +1,38 @@
+import pytest
+
+from core.chunking import chunk_page
+from core.quantization import embedding_fields
+
+PAGES = 8
+QUESTION = "Which procedure replaces the gasket?"
+
+
+def page_text(page: int) -> str:
+    return f"Maintenance manual, page {page}: procedure{page} for the pump."
+
+
+@pytest.fixture(params=["mongo_store", "local_store"])
+def store(request):
+    return request.getfixturevalue(request.param)
+
+
+def test_a_new_version_invalidates_the_cached_results(store, ingest, fake_embeddings):
+    handle = ingest(store, "manual", [page_text(page) for page in range(PAGES)])
+    results = handle.query_with_keyword_filter(QUESTION, top_k=3)
+    assert PAGES not in {result["page"] for result in results}
+    assert handle.query_with_keyword_filter(QUESTION, top_k=3) == results
+    assert handle.result_cache.stats()["hits"] == 1
+
+    # A page answering the question is added: the cached results are served
+    # until its version is published
+    text = "Maintenance manual, addendum: the gasket replaces itself."
+    (chunk,) = chunk_page(PAGES, text, keywords=[], filename="")
+    handle.insert_in_batches(
+        [{**chunk, **embedding_fields(fake_embeddings.vector(chunk["text"]))}]
+    )
+    assert handle.query_with_keyword_filter(QUESTION, top_k=3) == results
+
+    handle.build_indexes({})
+    results = handle.query_with_keyword_filter(QUESTION, top_k=3)
+    assert results[0]["page"] == PAGES
+    assert results[0]["text"] == text
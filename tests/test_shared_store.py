@@ -0,0 +1,77 @@
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import mongomock
+import pytest
+
+COLLECTIONS = ["manuals", "specs", "notes"]
+PAGES = 20
+SESSIONS = 24
+QUESTIONS_PER_SESSION = 10
+
+
+class CountingMongoClient(mongomock.MongoClient):
+    created = 0
+    lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        with CountingMongoClient.lock:
+            CountingMongoClient.created += 1
+        super().__init__(*args, **kwargs)
+
+
+@pytest.fixture(params=["mongodb", "local"])
+def store(request, monkeypatch):
+    CountingMongoClient.created = 0
+    if request.param == "local":
+        return request.getfixturevalue("local_store")
+    # The store opens its client with the counting one
+    monkeypatch.setattr(mongomock, "MongoClient", CountingMongoClient)
+    return request.getfixturevalue("mongo_store")
+
+
+def page_text(collection_name: str, page: int) -> str:
+    return f"The {collection_name} document, page {page}: section{page} content."
+
+
+def test_one_pool_serves_concurrent_sessions(store, ingest):
+    for collection_name in COLLECTIONS:
+        ingest(
+            store,
+            collection_name,
+            [page_text(collection_name, page) for page in range(PAGES)],
+        )
+
+    def session(seed: int):
+        """
+        A session asking questions about the collection it has selected, as
+        the app does with a handle taken from the shared store.
+        """
+        rng = random.Random(seed)
+        collection_name = rng.choice(COLLECTIONS)
+        handle = store.for_collection(collection_name)
+        answers = []
+        for _ in range(QUESTIONS_PER_SESSION):
+            page = rng.randrange(PAGES)
+            results = handle.query_with_keyword_filter(
+                f"{collection_name} document section{page}", top_k=3
+            )
+            answers.append((collection_name, page, results))
+        return answers
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        sessions = list(executor.map(session, range(SESSIONS)))
+
+    for answers in sessions:
+        for collection_name, page, results in answers:
+            assert results
+            assert results[0]["page"] == page
+            # Every session only sees the collection of its handle
+            assert all(
+                result["text"].startswith(f"The {collection_name} document")
+                for result in results
+            )
+    assert store.collection_name == "mycollection"
+    # The handles share the client pool of the store
+    assert CountingMongoClient.created == (1 if hasattr(store, "client") else 0)
@@ -0,0 +1,17 @@
+import core.context
+from core.util_functions import StreamMetrics
+
+
+class CharEncoding:
+    def encode(self, text, disallowed_special=()):
+        return list(text)
+
+
+def test_tokens_are_counted_with_the_chat_model_tokenizer(monkeypatch):
+    encodings = {"gpt-4o": CharEncoding()}
+    monkeypatch.setattr(core.context, "get_model_encoding", encodings.__getitem__)
+
+    metrics = StreamMetrics(model="gpt-4o")
+    assert "".join(metrics.track(["Hello", " world"])) == "Hello world"
+    assert metrics.tokens == len("Hello world")
+    assert metrics.as_dict()["tokens"] == 11
@@ -0,0 +1,34 @@
+import pytest
+
+from core.text_extractor import TextExtractor
+
+canvas = pytest.importorskip("reportlab.pdfgen.canvas")
+
+
+def make_pdf(path, labels: bool):
+    pdf = canvas.Canvas(str(path))
+    if labels:
+        # Roman front matter, then the body numbered from 1
+        pdf.addPageLabel(0, style="ROMAN_LOWER")
+        pdf.addPageLabel(3, style="ARABIC", start=1)
+    for index in range(8):
+        pdf.drawString(100, 700, f"Page {index}")
+        if index == 5:
+            pdf.bookmarkPage("installation")
+            pdf.addOutlineEntry("Installation", "installation", 0)
+        pdf.showPage()
+    pdf.save()
+
+
+def test_outline_pages_use_the_page_labels(tmp_path):
+    make_pdf(tmp_path / "labels.pdf", labels=True)
+    assert TextExtractor(str(tmp_path / "labels.pdf")).outline_toc() == [
+        {"title": "Installation", "page": "3", "level": 0}
+    ]
+
+
+def test_outline_pages_without_labels_count_from_one(tmp_path):
+    make_pdf(tmp_path / "plain.pdf", labels=False)
+    assert TextExtractor(str(tmp_path / "plain.pdf")).outline_toc() == [
+        {"title": "Installation", "page": "6", "level": 0}
+    ]